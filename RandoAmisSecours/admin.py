@@ -20,28 +20,32 @@
 from __future__ import unicode_literals
 
 from django.contrib import admin
+from django.db.models import DateTimeField, Value
 from django.utils.timezone import datetime, utc
-from RandoAmisSecours.models import FINISHED, FriendRequest, Outing, Profile, GPSPoint
+from RandoAmisSecours.models import FINISHED, ArchivedOuting, FriendRequest, Outing, Profile, GPSPoint, Notification
 
 
 class OutingAdmin(admin.ModelAdmin):
     list_display = ('name', 'user', 'beginning', 'ending', 'alert', 'finished', 'not_running', 'not_late', 'not_alerting')
     ordering = ('-beginning', '-ending', '-alert', 'name')
 
+    def get_queryset(self, request):
+        # Every column is computed relatively to the same time
+        now = datetime.utcnow().replace(tzinfo=utc)
+        return super(OutingAdmin, self).get_queryset(request) \
+                                       .annotate(now=Value(now, output_field=DateTimeField()))
+
     def finished(self, outing):
         return outing.status == FINISHED
 
     def not_running(self, outing):
-        now = datetime.utcnow().replace(tzinfo=utc)
-        return not outing.beginning <= now
+        return not outing.beginning <= outing.now
 
     def not_late(self, outing):
-        now = datetime.utcnow().replace(tzinfo=utc)
-        return not outing.ending <= now
+        return not outing.ending <= outing.now
 
     def not_alerting(self, outing):
-        now = datetime.utcnow().replace(tzinfo=utc)
-        return not outing.alert <= now
+        return not outing.alert <= outing.now
 
     finished.boolean = True
     not_running.boolean = True
@@ -49,6 +53,11 @@ class OutingAdmin(admin.ModelAdmin):
     not_alerting.boolean = True
 
 
+class ArchivedOutingAdmin(admin.ModelAdmin):
+    list_display = ('name', 'user', 'beginning', 'ending', 'status', 'point_count', 'archived')
+    ordering = ('-beginning', '-ending', 'name')
+
+
 class ProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'phone_number', 'language', 'timezone')
 
@@ -58,7 +67,15 @@ class GPSPointAdmin(admin.ModelAdmin):
     ordering = ('outing', 'date')
 
 
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ('key', 'user', 'channel', 'status', 'attempts', 'next_attempt', 'sent')
+    list_filter = ('status', 'channel')
+    ordering = ('-created', )
+
+
 admin.site.register(FriendRequest)
 admin.site.register(Outing, OutingAdmin)
+admin.site.register(ArchivedOuting, ArchivedOutingAdmin)
 admin.site.register(Profile, ProfileAdmin)
 admin.site.register(GPSPoint, GPSPointAdmin)
+admin.site.register(Notification, NotificationAdmin)
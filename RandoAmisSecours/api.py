@@ -19,28 +19,99 @@
 
 from __future__ import unicode_literals
 
-from django.db.models import Q
+from django.conf import settings
+from django.conf.urls import url
+from django.core.cache import cache
+from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import Count, Max, Q
+from django.db.models.constants import LOOKUP_SEP
+from django.http import HttpResponse
+from django.middleware.gzip import GZipMiddleware
 from django.contrib.auth.models import User
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, quote_etag
+from django.utils.timezone import datetime, is_naive, make_aware, timedelta, utc
 
 from tastypie import fields
 from tastypie.authentication import ApiKeyAuthentication, BasicAuthentication
 from tastypie.authorization import Authorization
-from tastypie.exceptions import Unauthorized
+from tastypie.exceptions import BadRequest, ImmediateHttpResponse, InvalidFilterError, Unauthorized
+from tastypie.http import HttpBadRequest, HttpCreated, HttpMultipleChoices, HttpNotFound
 from tastypie.models import ApiKey
-from tastypie.resources import ModelResource, ALL, ALL_WITH_RELATIONS
-
-from RandoAmisSecours.models import Outing, Profile, GPSPoint
+from tastypie.resources import ModelResource, Resource, ALL, ALL_WITH_RELATIONS
+from tastypie.utils import trailing_slash
+from tastypie.utils.mime import build_content_type
+
+from RandoAmisSecours.geo import near
+from RandoAmisSecours.models import ArchivedOuting, DeletedOuting, Outing, Profile, GPSPoint, TraceSegment, get_outing
+from RandoAmisSecours.paginator import KeysetPaginator
+from RandoAmisSecours.trace import EPOCH, MAX_ZOOM, decode, encode_polyline, get_simplified_trace, invalidate_trace, tolerance_for_zoom
+from RandoAmisSecours.utils import authentication_cache_key, authentication_version_key, get_friend_ids
+
+import calendar
+import hashlib
+import json
+import operator
+import uuid
+
+# Content type of the packed traces (see RandoAmisSecours.trace)
+TRACE_CONTENT_TYPE = 'application/x-ras-trace'
+
+
+class CachedApiKeyAuthentication(ApiKeyAuthentication):
+    """ Keep the users (with their API key and profile) authenticated by a
+    username and an API key in cache for RAS_AUTH_CACHE_TIMEOUT seconds.
+
+    The cached users are versioned: the version of a user is dropped when the
+    user, the API key or the profile change, invalidating every cached
+    authentication of this user. """
+    def is_authenticated(self, request, **kwargs):
+        try:
+            (username, api_key) = self.extract_credentials(request)
+        except ValueError:
+            return self._unauthorized()
+        if not username or not api_key:
+            return self._unauthorized()
+
+        key = authentication_cache_key(username, api_key)
+        cached = cache.get(key)
+        if cached is not None:
+            (user, version) = cached
+            if cache.get(authentication_version_key(user.pk)) == version:
+                request.user = user
+                return True
+
+        result = super(CachedApiKeyAuthentication, self).is_authenticated(request, **kwargs)
+        if result is not True:
+            return result
+
+        user = request.user
+        try:
+            user.profile
+        except Profile.DoesNotExist:
+            pass
+        # A change between the query and the creation of the version is
+        # only seen once the cache expires
+        timeout = getattr(settings, 'RAS_AUTH_CACHE_TIMEOUT', 60)
+        version_key = authentication_version_key(user.pk)
+        cache.add(version_key, uuid.uuid4().hex, timeout)
+        version = cache.get(version_key)
+        if version is not None:
+            cache.set(key, (user, version), timeout)
+        return True
 
 
 class UserAuthorization(Authorization):
     def read_list(self, object_list, bundle):
         return object_list.filter(Q(pk=bundle.request.user.pk) |
-                                  Q(profile__in=bundle.request.user.profile.friends.all()))
+                                  Q(pk__in=get_friend_ids(bundle.request.user)))
 
     def read_detail(self, object_list, bundle):
         # bundle.obj is a User
         return (bundle.obj.pk == bundle.request.user.pk or
-                bundle.obj.profile in bundle.request.user.profile.friends.all())
+                bundle.obj.pk in get_friend_ids(bundle.request.user))
 
     def create_list(self, object_list, bundle):
         raise Unauthorized('Creation impossible')
@@ -64,12 +135,12 @@ class UserAuthorization(Authorization):
 class ProfileAuthorization(Authorization):
     def read_list(self, object_list, bundle):
         return object_list.filter(Q(user=bundle.request.user) |
-                                  Q(pk__in=bundle.request.user.profile.friends.all()))
+                                  Q(user_id__in=get_friend_ids(bundle.request.user)))
 
     def read_detail(self, object_list, bundle):
         # bundle.obj is a Profile
-        return (bundle.obj.user == bundle.request.user or
-                bundle.obj in bundle.request.user.profile.friends.all())
+        return (bundle.obj.user_id == bundle.request.user.pk or
+                bundle.obj.user_id in get_friend_ids(bundle.request.user))
 
     def create_list(self, object_list, bundle):
         raise Unauthorized('Creation impossible')
@@ -93,12 +164,12 @@ class ProfileAuthorization(Authorization):
 class OutingAuthorization(Authorization):
     def read_list(self, object_list, bundle):
         return object_list.filter(Q(user=bundle.request.user) |
-                                  Q(user__profile__in=bundle.request.user.profile.friends.all()))
+                                  Q(user_id__in=get_friend_ids(bundle.request.user)))
 
     def read_detail(self, object_list, bundle):
         # bundle.obj is an Outing
-        return (bundle.obj.user == bundle.request.user or
-                bundle.obj.user.profile in bundle.request.user.profile.friends.all())
+        return (bundle.obj.user_id == bundle.request.user.pk or
+                bundle.obj.user_id in get_friend_ids(bundle.request.user))
 
     def create_list(self, object_list, bundle):
         raise Unauthorized('Creation impossible')
@@ -121,13 +192,13 @@ class OutingAuthorization(Authorization):
 
 class GPSPointAuthorization(Authorization):
     def read_list(self, object_list, bundle):
-        return object_list.filter(Q(outing__user__pk=bundle.request.user.pk) |
-                                  Q(outing__user__profile__in=bundle.request.user.profile.friends.all()))
+        return object_list.filter(Q(outing__user_id=bundle.request.user.pk) |
+                                  Q(outing__user_id__in=get_friend_ids(bundle.request.user)))
 
     def read_detail(self, object_list, bundle):
         # bundle.obj is a User
-        return (bundle.obj.outing.user.pk == bundle.request.user.pk or
-                bundle.obj.outing.user.profile in bundle.request.user.profile.friends.all())
+        return (bundle.obj.outing.user_id == bundle.request.user.pk or
+                bundle.obj.outing.user_id in get_friend_ids(bundle.request.user))
 
     def create_list(self, object_list, bundle):
         raise Unauthorized('Creation impossible')
@@ -148,7 +219,254 @@ class GPSPointAuthorization(Authorization):
         raise Unauthorized('Deletion impossible')
 
 
-class UserResource(ModelResource):
+def to_timestamp(date):
+    return calendar.timegm(date.utctimetuple()) if date else None
+
+
+class ConditionalMixin(object):
+    """ Answer 304 (Not Modified) to the polls of unchanged resources without
+    serializing them. The version of a list is the date of the last change
+    and the number of the objects the user can read, with the friends of the
+    user (the objects of a new friend might be older than the last change).
+    The version of an object is the date of its last change. """
+    version_field = 'updated'
+
+    def get_version(self, request, **kwargs):
+        bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(bundle=bundle, **self.remove_api_resource_names(kwargs))
+        version = objects.order_by().aggregate(last=Max(self.version_field), count=Count('pk'))
+        return (version['last'], version['count'])
+
+    def get_object_version(self, obj):
+        return getattr(obj, self.version_field)
+
+    def make_etag(self, request, version):
+        # The same resource is different for every user and query
+        query = sorted((k, v) for (k, v) in request.GET.items() if k not in ('username', 'api_key'))
+        data = repr((self._meta.resource_name, request.user.pk, query,
+                     request.META.get('HTTP_ACCEPT'), request.META.get('HTTP_ACCEPT_ENCODING'),
+                     version))
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def conditional_response(self, request, version, last_modified=None):
+        """ Return the 304 response or None and the ETag of the version. The
+        ETag is more precise than the Last-Modified date (to the second). """
+        etag = self.make_etag(request, version)
+        return (get_conditional_response(request, etag=etag, last_modified=to_timestamp(last_modified)), etag)
+
+    def set_version_headers(self, response, etag, last_modified=None):
+        response['ETag'] = quote_etag(etag)
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(to_timestamp(last_modified))
+        return response
+
+    def get_list(self, request, **kwargs):
+        # Only the ETag of the lists is checked: the date of the last change
+        # does not reflect the deletions
+        version = (self.get_version(request, **kwargs), sorted(get_friend_ids(request.user)))
+        (response, etag) = self.conditional_response(request, version)
+        if response is None:
+            response = super(ConditionalMixin, self).get_list(request, **kwargs)
+        return self.set_version_headers(response, etag)
+
+    def get_detail(self, request, **kwargs):
+        basic_bundle = self.build_bundle(request=request)
+
+        try:
+            obj = self.cached_obj_get(bundle=basic_bundle, **self.remove_api_resource_names(kwargs))
+        except ObjectDoesNotExist:
+            return HttpNotFound()
+        except MultipleObjectsReturned:
+            return HttpMultipleChoices("More than one resource is found at this URI.")
+
+        last_modified = self.get_object_version(obj)
+        (response, etag) = self.conditional_response(request, last_modified, last_modified)
+        if response is None:
+            bundle = self.build_bundle(obj=obj, request=request)
+            bundle = self.full_dehydrate(bundle)
+            bundle = self.alter_detail_data_to_serialize(request, bundle)
+            response = self.create_response(request, bundle)
+        return self.set_version_headers(response, etag, last_modified)
+
+
+class ColumnsMixin(object):
+    """ Fast path of the large lists, in JSON only, with ?layout=columns (an
+    array per field) or, if in the layouts of the resource, ?layout=polyline
+    (the same without the latitudes and longitudes, sent as a polyline).
+
+    The rows are read with values() and serialized without bundles, so the
+    dehydrate methods are not called. The related resources are given by
+    URIs built from their ids. The response is compressed if the client
+    accepts gzip. """
+    layouts = ('columns',)
+
+    def get_columns(self):
+        """ Return the (name, lookup, conversion) of every field """
+        def uri(resource):
+            template = resource.get_resource_uri() + '%d/'
+            return lambda pk: None if pk is None else template % pk
+
+        columns = []
+        for (name, field) in self.fields.items():
+            if name == 'resource_uri':
+                columns.append((name, 'pk', uri(self)))
+            elif isinstance(field, fields.ToOneField):
+                columns.append((name, "%s_id" % field.attribute, uri(field.to_class())))
+            elif isinstance(field, fields.DateTimeField):
+                columns.append((name, field.attribute, self._meta.serializer.format_datetime))
+            else:
+                columns.append((name, field.attribute, None))
+        return columns
+
+    def get_list(self, request, **kwargs):
+        layout = request.GET.get('layout')
+        if layout is None or self.determine_format(request) != 'application/json':
+            return super(ColumnsMixin, self).get_list(request, **kwargs)
+        if layout not in self.layouts:
+            raise BadRequest("Unknown layout '%s'" % layout)
+
+        # Same objects and pages than the usual list
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(bundle=base_bundle, **self.remove_api_resource_names(kwargs))
+        sorted_objects = self.apply_sorting(objects, options=request.GET)
+
+        columns = self.get_columns()
+        lookups = set(lookup for (_, lookup, _) in columns) - set(['pk'])
+        rows = sorted_objects.values('pk', *lookups)
+        paginator = self._meta.paginator_class(request.GET, rows, resource_uri=self.get_resource_uri(),
+                                               limit=self._meta.limit, max_limit=self._meta.max_limit,
+                                               collection_name=self._meta.collection_name)
+        page = paginator.page()
+        rows = page[self._meta.collection_name]
+
+        data = {'meta': page['meta'], 'columns': {}}
+        if layout == 'polyline':
+            data['polyline'] = encode_polyline((row['latitude'], row['longitude']) for row in rows)
+            columns = [c for c in columns if c[0] not in ('latitude', 'longitude')]
+        for (name, lookup, conversion) in columns:
+            if conversion is None:
+                data['columns'][name] = [row[lookup] for row in rows]
+            else:
+                data['columns'][name] = [None if row[lookup] is None else conversion(row[lookup])
+                                         for row in rows]
+
+        response = HttpResponse(json.dumps(data, separators=(',', ':')),
+                                content_type=build_content_type('application/json'))
+        return GZipMiddleware().process_response(request, response)
+
+
+class OutingPaginator(KeysetPaginator):
+    key = 'beginning'
+
+
+class GPSPointPaginator(KeysetPaginator):
+    key = 'date'
+
+    def get_pk(self, obj):
+        return point_pk(obj)
+
+
+def point_pk(point):
+    """ The packed points are not saved: as the dates of the points of an
+    outing are unique, they are ordered by date then by the opposite of the
+    outing primary key """
+    if isinstance(point, dict):
+        return point['pk'] if point['pk'] is not None else -point['outing_id']
+    return point.pk if point.pk is not None else -point.outing_id
+
+
+def point_position(point):
+    return (point['date'] if isinstance(point, dict) else point.date, point_pk(point))
+
+
+class PointList(object):
+    """ The saved GPS points (a queryset) and the packed ones, ordered by
+    date then by point_pk, for the GPSPoint paginator. Only the saved points
+    of the page are read and only the segments that might contain points of
+    the page are decoded. """
+    def __init__(self, points, segments, filters, fields=None):
+        self.points = points
+        self.model = points.model
+        self.segments = segments
+        self.filters = filters
+        # Rows of values() rather than objects
+        self.fields = fields
+
+    def values(self, *fields):
+        return PointList(self.points.values(*fields), self.segments, self.filters, fields)
+
+    def get_packed_points(self, segment):
+        points = []
+        for point in segment.get_points():
+            if all(function(getattr(point, name), value) for (name, function, value) in self.filters):
+                points.append(point)
+        return points
+
+    def get_packed(self, position, limit, end):
+        segments = self.segments.order_by('start', 'pk')
+        if position is not None:
+            segments = segments.filter(end__gte=position[0])
+        if end is not None:
+            segments = segments.filter(start__lte=end)
+        if self.fields is None:
+            segments = segments.select_related('outing')
+
+        packed = []
+        for segment in segments.iterator():
+            # The points of the next segments are not older than its start
+            if limit and len(packed) >= limit and segment.start > point_position(packed[-1])[0]:
+                break
+            for point in self.get_packed_points(segment):
+                if position is None or point_position(point) > position:
+                    if self.fields is None:
+                        point.outing = segment.outing
+                        packed.append(point)
+                    else:
+                        packed.append(dict((name, getattr(point, name)) for name in self.fields))
+            packed.sort(key=point_position)
+            packed = packed[:limit]
+        return packed
+
+    def after(self, position, limit):
+        """ Return the first 'limit' points (or every point) after the
+        (date, pk) position (or from the beginning) """
+        points = self.points.order_by('date', 'pk')
+        if position is not None:
+            (date, pk) = position
+            points = points.filter(Q(date__gt=date) | Q(date=date, pk__gt=pk))
+        points = list(points[:limit] if limit else points)
+        # The segments starting after a full page of saved points are skipped
+        end = point_position(points[-1])[0] if limit and len(points) == limit else None
+        return sorted(points + self.get_packed(position, limit, end), key=point_position)[:limit]
+
+    def count(self):
+        count = self.points.count()
+        for segment in self.segments.defer('data'):
+            # Every point of the segment matches if its bounds do
+            if all(function(segment.start, value) and function(segment.end, value)
+                   for (name, function, value) in self.filters if name == 'date'):
+                count += segment.count
+            else:
+                count += len(self.get_packed_points(segment))
+        return count
+
+    def __getitem__(self, index):
+        # Slices only, for the offset pagination
+        return self.after(None, index.stop)[index]
+
+
+# Filters of the GPSPoint resource applied to the packed points
+OPERATORS = {
+    'exact': operator.eq,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'range': lambda value, bounds: bounds[0] <= value <= bounds[1],
+}
+
+
+class UserResource(ConditionalMixin, ModelResource):
     profile = fields.ForeignKey('RandoAmisSecours.api.ProfileResource', 'profile')
 
     class Meta:
@@ -159,11 +477,16 @@ class UserResource(ModelResource):
         filtering = {
             'id': ALL
         }
-        authentication = ApiKeyAuthentication()
+        authentication = CachedApiKeyAuthentication()
         authorization = UserAuthorization()
 
+    version_field = 'profile__updated'
+
+    def get_object_version(self, obj):
+        return obj.profile.updated
+
 
-class ProfileResource(ModelResource):
+class ProfileResource(ConditionalMixin, ModelResource):
     user = fields.ForeignKey(UserResource, 'user')
     friends = fields.ToManyField('self', 'friends')
 
@@ -172,7 +495,7 @@ class ProfileResource(ModelResource):
         resource_name = 'profile'
         fields = ['phone_number', 'language', 'timezone', 'friends']
         allowed_methods = ['get']
-        authentication = ApiKeyAuthentication()
+        authentication = CachedApiKeyAuthentication()
         authorization = ProfileAuthorization()
 
     def dehydrate(self, bundle):
@@ -185,7 +508,7 @@ class ProfileResource(ModelResource):
         return bundle
 
 
-class OutingResource(ModelResource):
+class OutingResource(ConditionalMixin, ColumnsMixin, ModelResource):
     user = fields.ForeignKey(UserResource, 'user')
 
     class Meta:
@@ -193,25 +516,356 @@ class OutingResource(ModelResource):
         resource_name = 'outing'
         fields = ['id', 'name', 'description', 'status', 'beginning', 'ending', 'alert', 'latitude', 'longitude']
         allowed_methods = ['get']
+        filtering = {
+            'user': ALL_WITH_RELATIONS,
+            'status': ['exact', 'gt', 'gte', 'lt', 'lte', 'range'],
+            'ending': ['exact', 'gt', 'gte', 'lt', 'lte', 'range']
+        }
+        paginator_class = OutingPaginator
+        authentication = CachedApiKeyAuthentication()
+        authorization = OutingAuthorization()
+
+    def apply_filters(self, request, applicable_filters):
+        """ Also filter the outings around a position with
+        ?near=<latitude>,<longitude>,<distance in km> """
+        object_list = super(OutingResource, self).apply_filters(request, applicable_filters)
+        if 'near' in request.GET:
+            try:
+                (latitude, longitude, distance) = [float(v) for v in request.GET['near'].split(',')]
+            except ValueError:
+                raise InvalidFilterError("'near' should be 'latitude,longitude,distance'")
+            if not (-90 <= latitude <= 90 and -180 <= longitude <= 180 and
+                    0 <= distance <= getattr(settings, 'RAS_NEAR_MAX_DISTANCE', 100)):
+                raise InvalidFilterError("Invalid position or distance for 'near'")
+            object_list = near(object_list, latitude, longitude, distance)
+        return object_list
+
+
+class ArchivedOutingResource(ConditionalMixin, ModelResource):
+    user = fields.ForeignKey(UserResource, 'user')
+
+    class Meta:
+        queryset = ArchivedOuting.objects.all()
+        resource_name = 'archived_outing'
+        fields = ['id', 'name', 'description', 'status', 'beginning', 'ending', 'alert', 'latitude', 'longitude',
+                  'archived', 'point_count']
+        allowed_methods = ['get']
         filtering = {
             'user': ALL_WITH_RELATIONS,
             'status': ['exact', 'gt', 'gte', 'lt', 'lte', 'range']
         }
-        authentication = ApiKeyAuthentication()
+        authentication = CachedApiKeyAuthentication()
         authorization = OutingAuthorization()
 
+    version_field = 'archived'
+
 
-class GPSPointResource(ModelResource):
+class GPSPointResource(ConditionalMixin, ColumnsMixin, ModelResource):
     outing = fields.ForeignKey(OutingResource, 'outing')
 
     class Meta:
-        queryset = GPSPoint.objects.all()
+        queryset = GPSPoint.objects.select_related('outing')
         resource_name = 'GPSPoint'
         fields = ['outing', 'date', 'latitude', 'longitude', 'precision']
         allowed_methods = ['get']
-        authentication = ApiKeyAuthentication()
+        filtering = {
+            'outing': ['exact'],
+            'date': ['gt', 'gte', 'lt', 'lte', 'range']
+        }
+        paginator_class = GPSPointPaginator
+        authentication = CachedApiKeyAuthentication()
         authorization = GPSPointAuthorization()
 
+    layouts = ('columns', 'polyline')
+
+    def packed_filters(self, request, kwargs):
+        """ Return the (attribute, operator, value) of the filters applied to
+        the packed points """
+        filters = request.GET.copy() if hasattr(request, 'GET') else {}
+        filters.update(kwargs)
+        packed_filters = []
+        for (lookup, value) in self.build_filters(filters=filters).items():
+            (name, operator_name) = lookup.split(LOOKUP_SEP)
+            try:
+                if name == 'outing':
+                    value = int(value)
+                else:
+                    values = [parse_datetime(v) for v in (value if operator_name == 'range' else [value])]
+                    if None in values:
+                        raise ValueError
+                    values = [make_aware(v) if is_naive(v) else v for v in values]
+                    value = values if operator_name == 'range' else values[0]
+            except (TypeError, ValueError):
+                raise InvalidFilterError("Invalid value for '%s'" % lookup)
+            packed_filters.append(('outing_id' if name == 'outing' else name, OPERATORS[operator_name], value))
+        return packed_filters
+
+    def obj_get_list(self, bundle, **kwargs):
+        """ Also list the packed points (RandoAmisSecours.trace), merged by
+        the PointList of the pages """
+        objects = super(GPSPointResource, self).obj_get_list(bundle, **kwargs)
+
+        user = bundle.request.user
+        segments = TraceSegment.objects.filter(Q(outing__user_id=user.pk) |
+                                               Q(outing__user_id__in=get_friend_ids(user)))
+        filters = self.packed_filters(bundle.request, kwargs)
+        # Only the segments that might contain matching points
+        for (name, function, value) in filters:
+            if name == 'outing_id':
+                segments = segments.filter(outing_id=value)
+            elif function is OPERATORS['range']:
+                segments = segments.filter(end__gte=value[0], start__lte=value[1])
+            else:
+                if function in (operator.eq, operator.gt, operator.ge):
+                    segments = segments.filter(end__gte=value)
+                if function in (operator.eq, operator.lt, operator.le):
+                    segments = segments.filter(start__lte=value)
+
+        return PointList(objects, segments, filters)
+
+    def dehydrate_resource_uri(self, bundle):
+        # The packed points do not have any URI
+        if bundle.obj.pk is None:
+            return None
+        return super(GPSPointResource, self).dehydrate_resource_uri(bundle)
+
+    def get_version(self, request, **kwargs):
+        # Versioned by the outings rather than by scanning the points
+        outings = Outing.objects.filter(Q(user=request.user) |
+                                        Q(user_id__in=get_friend_ids(request.user)))
+        version = outings.order_by().aggregate(last=Max('trace_updated'), count=Count('pk'))
+        return (version['last'], version['count'])
+
+    def get_object_version(self, obj):
+        return obj.outing.trace_updated
+
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/bulk/(?P<outing_pk>\d+)%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('bulk'), name='api_gpspoint_bulk'),
+            url(r"^(?P<resource_name>%s)/trace/(?P<outing_pk>\d+)%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('trace'), name='api_gpspoint_trace'),
+        ]
+
+    def bad_request(self, request, message):
+        return ImmediateHttpResponse(self.error_response(request, {'error': message},
+                                                         response_class=HttpBadRequest))
+
+    def parse_points(self, request):
+        """ Return the list of (date, latitude, longitude, precision) of the
+        request, either a packed trace or a JSON object like
+        {"points": [[date, latitude, longitude, precision], ...]}, the date
+        being an ISO 8601 string or a number of seconds since the epoch """
+        content_type = request.META.get('CONTENT_TYPE', 'application/json')
+        if content_type.split(';')[0].strip() == TRACE_CONTENT_TYPE:
+            try:
+                return decode(request.body)
+            except (IndexError, ValueError):
+                raise self.bad_request(request, 'Invalid trace')
+
+        try:
+            data = self.deserialize(request, request.body, format=content_type)
+            points = []
+            for (date, latitude, longitude, precision) in data['points']:
+                if isinstance(date, (int, float)):
+                    date = EPOCH + timedelta(seconds=date)
+                else:
+                    date = parse_datetime(date)
+                    if date.tzinfo is None:
+                        date = date.replace(tzinfo=utc)
+                points.append((date, float(latitude), float(longitude), int(precision)))
+        except Exception:
+            raise self.bad_request(request, 'Invalid points')
+        return points
+
+    def bulk(self, request, **kwargs):
+        """ Add the points of one outing in a single request. Points already
+        recorded at the same date are skipped, so the client can send them
+        again when unsure of the outcome. """
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        points = self.parse_points(request)
+        if len(points) > getattr(settings, 'RAS_GPS_BULK_MAX', 1000):
+            raise self.bad_request(request, 'Too many points')
+        for (_, latitude, longitude, _) in points:
+            if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                raise self.bad_request(request, 'Invalid coordinates')
+
+        with transaction.atomic():
+            # Only the owner can add points. Locking the outing serializes the
+            # uploads of the same trace.
+            try:
+                outing = Outing.objects.select_for_update() \
+                                       .get(pk=kwargs['outing_pk'], user=request.user)
+            except Outing.DoesNotExist:
+                return HttpNotFound()
+
+            created = []
+            if points:
+                dates = [p[0] for p in points]
+                (start, end) = (min(dates), max(dates))
+                known = set(GPSPoint.objects.filter(outing=outing, date__range=(start, end))
+                                            .values_list('date', flat=True))
+                # The packed points are stored to the second
+                packed = set()
+                for segment in TraceSegment.objects.filter(outing=outing, start__lte=end, end__gte=start):
+                    packed.update(p.date for p in segment.get_points())
+
+                for (date, latitude, longitude, precision) in points:
+                    if date in known or date.replace(microsecond=0) in packed:
+                        continue
+                    known.add(date)
+                    created.append(GPSPoint(outing=outing, date=date, latitude=latitude,
+                                            longitude=longitude, precision=precision))
+                GPSPoint.objects.bulk_create(created)
+                if created:
+                    Outing.objects.filter(pk=outing.pk).update(trace_updated=datetime.utcnow().replace(tzinfo=utc))
+
+        # Once committed, or a reader could cache the previous trace again
+        if created:
+            invalidate_trace(outing.pk)
+
+        self.log_throttled_access(request)
+        return self.create_response(request, {'created': len(created),
+                                              'duplicates': len(points) - len(created)},
+                                    response_class=HttpCreated)
+
+    def trace(self, request, **kwargs):
+        """ Return the trace of the outing simplified for the 'zoom' level of
+        the map (the full trace without zoom) """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        try:
+            outing = get_outing(kwargs['outing_pk'])
+        except Outing.DoesNotExist:
+            return HttpNotFound()
+        if outing.user_id != request.user.pk and outing.user_id not in get_friend_ids(request.user):
+            return HttpNotFound()
+
+        try:
+            zoom = max(0, min(MAX_ZOOM, int(request.GET['zoom']))) if 'zoom' in request.GET else None
+        except ValueError:
+            raise self.bad_request(request, 'Invalid zoom')
+        tolerance = 0 if zoom is None else tolerance_for_zoom(zoom, outing.latitude)
+
+        last_modified = outing.trace_updated or outing.updated
+        (response, etag) = self.conditional_response(request, last_modified, last_modified)
+        if response is None:
+            points = get_simplified_trace(outing, tolerance)
+            response = self.create_response(request, {'tolerance': tolerance,
+                                                      'points': [[p.date, p.latitude, p.longitude, p.precision]
+                                                                 for p in points]})
+        self.log_throttled_access(request)
+        return self.set_version_headers(response, etag, last_modified)
+
+
+class SyncResource(Resource):
+    """ Changes visible to the user since the previous sync:
+
+        GET /api/1.0/sync/?token=<token of the previous response>
+
+    Without token (or with a token older than RAS_SYNC_DAYS days, 'reset'
+    being set), every outing, user and profile is sent but no GPS point: the
+    traces are fetched with the GPSPoint trace API.
+    Otherwise, only the changed outings, users and profiles and the deleted
+    or archived outings are sent. When the friends of the user change, every
+    outing is sent again: the client drops the outings of the former friends
+    and fetches the traces of the new ones. The new GPS points are sent by batches of RAS_SYNC_POINTS, 'more'
+    being set when the client should ask for the next batch. Like the other
+    changes, the points created in the last RAS_SYNC_OVERLAP seconds are sent
+    again: the client drops the points it already has (same outing and
+    date). """
+    class Meta:
+        resource_name = 'sync'
+        allowed_methods = ['get']
+        include_resource_uri = False
+        authentication = CachedApiKeyAuthentication()
+
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('sync'), name='api_sync'),
+        ]
+
+    def encode_token(self, date, position):
+        (created, point_pk) = position
+        return "%d.%d.%d" % (int((date - EPOCH).total_seconds() * 1000000),
+                             int((created - EPOCH).total_seconds() * 1000000), point_pk)
+
+    def decode_token(self, token):
+        """ Return the date of the previous sync and the position (creation
+        date and pk) of the next GPS points """
+        try:
+            (timestamp, created, point_pk) = [int(v) for v in token.split('.')]
+            return (EPOCH + timedelta(microseconds=timestamp),
+                    (EPOCH + timedelta(microseconds=created), point_pk))
+        except (OverflowError, ValueError):
+            raise BadRequest("Invalid sync token")
+
+    def dehydrate_objects(self, resource, request, objects):
+        return [resource.full_dehydrate(resource.build_bundle(obj=obj, request=request))
+                for obj in objects]
+
+    def sync(self, request, **kwargs):
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        now = datetime.utcnow().replace(tzinfo=utc)
+        overlap = timedelta(seconds=getattr(settings, 'RAS_SYNC_OVERLAP', 10))
+        (since, position) = (None, None)
+        if request.GET.get('token'):
+            (since, position) = self.decode_token(request.GET['token'])
+        reset = since is not None and since < now - timedelta(days=getattr(settings, 'RAS_SYNC_DAYS', 30))
+
+        user_pks = [request.user.pk] + list(get_friend_ids(request.user))
+        profiles = Profile.objects.filter(user_id__in=user_pks).select_related('user')
+        outings = Outing.objects.filter(user_id__in=user_pks).select_related('user')
+        points = []
+        more = False
+        if since is None or reset:
+            deleted = []
+        else:
+            # The changes committed after the previous sync by the slow
+            # transactions are sent again
+            since -= overlap
+            profiles = profiles.filter(updated__gt=since)
+            if request.user.pk not in [profile.user_id for profile in profiles]:
+                outings = outings.filter(updated__gt=since)
+            deleted = DeletedOuting.objects.filter(owner__in=user_pks, deleted__gt=since) \
+                                           .values_list('pk', flat=True)
+
+            limit = getattr(settings, 'RAS_SYNC_POINTS', 1000)
+            (created, point_pk) = position
+            points = list(GPSPoint.objects.filter(Q(created__gt=created) | Q(created=created, pk__gt=point_pk),
+                                                  outing__user_id__in=user_pks)
+                                          .order_by('created', 'pk')
+                                          .values_list('created', 'pk', 'outing_id', 'date', 'latitude', 'longitude', 'precision')[:limit + 1])
+            more = len(points) > limit
+            points = points[:limit]
+
+        if more:
+            # The next batch starts after the last point sent
+            position = points[-1][:2]
+        else:
+            # The points created after the sync, or committed late, come with
+            # the next one
+            position = (now - overlap, 0)
+        data = {'token': self.encode_token(now, position),
+                'reset': reset,
+                'more': more,
+                'users': self.dehydrate_objects(UserResource(), request, [p.user for p in profiles]),
+                'profiles': self.dehydrate_objects(ProfileResource(), request, profiles),
+                'outings': self.dehydrate_objects(OutingResource(), request, outings),
+                'deleted_outings': list(deleted),
+                'points': [list(point[2:]) for point in points]}
+        self.log_throttled_access(request)
+        return self.create_response(request, data)
+
 
 class LoginResource(ModelResource):
     class Meta:
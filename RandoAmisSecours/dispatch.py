@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+
+# Copyright 2016 Rémi Duraffort
+# This file is part of RandoAmisSecours.
+#
+# RandoAmisSecours is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RandoAmisSecours is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with RandoAmisSecours.  If not, see <http://www.gnu.org/licenses/>
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.mail import get_connection, send_mail
+
+from multiprocessing.pool import ThreadPool
+import logging
+import smtplib
+import threading
+import time
+
+logger = logging.getLogger('ras.dispatch')
+
+
+class Job(object):
+    def __init__(self, channel, recipient, function, args):
+        self.channel = channel
+        self.recipient = recipient
+        self.function = function
+        self.args = args
+        self.result = None
+        self.started = None
+        self.cancelled = False
+        self.duration = None
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            if self.cancelled:
+                return None
+            self.started = time.time()
+        try:
+            return self.function(*self.args)
+        finally:
+            self.duration = time.time() - self.started
+
+    def cancel(self):
+        """ Prevent the job from starting. Return False if already started. """
+        with self.lock:
+            if self.started is None:
+                self.cancelled = True
+            return self.cancelled
+
+
+class Dispatcher(object):
+    """ Send the notifications from a pool of threads per channel (email and
+    every SMS provider), so a slow provider does not delay the others.
+
+    The messages should be rendered by the caller: translation and timezone
+    activations are not shared with the threads.
+    Every email thread keeps its SMTP connection open until the end of the
+    run. Every job should be done 'timeout' seconds after its thread started
+    it: the jobs waiting for a channel whose threads are all stuck are
+    cancelled. """
+    def __init__(self, limits=None, timeout=None):
+        self.limits = getattr(settings, 'RAS_DISPATCH_LIMITS', {}) if limits is None else limits
+        self.default_limit = getattr(settings, 'RAS_DISPATCH_DEFAULT_LIMIT', 2)
+        self.timeout = getattr(settings, 'RAS_DISPATCH_TIMEOUT', 30) if timeout is None else timeout
+        self.pools = {}
+        self.jobs = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        # Time spent sending, by channel
+        self.durations = {}
+
+    def get_connection(self):
+        """ Return the mail connection of the current thread """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = get_connection()
+            connection.open()
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def send_mail(self, subject, body, from_email, recipient_list):
+        connection = self.get_connection()
+        try:
+            send_mail(subject, body, from_email, recipient_list,
+                      connection=connection)
+        except smtplib.SMTPServerDisconnected:
+            # The server might close idle connections: retry once
+            connection.close()
+            connection.open()
+            send_mail(subject, body, from_email, recipient_list,
+                      connection=connection)
+
+    def get_limit(self, channel):
+        return self.limits.get(channel, self.default_limit)
+
+    def submit(self, channel, recipient, function, *args):
+        if channel not in self.pools:
+            self.pools[channel] = ThreadPool(self.get_limit(channel))
+        job = Job(channel, recipient, function, args)
+        job.result = self.pools[channel].apply_async(job)
+        self.jobs.append(job)
+        return job
+
+    def join(self):
+        """ Wait for every job and return the list of (job, error) that failed
+        or did not finish on time, the error being 'timeout' for the jobs whose
+        thread might still send the message and 'cancelled' for the jobs that
+        never started """
+        failures = []
+        # Threads stuck on a timeout, by channel
+        stuck = {}
+        pending = self.jobs
+        while pending:
+            waiting = []
+            for job in pending:
+                if job.result.ready():
+                    self.durations[job.channel] = self.durations.get(job.channel, 0) + job.duration
+                    if not job.result.successful():
+                        try:
+                            job.result.get()
+                        except Exception as exc:
+                            failures.append((job, exc))
+                            logger.error("Unable to send %s to '%s'", job.channel, job.recipient,
+                                         exc_info=True,
+                                         extra={'data': {'user': job.recipient,
+                                                         'channel': job.channel}})
+                elif job.started is not None and time.time() - job.started >= self.timeout:
+                    failures.append((job, 'timeout'))
+                    logger.error("Timeout when sending %s to '%s'", job.channel, job.recipient)
+                    stuck[job.channel] = stuck.get(job.channel, 0) + 1
+                else:
+                    waiting.append(job)
+
+            pending = []
+            for job in waiting:
+                # No thread left to start the job
+                if stuck.get(job.channel, 0) >= self.get_limit(job.channel) and job.cancel():
+                    failures.append((job, 'cancelled'))
+                    logger.error("Cancelled sending %s to '%s'", job.channel, job.recipient)
+                else:
+                    pending.append(job)
+            if pending:
+                # Until the next job ends or times out
+                started = [job.started for job in pending if job.started is not None]
+                delay = min(started) + self.timeout - time.time() if started else self.timeout
+                pending[0].result.wait(max(0.01, min(0.1, delay)))
+
+        # The threads stuck on a timeout are abandoned
+        for pool in self.pools.values():
+            pool.terminate()
+        self.pools = {}
+        self.jobs = []
+
+        for connection in self.connections:
+            try:
+                connection.close()
+            except Exception:
+                logger.warning("Unable to close the mail connection", exc_info=True)
+        self.local = threading.local()
+        self.connections = []
+        return failures
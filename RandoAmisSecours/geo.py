@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+
+# Copyright 2016 Rémi Duraffort
+# This file is part of RandoAmisSecours.
+#
+# RandoAmisSecours is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RandoAmisSecours is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with RandoAmisSecours.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Geographic search of the outings
+
+Every outing stores the geohash of its position: the points of a cell share
+the prefix of its geohash, so a cell is a range of the (indexed) column. An
+area is covered by a few cells, the candidates being refined in SQL with the
+distance on the local projection.
+"""
+
+from __future__ import unicode_literals
+
+from django.db.models import ExpressionWrapper, F, FloatField, Q
+
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+# Length of the stored geohashes (cells of about 5 meters)
+GEOHASH_LENGTH = 9
+# Maximum number of cells covering a search area
+MAX_CELLS = 16
+
+EARTH_RADIUS = 6371.0
+# Length of a degree of latitude (in km)
+DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+def encode(latitude, longitude, length=GEOHASH_LENGTH):
+    """ Return the geohash of the position """
+    (lat_min, lat_max) = (-90.0, 90.0)
+    (lon_min, lon_max) = (-180.0, 180.0)
+    geohash = []
+    (bits, value, even) = (0, 0, True)
+    while len(geohash) < length:
+        # Longitude and latitude bits are interleaved, starting with the
+        # longitude
+        if even:
+            middle = (lon_min + lon_max) / 2
+            if longitude >= middle:
+                value = value * 2 + 1
+                lon_min = middle
+            else:
+                value *= 2
+                lon_max = middle
+        else:
+            middle = (lat_min + lat_max) / 2
+            if latitude >= middle:
+                value = value * 2 + 1
+                lat_min = middle
+            else:
+                value *= 2
+                lat_max = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            geohash.append(BASE32[value])
+            (bits, value) = (0, 0)
+    return ''.join(geohash)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """ Distance between two positions (in km) """
+    (lat1, lon1, lat2, lon2) = [math.radians(v) for v in (lat1, lon1, lat2, lon2)]
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+
+def bounding_boxes(latitude, longitude, distance):
+    """ Return the (min_lat, max_lat, min_lon, max_lon) boxes containing the
+    positions closer than 'distance' km, split on the antimeridian """
+    delta = distance / DEGREE
+    (min_lat, max_lat) = (latitude - delta, latitude + delta)
+    if min_lat <= -90 or max_lat >= 90:
+        # Around a pole: every longitude
+        return [(max(min_lat, -90), min(max_lat, 90), -180, 180)]
+
+    delta = delta / math.cos(math.radians(latitude))
+    (min_lon, max_lon) = (longitude - delta, longitude + delta)
+    if max_lon - min_lon >= 360:
+        return [(min_lat, max_lat, -180, 180)]
+    if min_lon < -180:
+        return [(min_lat, max_lat, min_lon + 360, 180), (min_lat, max_lat, -180, max_lon)]
+    if max_lon > 180:
+        return [(min_lat, max_lat, min_lon, 180), (min_lat, max_lat, -180, max_lon - 360)]
+    return [(min_lat, max_lat, min_lon, max_lon)]
+
+
+def cover(min_lat, max_lat, min_lon, max_lon):
+    """ Return the prefixes of the cells covering the box: the longest
+    prefixes covering it with at most MAX_CELLS cells """
+    for length in range(GEOHASH_LENGTH, 0, -1):
+        lat_bits = 5 * length // 2
+        lon_bits = 5 * length - lat_bits
+        (height, width) = (180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits)
+
+        rows = range(int((min_lat + 90) / height), min(int((max_lat + 90) / height), 2 ** lat_bits - 1) + 1)
+        columns = range(int((min_lon + 180) / width), min(int((max_lon + 180) / width), 2 ** lon_bits - 1) + 1)
+        if len(rows) * len(columns) <= MAX_CELLS:
+            # Geohash of the center of every cell
+            return sorted(set(encode((row + 0.5) * height - 90, (column + 0.5) * width - 180, length)
+                              for row in rows for column in columns))
+    return ['']
+
+
+def near(queryset, latitude, longitude, distance):
+    """ Filter the outings of the queryset closer than 'distance' km to the
+    position. The candidates found with the index are refined in SQL on the
+    local projection of the area, a few meters off for a radius of 100 km. """
+    (sin0, cos0) = (math.sin(math.radians(latitude)), math.cos(math.radians(latitude)))
+    query = Q()
+    for (index, (min_lat, max_lat, min_lon, max_lon)) in enumerate(bounding_boxes(latitude, longitude, distance)):
+        cells = Q()
+        for prefix in cover(min_lat, max_lat, min_lon, max_lon):
+            # Every geohash starting with the prefix
+            cells |= Q(geohash__range=(prefix, prefix + '~'))
+        box = cells & Q(latitude__range=(min_lat, max_lat), longitude__range=(min_lon, max_lon))
+        if max_lon - min_lon >= 360:
+            # Around a pole: the whole box
+            query |= box
+            continue
+
+        # Center of the box, on the same side of the antimeridian
+        center = longitude
+        if min_lon > longitude + 180:
+            center += 360
+        elif max_lon < longitude - 180:
+            center -= 360
+        # Squared distance in degrees of latitude, the cosine of the middle
+        # latitude being linearized around the position
+        dlat = F('latitude') - latitude
+        dlon = (F('longitude') - center) * (cos0 - sin0 * math.pi / 360 * dlat)
+        name = 'near_%d' % index
+        queryset = queryset.annotate(**{name: ExpressionWrapper(dlat * dlat + dlon * dlon, output_field=FloatField())})
+        query |= box & Q(**{name + '__lte': (distance / DEGREE) ** 2})
+    return queryset.filter(query)
@@ -19,19 +19,99 @@
 
 from __future__ import unicode_literals
 
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.core.urlresolvers import reverse
-from django.utils.timesince import timesince
-from django.utils.timezone import datetime, utc
+from django.db import transaction
+from django.db.models import Case, DateTimeField, F, Prefetch, Value, When, signals
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import datetime, is_naive, make_aware, timedelta, utc
+from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy as _
 
-from RandoAmisSecours.models import Outing, CONFIRMED, DRAFT
-from RandoAmisSecours.utils import Localize, send_mail_help, send_sms
+from RandoAmisSecours.dispatch import Dispatcher
+from RandoAmisSecours.metrics import Metrics
+from RandoAmisSecours.models import Outing, Profile, CONFIRMED, DRAFT, EMAIL
+from RandoAmisSecours.outbox import drain, enqueue, make_key, mail_notification, sms_notification
+from RandoAmisSecours.scheduler import AlertScheduler, current_window, next_deadline
+from RandoAmisSecours.utils import Localize, RenderCache
 
+from collections import OrderedDict
+import io
+import json
 import logging
+import re
+import time
 
 logger = logging.getLogger('ras.alert')
 
+# Number of outings loaded at once
+CHUNK_SIZE = 500
+
+EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+
+
+def alert_queryset():
+    """ Outings along with everything needed to alert the owner and friends """
+    return Outing.objects.select_related('user__profile') \
+                         .prefetch_related(Prefetch('user__profile__friends',
+                                                    queryset=Profile.objects.select_related('user')))
+
+
+def lock_chunk(queryset, last_pk, size=CHUNK_SIZE):
+    """ Lock the next 'size' outings of the queryset, using the primary key to
+    paginate, and load them along with everything needed to alert.
+    Should be called inside a transaction. Only the outings are locked so the
+    workers do not wait for each other on the users and profiles. """
+    pks = list(queryset.select_for_update()
+                       .filter(pk__gt=last_pk)
+                       .order_by('pk')
+                       .values_list('pk', flat=True)[:size])
+    if not pks:
+        return []
+    return list(alert_queryset().filter(pk__in=pks).order_by('pk'))
+
+
+def parse_shard(value):
+    """ Parse a 'N/M' shard into (N, M) """
+    try:
+        (index, count) = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise CommandError("Invalid shard '%s', should be N/M" % value)
+    if count < 1 or not 1 <= index <= count:
+        raise CommandError("Invalid shard '%s', should be N/M with 1 <= N <= M" % value)
+    return (index, count)
+
+
+def parse_time(value):
+    """ Parse a date and time, UTC if the timezone is not given """
+    try:
+        date = parse_datetime(value)
+    except ValueError:
+        date = None
+    if date is None:
+        raise CommandError("Invalid date '%s', should be YYYY-MM-DD HH:MM" % value)
+    if is_naive(date):
+        date = make_aware(date, utc)
+    return date
+
+
+def parse_step(value):
+    """ Parse a step like 30s, 1m or 2h """
+    match = re.match(r'^(\d+)([smh])$', value)
+    if match is None or not int(match.group(1)):
+        raise CommandError("Invalid step '%s', should be like 30s, 1m or 2h" % value)
+    unit = {'s': 'seconds', 'm': 'minutes', 'h': 'hours'}[match.group(2)]
+    return timedelta(**{unit: int(match.group(1))})
+
+
+def in_shard(queryset, shard):
+    """ Only keep the outings of the given shard """
+    if shard is None:
+        return queryset
+    (index, count) = shard
+    return queryset.annotate(shard=F('pk') % count).filter(shard=index - 1)
+
 
 class Command(BaseCommand):
     help = 'Alert the user or his friends that he is late'
@@ -39,102 +119,415 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--interval', dest='interval', default=10,
                             type=int, help='Check interval in minutes')
-        parser.add_argument('--alert', dest='alert', default=60,
+        parser.add_argument('--alert', dest='alert',
+                            default=getattr(settings, 'RAS_ALERT_PERIOD', 60),
                             type=int, help='Alerting interval')
         parser.add_argument('--url', dest='base_url',
                             help='Base URL of the website')
+        parser.add_argument('--daemon', dest='daemon', default=False,
+                            action='store_true',
+                            help='Keep running and send the alerts on time')
+        parser.add_argument('--refresh', dest='refresh', default=60,
+                            type=int, help='Refresh interval in seconds (daemon only)')
+        parser.add_argument('--no-send', dest='send', default=True,
+                            action='store_false',
+                            help='Only fill the outbox, the notify command will send them')
+        parser.add_argument('--shard', dest='shard', default=None,
+                            help='Only handle the N-th of M shards of the outings (N/M)')
+        parser.add_argument('--metrics-file', dest='metrics_file', default=None,
+                            help='Write the metrics of every run to this file (Prometheus format)')
+        parser.add_argument('--simulate', dest='simulate', default=False,
+                            action='store_true',
+                            help='Run the alert logic against a virtual clock without sending anything')
+        parser.add_argument('--from', dest='start', default=None,
+                            help='Beginning of the simulation (default to now)')
+        parser.add_argument('--to', dest='end', default=None,
+                            help='End of the simulation (default to one day after the beginning)')
+        parser.add_argument('--step', dest='step', default=None,
+                            help='Step of the virtual clock, like 30s, 1m or 2h (default to the interval)')
+        parser.add_argument('--output', dest='output', default=None,
+                            help='File where the simulated notifications are written (JSON lines)')
 
     def handle(self, *args, **kwargs):
+        self.period = timedelta(minutes=kwargs['alert'])
+        if kwargs.get('simulate'):
+            self.simulate(kwargs)
+            return
+
         if kwargs.get('base_url', None) is None:
             raise CommandError('url option is required')
+        self.base_url = kwargs['base_url']
+        self.send = kwargs['send']
+        self.dispatcher = Dispatcher()
+        self.notifications = []
+        self.renderer = RenderCache()
+        self.metrics = Metrics('ras_alert')
+        self.metrics_file = kwargs.get('metrics_file')
+        self.shard = None
+        if kwargs.get('shard'):
+            self.shard = parse_shard(kwargs['shard'])
+
+        if kwargs['daemon']:
+            self.daemon(kwargs['refresh'])
+            return
 
         logger.info("Running Alert script")
+        start = time.time()
         now = datetime.utcnow().replace(tzinfo=utc)
+        # Assuming that cron starts the script on multiples of the interval
+        self.metrics.set('lag_seconds', (now - EPOCH).total_seconds() % (kwargs['interval'] * 60))
 
         # Transform all DRAFT into CONFIRMED if the beginning is over
         logger.debug('Transforming DRAFTs')
-        outings = Outing.objects.filter(status=DRAFT, beginning__lt=now)
-        for outing in outings:
-            logger.info("Confirm: '%s' (owner: '%s')", outing.name,
-                        outing.user.get_full_name())
-            outing.status = CONFIRMED
-            outing.save()
+        with self.metrics.timer('phase_seconds', phase='drafts'):
+            self.confirm_drafts(now)
 
-        # Grab all late outings
+        # Grab the outings that should be notified, including the windows
+        # missed by the previous runs
         logger.debug('Alerting owner and friends')
-        outings = Outing.objects.filter(status=CONFIRMED, ending__lt=now)
+        outings = in_shard(Outing.objects.filter(status=CONFIRMED, next_notification_at__lte=now),
+                           self.shard)
 
-        for outing in outings:
-            logger.debug("Inspecting: '%s' (owner: '%s')", outing.name,
-                         outing.user.get_full_name())
-            # Late outings
-            if outing.ending <= now and now < outing.alert:
-                logger.debug(' |-> Late')
-                minutes = (now - outing.ending).seconds / 60.0
-                minutes = minutes % kwargs['alert']
-
-                if 0 <= minutes and minutes < kwargs['interval']:
-                    logger.debug(' |--> Alerting the owner')
-                    logger.debug("     |-> %s", outing.user.get_full_name())
-                    logger.debug("     |--> email: %s", outing.user.email)
-                    logger.debug("     |--> provider: %s", outing.user.profile.provider)
-                    # send a mail to the user, translated into the right language
-                    with Localize(outing.user.profile.language,
-                                  outing.user.profile.timezone):
-                        send_mail_help(outing.user, _('[R.A.S] Alert'),
-                                       'RandoAmisSecours/alert/late.html',
-                                       {'URL': "%s%s" % (kwargs['base_url'],
-                                                         reverse('outings.details', args=[outing.pk])),
-                                        'SAFE_URL': "%s%s" % (kwargs['base_url'],
-                                                              reverse('outings.finish', args=[outing.pk]))})
-                        send_sms(outing.user, 'RandoAmisSecours/alert/late.txt',
-                                 {'name': outing.name})
-
-            # Alerting outings
-            elif outing.alert <= now:
-                logger.debug(' |-> Alert')
-                minutes = (now - outing.alert).seconds / 60.0
-                minutes = minutes % kwargs['alert']
-
-                if 0 <= minutes and minutes < kwargs['interval']:
-                    logger.debug(' |--> Alerting now')
-                    friend_count = outing.user.profile.friends.count()
-                    logger.debug(" |---> %d friends to contact", friend_count)
-                    # Send on mail per user translated into the right language
-                    for friend_profile in outing.user.profile.friends.all():
-                        logger.debug("      |-> %s", friend_profile.user.get_full_name())
-                        logger.debug("      |--> email: %s", friend_profile.user.email)
-                        logger.debug("      \\--> provider: %s", friend_profile.provider)
-                        with Localize(friend_profile.language,
-                                      friend_profile.timezone):
-                            send_mail_help(friend_profile.user, _('[R.A.S] Alert'),
-                                           'RandoAmisSecours/alert/alert.html',
-                                           {'fullname': outing.user.get_full_name(),
-                                            'URL': "%s%s" % (kwargs['base_url'], reverse('outings.details', args=[outing.pk])),
-                                            'name': outing.name,
-                                            'ending': outing.ending})
-                            send_sms(friend_profile.user,
-                                     'RandoAmisSecours/alert/alert.txt',
-                                     {'fullname': outing.user.get_full_name(),
-                                      'name': outing.name,
-                                      'ending': timesince(outing.ending)})
-                    logger.debug(' |--> Alerting the owner')
-                    logger.debug("     |-> %s", outing.user.get_full_name())
-                    logger.debug("     |--> email: %s", outing.user.email)
-                    logger.debug("     |--> provider: %s", outing.user.profile.provider)
-                    with Localize(outing.user.profile.language,
-                                  outing.user.profile.timezone):
-                        send_mail_help(outing.user, _('[R.A.S] Alert'),
-                                       'RandoAmisSecours/alert/alert_owner.html',
-                                       {'fullname': outing.user.get_full_name(),
-                                        'URL': "%s%s" % (kwargs['base_url'],
-                                                         reverse('outings.details', args=[outing.pk])),
-                                        'name': outing.name,
-                                        'ending': outing.ending,
-                                        'friend_count': friend_count})
-                        send_sms(outing.user,
-                                 'RandoAmisSecours/alert/alert_owner.txt',
-                                 {'name': outing.name,
-                                  'ending': timesince(outing.ending)})
+        last_pk = 0
+        while True:
+            # The outings are locked so the workers with overlapping shards
+            # do not handle them concurrently, and the notifications are
+            # saved along with the decision to send them
+            with transaction.atomic():
+                with self.metrics.timer('phase_seconds', phase='scan'):
+                    chunk = lock_chunk(outings, last_pk)
+                self.advance(chunk, now)
+                for outing in chunk:
+                    logger.debug("Inspecting: '%s' (owner: '%s')", outing.name,
+                                 outing.user.get_full_name())
+                    self.notify(outing, now)
+                self.enqueue()
+            if len(chunk) < CHUNK_SIZE:
+                break
+            last_pk = chunk[-1].pk
 
+        self.drain(now)
+        self.metrics.set('duration_seconds', time.time() - start)
+        self.metrics.set('last_run_timestamp', time.time())
+        self.metrics.publish(self.metrics_file)
         logger.info("End of Alert script")
+
+    def decide(self, outing, now):
+        """ Return 'late' or 'alert' for a confirmed outing due at 'now' """
+        if now < outing.alert:
+            logger.debug(' |-> Late')
+            self.metrics.incr('outings', state='late')
+            return 'late'
+        logger.debug(' |-> Alert')
+        self.metrics.incr('outings', state='alerting')
+        return 'alert'
+
+    def notify(self, outing, now):
+        window = current_window(outing, now, self.period)
+        if self.decide(outing, now) == 'late':
+            self.alert_late(outing, window, now)
+        else:
+            self.alert_friends(outing, window, now)
+
+    def advance(self, outings, now):
+        """ Move the next notification time of the due outings after 'now',
+        in a single query. Return the number of outings advanced: the ones
+        already advanced by another worker are skipped. """
+        if not outings:
+            return 0
+        whens = []
+        for outing in outings:
+            outing.next_notification_at = next_deadline(outing, now, self.period)
+            outing.notification_count += 1
+            whens.append(When(pk=outing.pk, then=Value(outing.next_notification_at)))
+        return Outing.objects.filter(pk__in=[outing.pk for outing in outings],
+                                     next_notification_at__lte=now) \
+                             .update(next_notification_at=Case(*whens, output_field=DateTimeField()),
+                                     notification_count=F('notification_count') + 1)
+
+    def simulate(self, kwargs):
+        """ Run the cron logic every step between two dates and record the
+        notifications that would be queued. Nothing is saved nor sent. """
+        interval = kwargs['interval']
+        start = parse_time(kwargs['start']) if kwargs.get('start') else datetime.utcnow().replace(tzinfo=utc)
+        end = parse_time(kwargs['end']) if kwargs.get('end') else start + timedelta(days=1)
+        step = parse_step(kwargs['step']) if kwargs.get('step') else timedelta(minutes=interval)
+        self.metrics = Metrics('ras_alert')
+        self.shard = parse_shard(kwargs['shard']) if kwargs.get('shard') else None
+
+        # The outings are only loaded once: the simulation does not see the
+        # changes made by the users
+        outings = list(in_shard(alert_queryset().filter(status__in=[DRAFT, CONFIRMED]), self.shard)
+                       .order_by('pk'))
+        logger.info("Simulating %d outings from %s to %s", len(outings), start, end)
+
+        events = []
+        keys = set()
+        duplicates = 0
+        clock = time.time()
+        now = start
+        while now <= end:
+            for outing in outings:
+                if outing.status == DRAFT and outing.beginning < now:
+                    outing.status = CONFIRMED
+                    events.append({'time': now.isoformat(), 'outing': outing.pk,
+                                   'event': 'confirm'})
+                if outing.status != CONFIRMED or outing.next_notification_at is None or \
+                   now < outing.next_notification_at:
+                    continue
+
+                action = self.decide(outing, now)
+                window = current_window(outing, now, self.period)
+                outing.next_notification_at = next_deadline(outing, now, self.period)
+                users = [outing.user]
+                if action == 'alert':
+                    users.extend([profile.user for profile in outing.user.profile.friends.all()])
+                for user in users:
+                    channels = [EMAIL]
+                    if user.profile.provider and user.profile.provider_data:
+                        channels.append(user.profile.provider)
+                    for channel in channels:
+                        key = make_key(outing, window, user, channel)
+                        # The outbox would drop the duplicates
+                        duplicate = key in keys
+                        duplicates += duplicate
+                        keys.add(key)
+                        events.append({'time': now.isoformat(), 'outing': outing.pk,
+                                       'event': action, 'user': user.username,
+                                       'channel': channel, 'key': key,
+                                       'duplicate': duplicate})
+            now += step
+
+        if kwargs.get('output'):
+            with io.open(kwargs['output'], 'w', encoding='utf-8') as f_out:
+                for event in events:
+                    f_out.write("%s\n" % json.dumps(event, sort_keys=True))
+
+        self.stdout.write("%d notifications (%d duplicates) simulated in %.2fs" %
+                          (len(keys) + duplicates, duplicates, time.time() - clock))
+        return events
+
+    def daemon(self, refresh):
+        logger.info("Running Alert daemon")
+        scheduler = AlertScheduler()
+        refresh = timedelta(seconds=refresh)
+        # The outings committed late by slow transactions are read again
+        overlap = timedelta(seconds=getattr(settings, 'RAS_ALERT_REFRESH_OVERLAP', 10))
+
+        # Keep the schedule in sync with the outings saved by this process
+        def outing_saved(sender, instance, **kwargs):
+            if self.shard is None or instance.pk % self.shard[1] == self.shard[0] - 1:
+                scheduler.update(instance)
+
+        def outing_deleted(sender, instance, **kwargs):
+            scheduler.discard(instance.pk)
+
+        signals.post_save.connect(outing_saved, sender=Outing,
+                                  dispatch_uid='alert_daemon_saved')
+        signals.post_delete.connect(outing_deleted, sender=Outing,
+                                    dispatch_uid='alert_daemon_deleted')
+
+        # The notifications missed while the daemon was stopped are due
+        now = datetime.utcnow().replace(tzinfo=utc)
+        for outing in in_shard(Outing.objects.filter(status__in=[DRAFT, CONFIRMED]), self.shard):
+            scheduler.update(outing)
+        last_refresh = now
+        logger.debug("%d outings scheduled", len(scheduler))
+
+        while True:
+            start = time.time()
+            now = datetime.utcnow().replace(tzinfo=utc)
+
+            # Outings saved by other processes (website, API)
+            if last_refresh + refresh <= now:
+                logger.debug('Refreshing the schedule')
+                with self.metrics.timer('phase_seconds', phase='scan'):
+                    for outing in in_shard(Outing.objects.filter(updated__gte=last_refresh - overlap), self.shard):
+                        scheduler.update(outing)
+                last_refresh = now
+
+            deadline = scheduler.next_deadline()
+            if deadline is not None and deadline <= now:
+                self.metrics.set('lag_seconds', (now - deadline).total_seconds())
+
+            with transaction.atomic():
+                for pk in scheduler.pop_due(now):
+                    try:
+                        with self.metrics.timer('phase_seconds', phase='scan'):
+                            outing = alert_queryset().get(pk=pk)
+                    except Outing.DoesNotExist:
+                        continue
+                    logger.debug("Inspecting: '%s' (owner: '%s')", outing.name,
+                                 outing.user.get_full_name())
+                    if outing.status == DRAFT and outing.beginning <= now:
+                        with self.metrics.timer('phase_seconds', phase='drafts'):
+                            self.confirm(outing, now)
+                    if outing.status == CONFIRMED and outing.next_notification_at is not None and \
+                       outing.next_notification_at <= now:
+                        # Skip the outings notified by another worker
+                        if self.advance([outing], now):
+                            self.notify(outing, now)
+                    scheduler.update(outing)
+                self.enqueue()
+            self.drain(now)
+
+            # The metrics add up since the start of the daemon
+            self.metrics.incr('duration_seconds', time.time() - start)
+            self.metrics.set('last_run_timestamp', time.time())
+            self.metrics.publish(self.metrics_file)
+
+            # Sleep until the next deadline or refresh
+            wakeup = last_refresh + refresh
+            deadline = scheduler.next_deadline()
+            if deadline is not None and deadline < wakeup:
+                wakeup = deadline
+            delay = (wakeup - datetime.utcnow().replace(tzinfo=utc)).total_seconds()
+            if delay > 0:
+                time.sleep(delay)
+
+    def enqueue(self):
+        with self.metrics.timer('phase_seconds', phase='enqueue'):
+            count = enqueue(self.notifications)
+        self.metrics.incr('notifications', count, status='queued')
+        logger.debug("%d notifications added to the outbox", count)
+        self.notifications = []
+        self.renderer = RenderCache()
+
+    def drain(self, now):
+        if not self.send:
+            return
+        with self.metrics.timer('phase_seconds', phase='send'):
+            (sent, failed) = drain(self.dispatcher, now)
+        self.metrics.incr('notifications', sent + failed, status='attempted')
+        self.metrics.incr('notifications', failed, status='failed')
+
+        # Time spent in the sending threads
+        for (channel, duration) in self.dispatcher.durations.items():
+            self.metrics.incr('phase_seconds', duration,
+                              phase='email' if channel == EMAIL else 'sms')
+        self.dispatcher.durations = {}
+        if failed:
+            logger.error("%d notifications failed (will be retried)", failed)
+        logger.debug("%d notifications sent", sent)
+
+    def confirm_drafts(self, now):
+        # Grab the drafts for logging and confirm them all at once
+        drafts = in_shard(Outing.objects.filter(status=DRAFT, beginning__lt=now), self.shard)
+        confirmed = list(drafts.values_list('pk', 'name', 'user__username'))
+        if not confirmed:
+            return
+
+        # updated is not set by update()
+        count = Outing.objects.filter(pk__in=[pk for (pk, _, _) in confirmed], status=DRAFT) \
+                              .update(status=CONFIRMED, updated=now)
+        self.metrics.incr('confirmed', count)
+        logger.info("Confirm: %d outings", count,
+                    extra={'data': {'outings': [{'id': pk, 'name': name, 'owner': owner}
+                                                for (pk, name, owner) in confirmed]}})
+
+    def confirm(self, outing, now):
+        logger.info("Confirm: '%s' (owner: '%s')", outing.name,
+                    outing.user.get_full_name())
+        count = Outing.objects.filter(pk=outing.pk, status=DRAFT).update(status=CONFIRMED, updated=now)
+        self.metrics.incr('confirmed', count)
+        outing.status = CONFIRMED
+
+    def subject(self, language, timezone):
+        with Localize(language, timezone):
+            return force_text(_('[R.A.S] Alert'))
+
+    def alert_late(self, outing, window, now):
+        with self.metrics.timer('phase_seconds', phase='render'):
+            self._alert_late(outing, window, now)
+
+    def alert_friends(self, outing, window, now):
+        with self.metrics.timer('phase_seconds', phase='render'):
+            self._alert_friends(outing, window, now)
+
+    def _alert_late(self, outing, window, now):
+        logger.debug(' |--> Alerting the owner')
+        logger.debug("     |-> %s", outing.user.get_full_name())
+        logger.debug("     |--> email: %s", outing.user.email)
+        logger.debug("     |--> provider: %s", outing.user.profile.provider)
+        # send a mail to the user, translated into the right language
+        profile = outing.user.profile
+        self.notifications.append(
+            mail_notification(outing, window, outing.user,
+                              self.subject(profile.language, profile.timezone),
+                              self.renderer.render('RandoAmisSecours/alert/late.html',
+                                                   {'URL': "%s%s" % (self.base_url,
+                                                                     reverse('outings.details', args=[outing.pk])),
+                                                    'SAFE_URL': "%s%s" % (self.base_url,
+                                                                          reverse('outings.finish', args=[outing.pk]))},
+                                                   profile.language, profile.timezone),
+                              now))
+        self.notifications.append(
+            sms_notification(outing, window, outing.user,
+                             self.renderer.render('RandoAmisSecours/alert/late.txt',
+                                                  {'name': outing.name},
+                                                  profile.language, profile.timezone),
+                             now))
+
+    def _alert_friends(self, outing, window, now):
+        logger.debug(' |--> Alerting now')
+        friends = outing.user.profile.friends.all()
+        friend_count = len(friends)
+        logger.debug(" |---> %d friends to contact", friend_count)
+
+        # The messages only depend on the language and timezone: render them
+        # once for each group of friends
+        groups = OrderedDict()
+        for friend_profile in friends:
+            groups.setdefault((friend_profile.language, friend_profile.timezone), []).append(friend_profile)
+
+        mail_ctx = {'fullname': outing.user.get_full_name(),
+                    'URL': "%s%s" % (self.base_url, reverse('outings.details', args=[outing.pk])),
+                    'name': outing.name,
+                    'ending': outing.ending}
+        sms_ctx = {'fullname': outing.user.get_full_name(),
+                   'name': outing.name,
+                   'ending': outing.ending,
+                   'now': now}
+        # Send on mail per user translated into the right language
+        for ((language, timezone), profiles) in groups.items():
+            subject = self.subject(language, timezone)
+            mail = self.renderer.render('RandoAmisSecours/alert/alert.html',
+                                        mail_ctx, language, timezone)
+            sms = self.renderer.render('RandoAmisSecours/alert/alert.txt',
+                                       sms_ctx, language, timezone)
+            for friend_profile in profiles:
+                logger.debug("      |-> %s", friend_profile.user.get_full_name())
+                logger.debug("      |--> email: %s", friend_profile.user.email)
+                logger.debug("      \\--> provider: %s", friend_profile.provider)
+                self.notifications.append(
+                    mail_notification(outing, window, friend_profile.user,
+                                      subject, mail, now))
+                self.notifications.append(
+                    sms_notification(outing, window, friend_profile.user,
+                                     sms, now))
+
+        logger.debug(' |--> Alerting the owner')
+        logger.debug("     |-> %s", outing.user.get_full_name())
+        logger.debug("     |--> email: %s", outing.user.email)
+        logger.debug("     |--> provider: %s", outing.user.profile.provider)
+        profile = outing.user.profile
+        self.notifications.append(
+            mail_notification(outing, window, outing.user,
+                              self.subject(profile.language, profile.timezone),
+                              self.renderer.render('RandoAmisSecours/alert/alert_owner.html',
+                                                   {'fullname': outing.user.get_full_name(),
+                                                    'URL': "%s%s" % (self.base_url,
+                                                                     reverse('outings.details', args=[outing.pk])),
+                                                    'name': outing.name,
+                                                    'ending': outing.ending,
+                                                    'friend_count': friend_count},
+                                                   profile.language, profile.timezone),
+                              now))
+        self.notifications.append(
+            sms_notification(outing, window, outing.user,
+                             self.renderer.render('RandoAmisSecours/alert/alert_owner.txt',
+                                                  {'name': outing.name,
+                                                   'ending': outing.ending,
+                                                   'now': now},
+                                                  profile.language, profile.timezone),
+                             now))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+
+# Copyright 2016 Rémi Duraffort
+# This file is part of RandoAmisSecours.
+#
+# RandoAmisSecours is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RandoAmisSecours is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with RandoAmisSecours.  If not, see <http://www.gnu.org/licenses/>
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.timezone import datetime, timedelta, utc
+
+from RandoAmisSecours.models import ArchivedOuting, DeletedOuting, GPSPoint, Outing, TraceSegment, CANCELED, FINISHED
+from RandoAmisSecours.trace import decode
+
+from collections import defaultdict
+import logging
+
+logger = logging.getLogger('ras.archive_outings')
+
+
+def archive(outings):
+    """ Move the outings and their traces to the archive. Should be called
+    in a transaction. """
+    pks = [outing.pk for outing in outings]
+    points = defaultdict(list)
+    for (outing_pk, data) in TraceSegment.objects.filter(outing_id__in=pks).values_list('outing_id', 'data'):
+        points[outing_pk].extend(decode(data))
+    for row in GPSPoint.objects.filter(outing_id__in=pks) \
+                               .values_list('outing_id', 'date', 'latitude', 'longitude', 'precision'):
+        points[row[0]].append(row[1:])
+
+    ArchivedOuting.objects.bulk_create([ArchivedOuting.from_outing(outing, sorted(points[outing.pk]))
+                                        for outing in outings])
+    TraceSegment.objects.filter(outing_id__in=pks).delete()
+    GPSPoint.objects.filter(outing_id__in=pks).delete()
+    # Also delete the notifications
+    Outing.objects.filter(pk__in=pks).delete()
+
+
+class Command(BaseCommand):
+    help = 'Move the old finished and canceled outings to the archive and forget the old deletions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', dest='days', type=int,
+                            default=getattr(settings, 'RAS_ARCHIVE_DAYS', 365),
+                            help='Archive the outings that ended this number of days ago')
+        parser.add_argument('--batch', dest='batch', default=100,
+                            type=int, help='Outings archived in each transaction')
+
+    def handle(self, *args, **kwargs):
+        horizon = datetime.utcnow().replace(tzinfo=utc) - timedelta(days=kwargs['days'])
+        total = 0
+        while True:
+            # Short transactions: the archived outings are locked meanwhile
+            with transaction.atomic():
+                outings = list(Outing.objects.select_for_update()
+                                             .filter(status__in=[FINISHED, CANCELED], ending__lt=horizon)
+                                             .order_by('pk')[:kwargs['batch']])
+                if outings:
+                    archive(outings)
+            total += len(outings)
+            logger.debug("%d outings archived", total)
+            if len(outings) < kwargs['batch']:
+                break
+        logger.info("%d outings archived", total)
+
+        # The clients with older sync tokens get everything again anyway
+        horizon = datetime.utcnow().replace(tzinfo=utc) - timedelta(days=getattr(settings, 'RAS_SYNC_DAYS', 30))
+        DeletedOuting.objects.filter(deleted__lt=horizon).delete()
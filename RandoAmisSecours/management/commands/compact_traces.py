@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+
+# Copyright 2016 Rémi Duraffort
+# This file is part of RandoAmisSecours.
+#
+# RandoAmisSecours is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RandoAmisSecours is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with RandoAmisSecours.  If not, see <http://www.gnu.org/licenses/>
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from RandoAmisSecours.models import GPSPoint, CANCELED, FINISHED
+from RandoAmisSecours.trace import compact
+
+import logging
+
+logger = logging.getLogger('ras.compact_traces')
+
+
+class Command(BaseCommand):
+    help = 'Pack the GPS points of the finished and canceled outings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', dest='batch', default=100,
+                            type=int, help='Outings loaded at once')
+
+    def handle(self, *args, **kwargs):
+        total = 0
+        while True:
+            outings = list(GPSPoint.objects.filter(outing__status__in=[FINISHED, CANCELED])
+                                           .values_list('outing', flat=True)
+                                           .order_by('outing')
+                                           .distinct()[:kwargs['batch']])
+            for outing_pk in outings:
+                count = compact(outing_pk)
+                logger.debug("Outing %d: %d points packed", outing_pk, count)
+                total += count
+            if len(outings) < kwargs['batch']:
+                break
+        logger.info("%d points packed", total)
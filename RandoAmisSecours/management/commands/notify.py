@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+
+# Copyright 2016 Rémi Duraffort
+# This file is part of RandoAmisSecours.
+#
+# RandoAmisSecours is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RandoAmisSecours is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with RandoAmisSecours.  If not, see <http://www.gnu.org/licenses/>
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import datetime, utc
+
+from RandoAmisSecours.dispatch import Dispatcher
+from RandoAmisSecours.outbox import drain
+
+import logging
+import time
+
+logger = logging.getLogger('ras.notify')
+
+
+class Command(BaseCommand):
+    help = 'Send the notifications waiting in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', dest='batch', default=100,
+                            type=int, help='Notifications claimed at once')
+        parser.add_argument('--daemon', dest='daemon', default=False,
+                            action='store_true',
+                            help='Keep running and poll the outbox')
+        parser.add_argument('--sleep', dest='sleep', default=5,
+                            type=int, help='Polling interval in seconds (daemon only)')
+
+    def handle(self, *args, **kwargs):
+        dispatcher = Dispatcher()
+        while True:
+            now = datetime.utcnow().replace(tzinfo=utc)
+            (sent, failed) = drain(dispatcher, now, kwargs['batch'])
+            if sent or failed:
+                logger.info("%d notifications sent, %d failed", sent, failed)
+
+            if not kwargs['daemon']:
+                return
+            time.sleep(kwargs['sleep'])
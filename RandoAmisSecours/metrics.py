@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+
+# Copyright 2016 Rémi Duraffort
+# This file is part of RandoAmisSecours.
+#
+# RandoAmisSecours is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RandoAmisSecours is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with RandoAmisSecours.  If not, see <http://www.gnu.org/licenses/>
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import io
+import logging
+import os
+import time
+
+logger = logging.getLogger('ras.metrics')
+
+
+class Metrics(object):
+    """ Timers and counters of a run, exported in the Prometheus text format
+    or handed over to the RAS_METRICS_HOOK callable """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.values = OrderedDict()
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def get(self, name, **labels):
+        return self.values.get((name, tuple(sorted(labels.items()))), 0)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Add the time spent in the block to the given metric (seconds) """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.incr(name, time.time() - start, **labels)
+
+    def to_prometheus(self):
+        # The samples of a metric are grouped under its TYPE line
+        families = OrderedDict()
+        for ((name, labels), value) in self.values.items():
+            families.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for (name, samples) in families.items():
+            name = "%s_%s" % (self.prefix, name)
+            lines.append("# TYPE %s gauge" % name)
+            for (labels, value) in samples:
+                if labels:
+                    lines.append("%s{%s} %s" % (name, ','.join('%s="%s"' % label for label in labels), value))
+                else:
+                    lines.append("%s %s" % (name, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """ Write the metrics atomically, as expected by the textfile
+        collector of the node exporter """
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        with io.open(tmp_filename, 'w', encoding='utf-8') as f_out:
+            f_out.write(self.to_prometheus())
+        os.rename(tmp_filename, filename)
+
+    def publish(self, filename=None):
+        """ Export the metrics without ever interrupting the caller """
+        if filename:
+            try:
+                self.write(filename)
+            except (IOError, OSError):
+                logger.error("Unable to write the metrics to '%s'", filename,
+                             exc_info=True)
+
+        hook = getattr(settings, 'RAS_METRICS_HOOK', None)
+        if hook:
+            try:
+                import_string(hook)(self)
+            except Exception:
+                logger.error("Unable to call the metrics hook '%s'", hook,
+                             exc_info=True)
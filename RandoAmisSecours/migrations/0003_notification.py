@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2016-04-09 16:40
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('RandoAmisSecours', '0002_outing_updated'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=200, unique=True)),
+                ('channel', models.CharField(max_length=30)),
+                ('subject', models.CharField(blank=True, max_length=200)),
+                ('body', models.TextField()),
+                ('status', models.IntegerField(choices=[(0, 'pending'), (1, 'sending'), (2, 'sent'), (3, 'failed')], default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField()),
+                ('token', models.CharField(blank=True, max_length=32)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sent', models.DateTimeField(blank=True, null=True)),
+                ('outing', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='RandoAmisSecours.Outing')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='notification',
+            index_together=set([('status', 'next_attempt')]),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2016-04-09 15:21
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils.timezone import datetime, timedelta, utc
+
+
+def schedule_outings(apps, schema_editor):
+    # The drafts (0) and confirmed (1) outings are notified from the ending
+    Outing = apps.get_model('RandoAmisSecours', 'Outing')
+    now = datetime.utcnow().replace(tzinfo=utc)
+    Outing.objects.filter(status__in=[0, 1], ending__gt=now).update(next_notification_at=models.F('ending'))
+
+    # The late ones were already notified by the previous alert runs: they
+    # are notified again at their next window (ending + k * period until the
+    # alert, then alert + k * period)
+    period = timedelta(minutes=getattr(settings, 'RAS_ALERT_PERIOD', 60))
+    for outing in Outing.objects.filter(status__in=[0, 1], ending__lte=now).iterator():
+        start = outing.ending if now < outing.alert else outing.alert
+        k = int((now - start).total_seconds() // period.total_seconds()) + 1
+        next_notification_at = start + k * period
+        if now < outing.alert and next_notification_at > outing.alert:
+            next_notification_at = outing.alert
+        Outing.objects.filter(pk=outing.pk).update(next_notification_at=next_notification_at,
+                                                   notification_count=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('RandoAmisSecours', '0003_notification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outing',
+            name='next_notification_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='outing',
+            name='notification_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(schedule_outings, migrations.RunPython.noop),
+    ]
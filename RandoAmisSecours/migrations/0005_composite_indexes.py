@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2016-04-16 09:47
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('RandoAmisSecours', '0004_outing_next_notification_at'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='gpspoint',
+            index_together=set([('outing', 'date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='outing',
+            index_together=set([('status', 'next_notification_at'), ('status', 'ending'), ('status', 'beginning'), ('user', 'status', 'beginning')]),
+        ),
+    ]
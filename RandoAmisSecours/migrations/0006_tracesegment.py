@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2016-04-23 14:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from RandoAmisSecours.trace import SEGMENT_SIZE, decode, encode
+
+
+def pack_points(apps, schema_editor):
+    # The points of the finished (4) and canceled (5) outings are packed
+    GPSPoint = apps.get_model('RandoAmisSecours', 'GPSPoint')
+    TraceSegment = apps.get_model('RandoAmisSecours', 'TraceSegment')
+    outings = GPSPoint.objects.filter(outing__status__in=[4, 5]) \
+                              .values_list('outing_id', flat=True).distinct()
+    for outing_id in list(outings):
+        points = list(GPSPoint.objects.filter(outing_id=outing_id)
+                                      .order_by('date')
+                                      .values_list('date', 'latitude', 'longitude', 'precision'))
+        TraceSegment.objects.bulk_create([
+            TraceSegment(outing_id=outing_id, start=chunk[0][0], end=chunk[-1][0],
+                         count=len(chunk), data=encode(chunk))
+            for chunk in [points[i:i + SEGMENT_SIZE] for i in range(0, len(points), SEGMENT_SIZE)]])
+        GPSPoint.objects.filter(outing_id=outing_id).delete()
+
+
+def unpack_points(apps, schema_editor):
+    GPSPoint = apps.get_model('RandoAmisSecours', 'GPSPoint')
+    TraceSegment = apps.get_model('RandoAmisSecours', 'TraceSegment')
+    for segment in TraceSegment.objects.all():
+        GPSPoint.objects.bulk_create([
+            GPSPoint(outing_id=segment.outing_id, date=date, latitude=latitude,
+                     longitude=longitude, precision=precision)
+            for (date, latitude, longitude, precision) in decode(segment.data)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('RandoAmisSecours', '0005_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TraceSegment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('outing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='RandoAmisSecours.Outing')),
+            ],
+            options={
+                'ordering': ['start'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='tracesegment',
+            index_together=set([('outing', 'start')]),
+        ),
+        migrations.RunPython(pack_points, unpack_points),
+    ]
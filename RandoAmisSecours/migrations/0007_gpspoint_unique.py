@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2016-04-30 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def remove_duplicates(apps, schema_editor):
+    # Keep the first of the points recorded at the same date
+    GPSPoint = apps.get_model('RandoAmisSecours', 'GPSPoint')
+    duplicates = GPSPoint.objects.values('outing_id', 'date') \
+                                 .annotate(count=Count('pk'), first=Min('pk')) \
+                                 .filter(count__gt=1)
+    for duplicate in list(duplicates):
+        GPSPoint.objects.filter(outing_id=duplicate['outing_id'], date=duplicate['date']) \
+                        .exclude(pk=duplicate['first']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('RandoAmisSecours', '0006_tracesegment'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='gpspoint',
+            unique_together=set([('outing', 'date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='gpspoint',
+            index_together=set([]),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2016-05-07 16:31
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+from RandoAmisSecours.geo import encode
+
+
+def set_geohash(apps, schema_editor):
+    Outing = apps.get_model('RandoAmisSecours', 'Outing')
+    for (pk, latitude, longitude) in Outing.objects.values_list('pk', 'latitude', 'longitude').iterator():
+        Outing.objects.filter(pk=pk).update(geohash=encode(latitude, longitude))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('RandoAmisSecours', '0007_gpspoint_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outing',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=12),
+        ),
+        migrations.RunPython(set_geohash, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='outing',
+            index_together=set([('status', 'next_notification_at'), ('status', 'ending'), ('status', 'beginning'), ('user', 'status', 'beginning'), ('status', 'geohash')]),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2016-05-14 11:02
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('RandoAmisSecours', '0008_outing_geohash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedOuting',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=200)),
+                ('description', models.TextField()),
+                ('status', models.IntegerField(choices=[(0, 'draft'), (1, 'confirmed'), (3, 'late'), (4, 'finished'), (5, 'canceled')])),
+                ('beginning', models.DateTimeField()),
+                ('ending', models.DateTimeField()),
+                ('alert', models.DateTimeField()),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('updated', models.DateTimeField()),
+                ('archived', models.DateTimeField(auto_now_add=True)),
+                ('point_count', models.PositiveIntegerField(default=0)),
+                ('trace', models.BinaryField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['beginning', 'ending', 'alert', 'name'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='archivedouting',
+            index_together=set([('user', 'beginning')]),
+        ),
+    ]
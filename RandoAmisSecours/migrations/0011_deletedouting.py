@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2016-05-21 10:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('RandoAmisSecours', '0010_updated'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletedOuting',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('owner', models.IntegerField()),
+                ('deleted', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='deletedouting',
+            index_together=set([('owner', 'deleted')]),
+        ),
+    ]
@@ -19,15 +19,18 @@
 
 from __future__ import unicode_literals
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils.encoding import python_2_unicode_compatible
-from django.utils.timezone import datetime, utc
+from django.utils.timezone import datetime, timedelta, utc
 from django.utils.translation import ugettext_noop as _
 from django.utils.translation import ugettext
 
+from RandoAmisSecours.geo import encode as geohash
 from RandoAmisSecours.settings import LANGUAGES
+from RandoAmisSecours.trace import decode, encode
 import binascii
 import json
 import pytz
@@ -71,6 +74,8 @@ class Profile(models.Model):
     hash_id = models.CharField(unique=True, max_length=30, default=random_hash)
     language = models.CharField(max_length=4, blank=True, null=True, choices=LANGUAGES)
     timezone = models.CharField(max_length=40, choices=[(tz, tz) for tz in pytz.all_timezones], default='UTC')
+    # Last modification of the profile, the user or the friends
+    updated = models.DateTimeField(auto_now=True)
 
     def clean(self):
         if self.provider_data:
@@ -104,6 +109,12 @@ class Outing(models.Model):
     class Meta:
         app_label = 'RandoAmisSecours'
         ordering = ['beginning', 'ending', 'alert', 'name']
+        # Alert scan, reporting and per-user status lists
+        index_together = [('status', 'next_notification_at'),
+                          ('status', 'ending'),
+                          ('status', 'beginning'),
+                          ('user', 'status', 'beginning'),
+                          ('status', 'geohash')]
 
     user = models.ForeignKey(User)
 
@@ -120,17 +131,49 @@ class Outing(models.Model):
     # Position on the map
     latitude = models.FloatField()
     longitude = models.FloatField()
+    # Geohash of the position, for the geographic search (RandoAmisSecours.geo)
+    geohash = models.CharField(max_length=12, blank=True, db_index=True, editable=False)
+
+    # Last modification, used by the alert daemon to refresh its schedule
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+
+    # Next time the owner or friends should be notified (if not finished),
+    # advanced by the alert command every time it notifies them
+    next_notification_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    notification_count = models.PositiveIntegerField(default=0)
+
+    # Last time GPS points were added or packed
+    trace_updated = models.DateTimeField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return "%s: %s" % (self.user.get_full_name(), self.name)
 
-    def getPercents(self):
-        current_time = datetime.utcnow().replace(tzinfo=utc)
+    def save(self, *args, **kwargs):
+        self.geohash = geohash(self.latitude, self.longitude)
+        self.schedule()
+        super(Outing, self).save(*args, **kwargs)
+
+    def schedule(self, now=None):
+        """ Compute the next notification time from the time frame """
+        if self.status not in (DRAFT, CONFIRMED):
+            self.next_notification_at = None
+        elif not self.notification_count:
+            self.next_notification_at = self.ending
+        else:
+            # Already notified: wait for the next window
+            from RandoAmisSecours.scheduler import next_deadline
+            if now is None:
+                now = datetime.utcnow().replace(tzinfo=utc)
+            period = timedelta(minutes=getattr(settings, 'RAS_ALERT_PERIOD', 60))
+            self.next_notification_at = next_deadline(self, now, period)
+
+    def getPercents(self, now=None):
+        current_time = now or datetime.utcnow().replace(tzinfo=utc)
         # now < begin < end < alert
         if current_time < self.beginning:
             return (0, 0, 0)
-        # begin < end < alert < now
-        elif self.alert < current_time:
+        # begin < end < alert <= now
+        elif self.alert <= current_time:
             return (0, 0, 100)
         # begin < now < end < alert
         elif current_time < self.ending:
@@ -142,39 +185,233 @@ class Outing(models.Model):
                     ((current_time - self.ending).total_seconds()) / float((self.alert - self.beginning).total_seconds()) * 100,
                     0)
 
-    def is_running(self):
+    def get_state(self, now):
+        """ Return 'planned', 'running', 'late' or 'alerting' """
+        if now < self.beginning:
+            return 'planned'
+        elif now < self.ending:
+            return 'running'
+        elif now < self.alert:
+            return 'late'
+        return 'alerting'
+
+    def is_running(self, now=None):
         """ Return True if beginning <= now < end """
-        now = datetime.utcnow().replace(tzinfo=utc)
+        now = now or datetime.utcnow().replace(tzinfo=utc)
         return self.beginning <= now and now < self.ending
 
-    def is_late(self):
+    def is_late(self, now=None):
         """ Return True if end <= now < alert """
-        now = datetime.utcnow().replace(tzinfo=utc)
+        now = now or datetime.utcnow().replace(tzinfo=utc)
         return self.ending <= now and now < self.alert
 
-    def is_alerting(self):
+    def is_alerting(self, now=None):
         """ Return True if alert <= now """
-        now = datetime.utcnow().replace(tzinfo=utc)
+        now = now or datetime.utcnow().replace(tzinfo=utc)
         return self.alert <= now
 
+    def get_trace(self):
+        """ Return the GPS points of the outing, packed or not, ordered by
+        date. The packed points are not saved in the database. """
+        points = []
+        for segment in self.tracesegment_set.all():
+            points.extend(segment.get_points())
+        points.extend(self.gpspoint_set.all())
+        points.sort(key=lambda point: point.date)
+        return points
+
+    def get_point_count(self):
+        """ Return the number of GPS points of the outing, packed or not """
+        packed = self.tracesegment_set.aggregate(count=models.Sum('count'))['count'] or 0
+        return packed + self.gpspoint_set.count()
+
     is_running.boolean = True
     is_late.boolean = True
     is_alerting.boolean = True
 
 
+def classify_outings(outings, now):
+    """ Compute the state and the progress percentages of every outing in one
+    pass, relatively to the same 'now'. Return the list of outings. """
+    outings = list(outings)
+    for outing in outings:
+        outing.state = outing.get_state(now)
+        outing.percents = outing.getPercents(now)
+    return outings
+
+
 @python_2_unicode_compatible
 class GPSPoint(models.Model):
     class Meta:
         app_label = 'RandoAmisSecours'
         ordering = ['date']
+        unique_together = [('outing', 'date')]
 
     outing = models.ForeignKey(Outing)
     date = models.DateTimeField()
     latitude = models.FloatField()
     longitude = models.FloatField()
     precision = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
 
     def __str__(self):
         return "[%s] %s: (%f, %f)" % (self.outing.user.get_full_name(),
                                       self.outing.name, self.latitude,
                                       self.longitude)
+
+
+@python_2_unicode_compatible
+class TraceSegment(models.Model):
+    """ GPS points packed by RandoAmisSecours.trace """
+    class Meta:
+        app_label = 'RandoAmisSecours'
+        ordering = ['start']
+        index_together = [('outing', 'start')]
+
+    outing = models.ForeignKey(Outing)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    def __str__(self):
+        return "[%s] %s: %d points" % (self.outing.user.get_full_name(),
+                                       self.outing.name, self.count)
+
+    def get_points(self):
+        return [GPSPoint(outing_id=self.outing_id, date=date, latitude=latitude,
+                         longitude=longitude, precision=precision)
+                for (date, latitude, longitude, precision) in decode(self.data)]
+
+
+@python_2_unicode_compatible
+class ArchivedOuting(models.Model):
+    """ Old finished or canceled outing, moved out of the Outing table with its
+    packed trace by the archive_outings command. The primary key is the one
+    of the original outing. """
+    class Meta:
+        app_label = 'RandoAmisSecours'
+        ordering = ['beginning', 'ending', 'alert', 'name']
+        index_together = [('user', 'beginning')]
+
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(User)
+
+    name = models.CharField(max_length=200)
+    description = models.TextField()
+    status = models.IntegerField(choices=OUTING_STATUS)
+
+    beginning = models.DateTimeField()
+    ending = models.DateTimeField()
+    alert = models.DateTimeField()
+
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+
+    updated = models.DateTimeField()
+    archived = models.DateTimeField(auto_now_add=True)
+
+    # Every GPS point of the outing (RandoAmisSecours.trace)
+    point_count = models.PositiveIntegerField(default=0)
+    trace = models.BinaryField()
+
+    FIELDS = ['user_id', 'name', 'description', 'status', 'beginning', 'ending',
+              'alert', 'latitude', 'longitude', 'updated']
+
+    def __str__(self):
+        return "%s: %s" % (self.user.get_full_name(), self.name)
+
+    @classmethod
+    def from_outing(cls, outing, points):
+        """ Archive of the outing with its (date, latitude, longitude,
+        precision) points """
+        archive = cls(id=outing.pk, point_count=len(points), trace=encode(points))
+        for field in cls.FIELDS:
+            setattr(archive, field, getattr(outing, field))
+        return archive
+
+    def to_outing(self):
+        """ Return an unsaved Outing with the archived information """
+        outing = Outing(pk=self.pk)
+        for field in self.FIELDS:
+            setattr(outing, field, getattr(self, field))
+        outing.archived = self.archived
+        # The trace is not in the GPSPoint and TraceSegment tables anymore
+        outing.get_trace = self.get_trace
+        outing.get_point_count = lambda: self.point_count
+        return outing
+
+    def get_trace(self):
+        return [GPSPoint(outing_id=self.pk, date=date, latitude=latitude,
+                         longitude=longitude, precision=precision)
+                for (date, latitude, longitude, precision) in decode(self.trace)]
+
+
+class DeletedOuting(models.Model):
+    """ Outing deleted (or archived), kept for the sync API for RAS_SYNC_DAYS
+    days. The primary key is the one of the outing and the owner is not a
+    foreign key as the outings are also deleted with their user. """
+    class Meta:
+        app_label = 'RandoAmisSecours'
+        index_together = [('owner', 'deleted')]
+
+    id = models.IntegerField(primary_key=True)
+    owner = models.IntegerField()
+    deleted = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+def get_outing(pk):
+    """ Return the outing, rebuilt from the archive (slower) if it has been
+    archived. Raise Outing.DoesNotExist if neither exists. """
+    try:
+        return Outing.objects.get(pk=pk)
+    except Outing.DoesNotExist:
+        try:
+            return ArchivedOuting.objects.get(pk=pk).to_outing()
+        except ArchivedOuting.DoesNotExist:
+            raise Outing.DoesNotExist
+
+
+# Notification status
+PENDING = 0
+SENDING = 1
+SENT = 2
+FAILED = 3
+NOTIFICATION_STATUS = (
+    (PENDING, _('pending')),
+    (SENDING, _('sending')),
+    (SENT, _('sent')),
+    (FAILED, _('failed'))
+)
+
+# Notification channel, the SMS channels are named after the provider
+EMAIL = 'email'
+
+
+@python_2_unicode_compatible
+class Notification(models.Model):
+    class Meta:
+        app_label = 'RandoAmisSecours'
+        index_together = [('status', 'next_attempt')]
+
+    # Unique for each (outing, recipient, alert window, channel)
+    key = models.CharField(max_length=200, unique=True)
+    outing = models.ForeignKey(Outing, blank=True, null=True)
+    user = models.ForeignKey(User, related_name='+')
+    channel = models.CharField(max_length=30)
+
+    # Rendered message
+    subject = models.CharField(max_length=200, blank=True)
+    body = models.TextField()
+
+    status = models.IntegerField(choices=NOTIFICATION_STATUS, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    # Next try for pending notifications, end of the lease when sending
+    next_attempt = models.DateTimeField()
+    # Set by the worker that claimed the notification
+    token = models.CharField(max_length=32, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return "%s => %s (%s)" % (self.key, self.user.get_full_name(), self.channel)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+
+# Copyright 2016 Rémi Duraffort
+# This file is part of RandoAmisSecours.
+#
+# RandoAmisSecours is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RandoAmisSecours is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with RandoAmisSecours.  If not, see <http://www.gnu.org/licenses/>
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.utils.encoding import force_text
+from django.utils.timezone import timedelta
+
+from RandoAmisSecours.models import Notification, EMAIL, FAILED, PENDING, SENDING, SENT
+from RandoAmisSecours.utils import get_provider
+
+import binascii
+import logging
+import os
+
+logger = logging.getLogger('ras.outbox')
+
+
+def make_key(outing, window, user, channel):
+    """ Idempotency key of a notification """
+    return "%d:%s:%d:%s" % (outing.pk, window.strftime('%Y%m%d%H%M%S'), user.pk, channel)
+
+
+def mail_notification(outing, window, user, subject, body, now):
+    return Notification(key=make_key(outing, window, user, EMAIL),
+                        outing=outing, user=user, channel=EMAIL,
+                        subject=force_text(subject), body=body,
+                        next_attempt=now)
+
+
+def sms_notification(outing, window, user, body, now):
+    """ Return None if the user does not have any provider """
+    if not user.profile.provider or not user.profile.provider_data:
+        return None
+
+    return Notification(key=make_key(outing, window, user, user.profile.provider),
+                        outing=outing, user=user, channel=user.profile.provider,
+                        body=body, next_attempt=now)
+
+
+def enqueue(notifications):
+    """ Save the notifications that are not already in the outbox. Should be
+    called in the transaction that decided to send them. """
+    notifications = [n for n in notifications if n is not None]
+    if not notifications:
+        return 0
+
+    keys = set(Notification.objects.filter(key__in=[n.key for n in notifications])
+                                   .values_list('key', flat=True))
+    new = []
+    for notification in notifications:
+        if notification.key not in keys:
+            keys.add(notification.key)
+            new.append(notification)
+    Notification.objects.bulk_create(new)
+    return len(new)
+
+
+def claim(now, batch):
+    """ Claim up to 'batch' pending notifications for this worker """
+    lease = getattr(settings, 'RAS_OUTBOX_LEASE', 300)
+
+    # Notifications of dead workers are sent again
+    Notification.objects.filter(status=SENDING, next_attempt__lt=now) \
+                        .update(status=PENDING)
+
+    pks = list(Notification.objects.filter(status=PENDING, next_attempt__lte=now)
+                                   .order_by('next_attempt')
+                                   .values_list('pk', flat=True)[:batch])
+    if not pks:
+        return []
+
+    token = binascii.b2a_hex(os.urandom(16)).decode('ascii')
+    Notification.objects.filter(pk__in=pks, status=PENDING) \
+                        .update(status=SENDING, token=token,
+                                next_attempt=now + timedelta(seconds=lease))
+    return list(Notification.objects.filter(status=SENDING, token=token)
+                                    .select_related('user__profile'))
+
+
+def submit(notification, dispatcher):
+    """ Hand the notification over to the dispatcher and return the job """
+    user = notification.user
+    if notification.channel == EMAIL:
+        return dispatcher.submit(EMAIL, user.get_full_name(), dispatcher.send_mail,
+                                 notification.subject, notification.body,
+                                 settings.DEFAULT_FROM_EMAIL, [user.email])
+
+    # The provider might have changed since the notification was created
+    if notification.channel != user.profile.provider or not user.profile.provider_data:
+        raise ValueError("The provider of '%s' changed" % user.get_full_name())
+    provider = get_provider(user.profile)
+    return dispatcher.submit(notification.channel, user.get_full_name(),
+                             provider.send_message, notification.body)
+
+
+def drain(dispatcher, now, batch=100):
+    """ Send the pending notifications, retrying the failures with an
+    exponential backoff. Return the number of (sent, failed) notifications. """
+    max_attempts = getattr(settings, 'RAS_OUTBOX_MAX_ATTEMPTS', 8)
+    backoff = getattr(settings, 'RAS_OUTBOX_BACKOFF', 30)
+
+    sent_count = failed_count = 0
+    while True:
+        notifications = claim(now, batch)
+        if not notifications:
+            break
+
+        jobs = {}
+        failed = []
+        timeouts = set()
+        cancelled = set()
+        for notification in notifications:
+            try:
+                jobs[submit(notification, dispatcher)] = notification
+            except Exception:
+                logger.error("Unable to send notification '%s'", notification.key,
+                             exc_info=True)
+                failed.append(notification)
+        for (job, error) in dispatcher.join():
+            if error == 'cancelled':
+                cancelled.add(jobs[job].pk)
+                continue
+            failed.append(jobs[job])
+            if error == 'timeout':
+                timeouts.add(jobs[job].pk)
+
+        # Never attempted: claimed again at once, by new threads
+        Notification.objects.filter(pk__in=cancelled).update(status=PENDING, next_attempt=now)
+
+        # Retry the failures later
+        failed_pks = set()
+        for notification in failed:
+            failed_pks.add(notification.pk)
+            attempts = notification.attempts + 1
+            if attempts >= max_attempts:
+                logger.error("Giving up on notification '%s'", notification.key)
+                Notification.objects.filter(pk=notification.pk) \
+                                    .update(status=FAILED, attempts=attempts)
+            elif notification.pk in timeouts:
+                # The message might still be sent by the abandoned thread:
+                # only retried once the lease of the claim expires
+                Notification.objects.filter(pk=notification.pk) \
+                                    .update(attempts=attempts)
+            else:
+                delay = timedelta(seconds=backoff * 2 ** notification.attempts)
+                Notification.objects.filter(pk=notification.pk) \
+                                    .update(status=PENDING, attempts=attempts,
+                                            next_attempt=now + delay)
+
+        sent = [n.pk for n in notifications if n.pk not in failed_pks and n.pk not in cancelled]
+        Notification.objects.filter(pk__in=sent).update(status=SENT, sent=now)
+        sent_count += len(sent)
+        failed_count += len(failed_pks)
+
+        if len(notifications) < batch and not cancelled:
+            break
+
+    return (sent_count, failed_count)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+
+# Copyright 2016 Rémi Duraffort
+# This file is part of RandoAmisSecours.
+#
+# RandoAmisSecours is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RandoAmisSecours is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with RandoAmisSecours.  If not, see <http://www.gnu.org/licenses/>
+
+from __future__ import unicode_literals
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+import base64
+import binascii
+import datetime
+import json
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+
+class KeysetPaginator(Paginator):
+    """ Paginate on (key, pk) rather than with an offset: every page is an
+    index range starting after the last object of the previous page, given
+    by the opaque 'cursor' of the 'next' link.
+
+    The total count is only computed for the first page (forced with
+    count=1 or skipped with count=0). The offset pagination is still used
+    when an 'offset' or an 'order_by' is given.
+
+    The objects might also provide after(position, limit), returning the
+    objects following the position (or the first ones), already ordered. """
+    key = None
+
+    def get_value(self, obj, name):
+        # The objects might be rows of values()
+        return obj[name] if isinstance(obj, dict) else getattr(obj, name)
+
+    def get_pk(self, obj):
+        return self.get_value(obj, 'pk')
+
+    def get_position(self, obj):
+        return (self.get_value(obj, self.key), self.get_pk(obj))
+
+    def wants_count(self, default):
+        value = self.request_data.get('count')
+        if value is None:
+            return default
+        return value.lower() not in ('0', 'false')
+
+    def encode_cursor(self, obj):
+        (value, pk) = self.get_position(obj)
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        data = json.dumps([value, pk]).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        try:
+            (value, pk) = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+            field = self.objects.model._meta.get_field(self.key)
+            if field.get_internal_type() == 'DateTimeField':
+                value = parse_datetime(value)
+                if value is None:
+                    raise ValueError
+            return (value, int(pk))
+        except (binascii.Error, TypeError, UnicodeError, ValueError):
+            raise BadRequest("Invalid cursor '%s' provided." % cursor)
+
+    def generate_uri(self, limit, cursor):
+        if self.resource_uri is None:
+            return None
+        params = self.request_data.copy()
+        params['limit'] = limit
+        params['cursor'] = cursor
+        if 'count' in params:
+            del params['count']
+        encoded = params.urlencode() if hasattr(params, 'urlencode') else urlencode(params)
+        return "%s?%s" % (self.resource_uri, encoded)
+
+    def get_page(self, objects, limit):
+        """ Return the objects of the page and whether more objects follow,
+        without counting them """
+        if not limit:
+            return (list(objects), False)
+        objects = list(objects[:limit + 1])
+        return (objects[:limit], len(objects) > limit)
+
+    def page(self):
+        if 'offset' in self.request_data or 'order_by' in self.request_data:
+            if self.wants_count(True):
+                return super(KeysetPaginator, self).page()
+
+            limit = self.get_limit()
+            offset = self.get_offset()
+            objects = self.objects[offset:offset + limit + 1] if limit else self.objects[offset:]
+            (objects, more) = self.get_page(objects, limit)
+            meta = {'offset': offset, 'limit': limit}
+            if limit:
+                meta['previous'] = self.get_previous(limit, offset)
+                meta['next'] = self._generate_uri(limit, offset + limit) if more else None
+            return {self.collection_name: objects, 'meta': meta}
+
+        limit = self.get_limit()
+        cursor = self.request_data.get('cursor')
+        if hasattr(self.objects, 'after'):
+            position = self.decode_cursor(cursor) if cursor else None
+            objects = self.objects.after(position, limit + 1 if limit else None)
+        else:
+            objects = self.objects.order_by(self.key, 'pk')
+            if cursor:
+                (value, pk) = self.decode_cursor(cursor)
+                objects = objects.filter(Q(**{"%s__gt" % self.key: value}) |
+                                         Q(**{self.key: value, 'pk__gt': pk}))
+
+        (page, more) = self.get_page(objects, limit)
+        meta = {'limit': limit,
+                'next': self.generate_uri(limit, self.encode_cursor(page[-1])) if more else None}
+        if self.wants_count(not cursor):
+            meta['total_count'] = self.get_count()
+        return {self.collection_name: page, 'meta': meta}
@@ -23,8 +23,13 @@ from django.contrib.auth.signals import user_logged_in
 from django.contrib.auth.models import User
 from django.db import models
 from django.dispatch import receiver
+from django.utils.timezone import datetime, utc
 
-from tastypie.models import create_api_key
+from tastypie.models import ApiKey, create_api_key
+
+from RandoAmisSecours.models import DeletedOuting, GPSPoint, Outing, Profile
+from RandoAmisSecours.trace import invalidate_trace
+from RandoAmisSecours.utils import invalidate_authentication, invalidate_friend_ids, provider_cache
 
 
 @receiver(user_logged_in, dispatch_uid='set_profile_info')
@@ -39,4 +44,62 @@ def set_profile_info(sender, **kwargs):
         kwargs['request'].session['django_timezone'] = tz
 
 
+@receiver(models.signals.post_save, sender=Profile, dispatch_uid='invalidate_provider')
+@receiver(models.signals.post_delete, sender=Profile, dispatch_uid='invalidate_provider_delete')
+def invalidate_provider(sender, instance, **kwargs):
+    """ Drop the cached SMS provider of the profile """
+    provider_cache.invalidate(instance.pk)
+
+
+@receiver(models.signals.m2m_changed, sender=Profile.friends.through, dispatch_uid='invalidate_friends')
+def invalidate_friends(sender, instance, action, pk_set, **kwargs):
+    """ Drop the cached friends of both sides of the changed friendships """
+    if action in ('post_add', 'post_remove'):
+        user_pks = set(Profile.objects.filter(pk__in=pk_set).values_list('user_id', flat=True))
+    elif action == 'pre_clear':
+        # The friends are not known after the clear
+        instance._cleared_friends = set(instance.friends.values_list('user_id', flat=True))
+        return
+    elif action == 'post_clear':
+        user_pks = getattr(instance, '_cleared_friends', set())
+    else:
+        return
+    user_pks.add(instance.user_id)
+    invalidate_friend_ids(user_pks)
+    # Change the version of the profiles in the API
+    Profile.objects.filter(user_id__in=user_pks).update(updated=datetime.utcnow().replace(tzinfo=utc))
+
+
+@receiver(models.signals.post_save, sender=User, dispatch_uid='touch_profile')
+def touch_profile(sender, instance, **kwargs):
+    """ The users are versioned by their profiles in the API """
+    Profile.objects.filter(user=instance).update(updated=datetime.utcnow().replace(tzinfo=utc))
+
+
+@receiver(models.signals.post_save, sender=GPSPoint, dispatch_uid='invalidate_trace')
+def invalidate_simplified_trace(sender, instance, **kwargs):
+    """ Drop the simplified traces of the outing and change the version of
+    its trace. A receiver on post_delete would prevent the fast deletion of
+    the points when compacting. """
+    invalidate_trace(instance.outing_id)
+    Outing.objects.filter(pk=instance.outing_id).update(trace_updated=datetime.utcnow().replace(tzinfo=utc))
+
+
+@receiver(models.signals.post_delete, sender=Outing, dispatch_uid='record_deleted_outing')
+def record_deleted_outing(sender, instance, **kwargs):
+    """ Tell the sync API that the outing is gone """
+    DeletedOuting.objects.create(id=instance.pk, owner=instance.user_id)
+
+
+@receiver(models.signals.post_save, sender=User, dispatch_uid='invalidate_user_authentication')
+@receiver(models.signals.post_delete, sender=User, dispatch_uid='invalidate_user_authentication_delete')
+@receiver(models.signals.post_save, sender=ApiKey, dispatch_uid='invalidate_key_authentication')
+@receiver(models.signals.post_delete, sender=ApiKey, dispatch_uid='invalidate_key_authentication_delete')
+@receiver(models.signals.post_save, sender=Profile, dispatch_uid='invalidate_profile_authentication')
+@receiver(models.signals.post_delete, sender=Profile, dispatch_uid='invalidate_profile_authentication_delete')
+def invalidate_cached_authentication(sender, instance, **kwargs):
+    """ Drop the users cached by the API authentication """
+    invalidate_authentication(instance.pk if sender is User else instance.user_id)
+
+
 models.signals.post_save.connect(create_api_key, sender=User, dispatch_uid='create_api_key')
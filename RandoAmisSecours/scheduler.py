@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+
+# Copyright 2016 Rémi Duraffort
+# This file is part of RandoAmisSecours.
+#
+# RandoAmisSecours is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RandoAmisSecours is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with RandoAmisSecours.  If not, see <http://www.gnu.org/licenses/>
+
+from __future__ import unicode_literals
+
+from RandoAmisSecours.models import CONFIRMED, DRAFT
+
+import heapq
+
+
+def next_deadline(outing, after, period):
+    """ Return the first notification time of the outing strictly after
+    'after' or None if the outing does not need any notification.
+    The notification times are:
+     * beginning (for drafts only)
+     * ending + k * period while before alert
+     * alert + k * period """
+    if outing.status == DRAFT and after < outing.beginning:
+        return outing.beginning
+    if outing.status not in (DRAFT, CONFIRMED):
+        return None
+
+    if after < outing.ending:
+        return outing.ending
+
+    period_seconds = period.total_seconds()
+    if after < outing.alert:
+        k = int((after - outing.ending).total_seconds() // period_seconds) + 1
+        deadline = outing.ending + k * period
+        if deadline < outing.alert:
+            return deadline
+        return outing.alert
+
+    k = int((after - outing.alert).total_seconds() // period_seconds) + 1
+    return outing.alert + k * period
+
+
+def current_window(outing, now, period):
+    """ Return the last notification time of the outing, not after 'now',
+    or None if the outing is not late yet """
+    if now < outing.ending:
+        return None
+
+    period_seconds = period.total_seconds()
+    if now < outing.alert:
+        k = int((now - outing.ending).total_seconds() // period_seconds)
+        return outing.ending + k * period
+
+    k = int((now - outing.alert).total_seconds() // period_seconds)
+    return outing.alert + k * period
+
+
+class AlertScheduler(object):
+    """ Priority queue of outings ordered by their next deadline: the
+    beginning of the drafts or the persisted next notification time
+
+    Updating or discarding an outing does not touch the heap: the stale
+    entries are dropped when they reach the top of the heap. """
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def update(self, outing):
+        if outing.status == DRAFT:
+            deadline = outing.beginning
+        elif outing.status in (DRAFT, CONFIRMED):
+            deadline = outing.next_notification_at
+        else:
+            deadline = None
+
+        if deadline is None:
+            self.deadlines.pop(outing.pk, None)
+        elif self.deadlines.get(outing.pk) != deadline:
+            self.deadlines[outing.pk] = deadline
+            heapq.heappush(self.heap, (deadline, outing.pk))
+
+    def discard(self, pk):
+        self.deadlines.pop(pk, None)
+
+    def _drop_stale(self):
+        while self.heap:
+            deadline, pk = self.heap[0]
+            if self.deadlines.get(pk) == deadline:
+                return
+            heapq.heappop(self.heap)
+
+    def next_deadline(self):
+        """ Return the earliest deadline or None if the queue is empty """
+        self._drop_stale()
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """ Remove and return the primary keys of the outings due at 'now' """
+        due = []
+        self._drop_stale()
+        while self.heap and self.heap[0][0] <= now:
+            deadline, pk = heapq.heappop(self.heap)
+            del self.deadlines[pk]
+            due.append(pk)
+            self._drop_stale()
+        return due
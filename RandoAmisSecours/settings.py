@@ -38,3 +38,66 @@ LOGIN_REDIRECT_URL = 'accounts.profile'
 MESSAGE_TAGS = {
     message_constants.ERROR: 'danger'
 }
+
+# Notifications sent in parallel by the alert command for each channel: 'email'
+# or the SMS provider name. Unlisted channels use the default limit.
+RAS_DISPATCH_LIMITS = {
+    'email': 4,
+}
+RAS_DISPATCH_DEFAULT_LIMIT = 2
+# Maximum time to send each notification, from the start of its thread (in
+# seconds)
+RAS_DISPATCH_TIMEOUT = 30
+
+# Outbox: a failed notification is retried after RAS_OUTBOX_BACKOFF * 2^n
+# seconds (n being the number of failures) until RAS_OUTBOX_MAX_ATTEMPTS.
+# A worker has RAS_OUTBOX_LEASE seconds to send the notifications it claimed.
+RAS_OUTBOX_BACKOFF = 30
+RAS_OUTBOX_MAX_ATTEMPTS = 8
+RAS_OUTBOX_LEASE = 300
+
+# Number of SMS providers kept in cache by each process
+RAS_PROVIDER_CACHE_SIZE = 256
+
+# Dotted path to a callable receiving the metrics of every alert run
+# (RandoAmisSecours.metrics.Metrics)
+RAS_METRICS_HOOK = None
+
+# Time between two notifications of a late or alerting outing (in minutes)
+RAS_ALERT_PERIOD = 60
+
+# The alert daemon reloads the outings changed since its previous refresh
+# minus this number of seconds, for the transactions committed late
+RAS_ALERT_REFRESH_OVERLAP = 10
+
+# Time the friends of a user are kept in cache (in seconds), the cache being
+# invalidated when the friends change. Only the processes sharing the cache
+# see the invalidation: keep it short with a per-process cache.
+RAS_FRIENDS_CACHE_TIMEOUT = 60
+
+# Maximum number of GPS points uploaded in one request
+RAS_GPS_BULK_MAX = 1000
+
+# Time the simplified GPS traces are kept in cache (in seconds), the cache
+# being invalidated when points are added
+RAS_TRACE_CACHE_TIMEOUT = 86400
+
+# Finished and canceled outings are archived this number of days after their
+# ending by the archive_outings command
+RAS_ARCHIVE_DAYS = 365
+
+# The sync API sends the deletions of the last RAS_SYNC_DAYS days (older
+# tokens get everything again) and at most RAS_SYNC_POINTS GPS points per
+# request. The changes of the last RAS_SYNC_OVERLAP seconds before the token
+# are sent again, in case they were committed late.
+RAS_SYNC_DAYS = 30
+RAS_SYNC_POINTS = 1000
+RAS_SYNC_OVERLAP = 10
+
+# Time the users authenticated by their API key are kept in cache (in
+# seconds), the cache being invalidated when the user, the key or the profile
+# change
+RAS_AUTH_CACHE_TIMEOUT = 60
+
+# Maximum radius of the geographic searches (in km)
+RAS_NEAR_MAX_DISTANCE = 100
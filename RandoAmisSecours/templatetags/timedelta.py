@@ -27,11 +27,11 @@ register = template.Library()
 
 
 @register.filter
-def timedelta(value):
+def timedelta(value, now=None):
     if not value:
         return ''
 
-    now = datetime.utcnow().replace(tzinfo=utc)
+    now = now or datetime.utcnow().replace(tzinfo=utc)
     if value > now:
         return _("in %s") % timesince(now, value)
     else:
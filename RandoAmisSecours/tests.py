@@ -20,16 +20,37 @@
 from __future__ import unicode_literals
 
 from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends.locmem import EmailBackend
 from django.core.exceptions import ValidationError
+from django.core.management import call_command, CommandError
 from django.core.urlresolvers import reverse
-from django.test import TestCase
-from django.test.client import Client
-from django.utils.timezone import datetime, utc
+from django.test import TestCase, override_settings
+from django.test.client import Client, RequestFactory
+from django.utils import six
+from django.utils.timezone import datetime, timedelta, utc
 
 from tastypie.test import ResourceTestCase
 
-from RandoAmisSecours.models import FriendRequest, Outing, Profile
-from RandoAmisSecours.models import CONFIRMED, DRAFT, FINISHED
+import importlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from RandoAmisSecours.api import CachedApiKeyAuthentication
+from RandoAmisSecours.dispatch import Dispatcher
+from RandoAmisSecours.models import ArchivedOuting, FriendRequest, Outing, Profile, classify_outings, get_outing
+from RandoAmisSecours.models import GPSPoint, Notification, TraceSegment
+from RandoAmisSecours.models import CANCELED, CONFIRMED, DRAFT, FINISHED, FAILED, PENDING, SENDING, SENT
+from RandoAmisSecours.outbox import drain
+from RandoAmisSecours.scheduler import AlertScheduler, next_deadline
+from RandoAmisSecours import geo, trace
+from RandoAmisSecours.utils import ProviderCache, RenderCache, get_friend_ids, get_provider, provider_cache, send_localized_mail
 
 
 class TemplatesTest(TestCase):
@@ -397,9 +418,27 @@ class FriendsTest(TestCase):
         response = self.client.get(reverse('friends.delete', args=[self.user3.pk]))
         self.assertRedirects(response, reverse('accounts.profile'))
 
+    def test_friend_ids(self):
+        cache.clear()
+        self.assertEqual(get_friend_ids(self.user1), set())
+        with self.assertNumQueries(0):
+            self.assertEqual(get_friend_ids(self.user1), set())
+
+        # Both sides are invalidated
+        self.user1.profile.friends.add(self.user2.profile, self.user3.profile)
+        self.assertEqual(get_friend_ids(self.user1), set([self.user2.pk, self.user3.pk]))
+        self.assertEqual(get_friend_ids(self.user2), set([self.user1.pk]))
+        self.user3.profile.friends.remove(self.user1.profile)
+        self.assertEqual(get_friend_ids(self.user1), set([self.user2.pk]))
+        self.assertEqual(get_friend_ids(self.user3), set())
+        self.user1.profile.friends.clear()
+        self.assertEqual(get_friend_ids(self.user1), set())
+        self.assertEqual(get_friend_ids(self.user2), set())
+
 
 class OutingsTest(TestCase):
     def setUp(self):
+        cache.clear()
         self.client = Client()
         self.user1 = User.objects.create_user('alpha',
                                               'alpha@example.com',
@@ -467,6 +506,22 @@ class OutingsTest(TestCase):
         self.assertEqual(len(ctx['friends_outings_finished']), 1)
         self.assertEqual(ctx['friends_outings_finished'][0], self.outing4)
 
+    def test_classify(self):
+        now = datetime(2013, 4, 10, 22, 0).replace(tzinfo=utc)
+        outing = Outing(beginning=now - timedelta(hours=2), ending=now + timedelta(hours=2),
+                        alert=now + timedelta(hours=6))
+        outings = classify_outings([outing], now)
+        self.assertEqual(outings[0].state, 'running')
+        self.assertEqual(outings[0].percents, (25, 0, 0))
+
+        # The same 'now' is used for every outing
+        outing.ending = now - timedelta(hours=1)
+        classify_outings(outings, now)
+        self.assertEqual(outing.state, 'late')
+        self.assertEqual(outing.percents, (12.5, 12.5, 0))
+        self.assertEqual(classify_outings([outing], now + timedelta(hours=6))[0].state, 'alerting')
+        self.assertEqual(classify_outings([outing], now - timedelta(hours=3))[0].state, 'planned')
+
     def test_details(self):
         response = self.client.get(reverse('outings.details', args=[self.outing1.pk]))
         self.assertEqual(response.status_code, 200)
@@ -841,3 +896,1207 @@ class AccountTest(TestCase):
             self.assertFalse("The clean method should fail here")
         self.user1.profile.timezone = 'Euope/Berlin'
         self.user1.profile.clean()
+
+
+class SchedulerTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alpha', 'alpha@example.com', 'azerty')
+        self.user.profile = Profile.objects.create(user=self.user, timezone='Europe/Paris', language='fr')
+        self.beginning = datetime(2016, 4, 2, 8, 0).replace(tzinfo=utc)
+        self.outing = Outing.objects.create(user=self.user, beginning=self.beginning,
+                                            ending=self.beginning + timedelta(hours=4),
+                                            alert=self.beginning + timedelta(hours=6),
+                                            latitude=1, longitude=1, status=DRAFT)
+        self.period = timedelta(minutes=60)
+
+    def test_next_deadline(self):
+        outing = self.outing
+        # Drafts are confirmed at the beginning
+        self.assertEqual(next_deadline(outing, self.beginning - timedelta(minutes=1), self.period), outing.beginning)
+        self.assertEqual(next_deadline(outing, self.beginning, self.period), outing.ending)
+
+        outing.status = CONFIRMED
+        self.assertEqual(next_deadline(outing, self.beginning - timedelta(minutes=1), self.period), outing.ending)
+        # Late: every period until the alert
+        self.assertEqual(next_deadline(outing, outing.ending, self.period), outing.ending + self.period)
+        self.assertEqual(next_deadline(outing, outing.ending + timedelta(minutes=90), self.period), outing.alert)
+        # Alerting: every period
+        self.assertEqual(next_deadline(outing, outing.alert, self.period), outing.alert + self.period)
+        self.assertEqual(next_deadline(outing, outing.alert + timedelta(days=2, minutes=5), self.period),
+                         outing.alert + timedelta(days=2, hours=1))
+
+        outing.status = FINISHED
+        self.assertEqual(next_deadline(outing, self.beginning, self.period), None)
+
+    def test_migration(self):
+        from django.apps import apps
+        schedule_outings = importlib.import_module('RandoAmisSecours.migrations.0004_outing_next_notification_at').schedule_outings
+
+        now = datetime.utcnow().replace(tzinfo=utc)
+        outings = []
+        for (ending, alert) in [(timedelta(hours=1), timedelta(hours=2)),
+                                (timedelta(minutes=-90), timedelta(hours=3)),
+                                (timedelta(days=-2, hours=-3), timedelta(days=-2, minutes=-5))]:
+            outings.append(Outing.objects.create(user=self.user, beginning=now + ending - timedelta(hours=2),
+                                                 ending=now + ending, alert=now + alert,
+                                                 latitude=1, longitude=1, status=CONFIRMED))
+        Outing.objects.update(next_notification_at=None, notification_count=0)
+        schedule_outings(apps, None)
+
+        # The late outings are not notified again before their next window
+        for outing in outings:
+            scheduled = Outing.objects.get(pk=outing.pk)
+            self.assertEqual(scheduled.next_notification_at, next_deadline(outing, now, self.period))
+            self.assertEqual(scheduled.notification_count, 0 if outing.ending > now else 1)
+        self.assertEqual(Outing.objects.get(pk=self.outing.pk).next_notification_at,
+                         next_deadline(self.outing, now, self.period))
+
+    def test_scheduler(self):
+        outing2 = Outing.objects.create(user=self.user, beginning=self.beginning - timedelta(hours=1),
+                                        ending=self.beginning + timedelta(hours=1),
+                                        alert=self.beginning + timedelta(hours=2),
+                                        latitude=1, longitude=1, status=CONFIRMED)
+        scheduler = AlertScheduler()
+        scheduler.update(self.outing)
+        scheduler.update(outing2)
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(scheduler.next_deadline(), self.outing.beginning)
+        self.assertEqual(scheduler.pop_due(self.beginning - timedelta(minutes=30)), [])
+        self.assertEqual(scheduler.pop_due(self.beginning), [self.outing.pk])
+        # Confirmed outings are due at their next notification time
+        self.assertEqual(scheduler.next_deadline(), outing2.ending)
+
+        # Updating an outing replaces its deadline
+        outing2.ending = self.beginning + timedelta(minutes=30)
+        outing2.save()
+        scheduler.update(outing2)
+        self.assertEqual(scheduler.next_deadline(), outing2.ending)
+        self.assertEqual(scheduler.pop_due(outing2.ending), [outing2.pk])
+
+        # Finished and discarded outings are dropped
+        scheduler.update(self.outing)
+        scheduler.discard(self.outing.pk)
+        outing2.status = FINISHED
+        scheduler.update(outing2)
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(scheduler.next_deadline(), None)
+
+
+class AlertTest(TestCase):
+    def setUp(self):
+        self.now = datetime.utcnow().replace(tzinfo=utc)
+        self.users = []
+        for i in range(4):
+            user = User.objects.create_user("user%d" % i, "user%d@example.com" % i, 'azerty')
+            user.profile = Profile.objects.create(user=user, timezone='Europe/Paris', language='fr')
+            self.users.append(user)
+        # Everybody is friend with user0
+        for user in self.users[1:]:
+            self.users[0].profile.friends.add(user.profile)
+
+    def create_outing(self, user, ending, alert, status=CONFIRMED, notified=False):
+        outing = Outing.objects.create(user=user, beginning=ending - timedelta(hours=2),
+                                       ending=ending, alert=alert,
+                                       latitude=1, longitude=1, status=status)
+        if notified:
+            # Already notified in the current window
+            outing.notification_count = 1
+            outing.save()
+        return outing
+
+    def test_alert(self):
+        # Late: alert the owner
+        self.create_outing(self.users[1], self.now - timedelta(minutes=1), self.now + timedelta(hours=1))
+        # Alerting: alert the owner and friends
+        self.create_outing(self.users[0], self.now - timedelta(hours=1), self.now - timedelta(minutes=2))
+        # Already notified or not late yet
+        self.create_outing(self.users[2], self.now - timedelta(minutes=30), self.now + timedelta(hours=1), notified=True)
+        self.create_outing(self.users[3], self.now + timedelta(minutes=30), self.now + timedelta(hours=1))
+
+        call_command('alert', base_url='http://example.com')
+        self.assertEqual(sorted([m.to[0] for m in mail.outbox]),
+                         ['user0@example.com', 'user1@example.com', 'user1@example.com',
+                          'user2@example.com', 'user3@example.com'])
+
+    def test_alert_queries(self):
+        for user in self.users:
+            self.create_outing(user, self.now - timedelta(hours=1), self.now - timedelta(minutes=2))
+            self.create_outing(user, self.now - timedelta(minutes=1), self.now + timedelta(hours=1))
+            self.create_outing(user, self.now + timedelta(hours=1), self.now + timedelta(hours=2), status=DRAFT)
+
+        # The number of queries does not depend on the number of outings:
+        # drafts (2), lock, outings and friends (3), schedule, outbox (2 +
+        # savepoint) and sending (5)
+        with self.assertNumQueries(15):
+            call_command('alert', base_url='http://example.com')
+        self.assertEqual(Outing.objects.filter(status=DRAFT).count(), 0)
+        # Friends and owners of the alerting outings, owners of the late ones
+        self.assertEqual(len(mail.outbox), (3 + 1) + 3 * (1 + 1) + 4)
+
+    def test_shard(self):
+        outings = [self.create_outing(user, self.now - timedelta(minutes=1), self.now + timedelta(hours=1))
+                   for user in self.users]
+        call_command('alert', base_url='http://example.com', shard='1/2')
+        self.assertEqual(sorted([m.to[0] for m in mail.outbox]),
+                         sorted([o.user.email for o in outings if o.pk % 2 == 0]))
+
+        # Overlapping shards do not send the notifications twice
+        call_command('alert', base_url='http://example.com', shard='1/1')
+        self.assertEqual(sorted([m.to[0] for m in mail.outbox]),
+                         ['user0@example.com', 'user1@example.com',
+                          'user2@example.com', 'user3@example.com'])
+
+        self.assertRaises(CommandError, call_command, 'alert', base_url='http://example.com', shard='3/2')
+        self.assertRaises(CommandError, call_command, 'alert', base_url='http://example.com', shard='1')
+
+    def test_metrics(self):
+        self.create_outing(self.users[1], self.now - timedelta(minutes=1), self.now + timedelta(hours=1))
+        self.create_outing(self.users[0], self.now - timedelta(hours=1), self.now - timedelta(minutes=2))
+        self.create_outing(self.users[2], self.now - timedelta(minutes=30), self.now + timedelta(hours=1), notified=True)
+        self.create_outing(self.users[3], self.now + timedelta(minutes=30), self.now + timedelta(hours=1), status=DRAFT)
+
+        filename = os.path.join(tempfile.mkdtemp(), 'alert.prom')
+        with self.settings(RAS_METRICS_HOOK='RandoAmisSecours.tests.metrics_hook'):
+            call_command('alert', base_url='http://example.com', metrics_file=filename)
+        metrics = metrics_hook.metrics
+        self.assertEqual(metrics.get('confirmed'), 1)
+        self.assertEqual(metrics.get('outings', state='late'), 1)
+        self.assertEqual(metrics.get('outings', state='alerting'), 1)
+        self.assertEqual(metrics.get('notifications', status='attempted'), 5)
+        self.assertEqual(metrics.get('notifications', status='failed'), 0)
+        self.assertTrue(metrics.get('phase_seconds', phase='email') > 0)
+
+        with io.open(filename, encoding='utf-8') as f_in:
+            lines = f_in.read().split('\n')
+        self.assertTrue('# TYPE ras_alert_outings gauge' in lines)
+        self.assertTrue('ras_alert_outings{state="late"} 1' in lines)
+        self.assertTrue('ras_alert_notifications{status="attempted"} 5' in lines)
+
+        # Every metric is a single group of samples, after its TYPE line
+        names = []
+        for line in lines:
+            if line.startswith('# TYPE '):
+                names.append(line.split()[2])
+            elif line:
+                self.assertEqual(line.split('{')[0].split(' ')[0], names[-1])
+        self.assertEqual(len(names), len(set(names)))
+        self.assertTrue('ras_alert_phase_seconds' in names)
+
+    def test_catch_up(self):
+        # Several windows were missed: notify once
+        outing = self.create_outing(self.users[1], self.now - timedelta(hours=3), self.now - timedelta(hours=1))
+        call_command('alert', base_url='http://example.com')
+        self.assertEqual(len(mail.outbox), 2)
+        outing = Outing.objects.get(pk=outing.pk)
+        self.assertEqual(outing.notification_count, 1)
+        self.assertEqual(outing.next_notification_at, outing.alert + timedelta(hours=2))
+
+        call_command('alert', base_url='http://example.com')
+        self.assertEqual(len(mail.outbox), 2)
+
+        # Finished outings are not notified anymore
+        outing.status = FINISHED
+        outing.save()
+        self.assertEqual(Outing.objects.get(pk=outing.pk).next_notification_at, None)
+
+    def test_simulate(self):
+        start = self.now.replace(second=0, microsecond=0)
+        self.create_outing(self.users[1], start + timedelta(minutes=5), start + timedelta(minutes=65), status=DRAFT)
+
+        filename = os.path.join(tempfile.mkdtemp(), 'simulation.json')
+        call_command('alert', simulate=True, start=start.isoformat(),
+                     end=(start + timedelta(hours=2)).isoformat(), step='10m',
+                     output=filename, stdout=six.StringIO())
+        with io.open(filename, encoding='utf-8') as f_in:
+            events = [json.loads(line) for line in f_in]
+        self.assertEqual([(e['time'], e['event'], e.get('user')) for e in events],
+                         [(start.isoformat(), 'confirm', None),
+                          ((start + timedelta(minutes=10)).isoformat(), 'late', 'user1'),
+                          ((start + timedelta(minutes=70)).isoformat(), 'alert', 'user1'),
+                          ((start + timedelta(minutes=70)).isoformat(), 'alert', 'user0')])
+        self.assertFalse(any(e.get('duplicate') for e in events))
+
+        # Nothing is saved nor sent
+        self.assertEqual(Outing.objects.get().status, DRAFT)
+        self.assertEqual(Notification.objects.count(), 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_render_cache(self):
+        renderer = RenderCache()
+        ctx = {'fullname': 'Alpha', 'name': 'Mont Blanc',
+               'ending': self.now - timedelta(hours=2), 'now': self.now}
+        sms_fr = renderer.render('RandoAmisSecours/alert/alert.txt', ctx, 'fr', 'Europe/Paris')
+        sms_en = renderer.render('RandoAmisSecours/alert/alert.txt', ctx, 'en', 'Europe/Paris')
+        # timesince is translated in the language of the recipient
+        self.assertTrue('heures' in sms_fr)
+        self.assertTrue('hours' in sms_en)
+        self.assertEqual(len(renderer.cache), 2)
+
+        # Rendered only once
+        for key in renderer.cache:
+            renderer.cache[key] = 'cached'
+        self.assertEqual(renderer.render('RandoAmisSecours/alert/alert.txt', dict(ctx), 'fr', 'Europe/Paris'), 'cached')
+
+    def test_outbox(self):
+        self.create_outing(self.users[0], self.now - timedelta(hours=1), self.now - timedelta(minutes=2))
+        call_command('alert', base_url='http://example.com', send=False)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(Notification.objects.filter(status=PENDING).count(), 4)
+
+        # The same alert window is not notified twice
+        call_command('alert', base_url='http://example.com')
+        call_command('notify')
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(Notification.objects.filter(status=SENT).count(), 4)
+
+    def test_outbox_retry(self):
+        self.users[1].profile.provider = 'unknown'
+        self.users[1].profile.provider_data = '{}'
+        self.users[1].profile.save()
+        self.create_outing(self.users[1], self.now - timedelta(minutes=1), self.now + timedelta(hours=1))
+        call_command('alert', base_url='http://example.com')
+        self.assertEqual(len(mail.outbox), 1)
+
+        # The SMS is retried later
+        sms = Notification.objects.get(channel='unknown')
+        self.assertEqual(sms.status, PENDING)
+        self.assertEqual(sms.attempts, 1)
+        self.assertTrue(sms.next_attempt > self.now)
+
+        with self.settings(RAS_OUTBOX_MAX_ATTEMPTS=2):
+            drain(Dispatcher(), sms.next_attempt)
+        sms = Notification.objects.get(channel='unknown')
+        self.assertEqual(sms.status, FAILED)
+        self.assertEqual(sms.attempts, 2)
+
+    def test_outbox_timeout(self):
+        class HungDispatcher(Dispatcher):
+            def send_mail(self, *args):
+                time.sleep(0.5)
+
+        self.create_outing(self.users[1], self.now - timedelta(minutes=1), self.now + timedelta(hours=1))
+        call_command('alert', base_url='http://example.com', send=False)
+        now = Notification.objects.get().next_attempt
+        self.assertEqual(drain(HungDispatcher(timeout=0.1), now), (0, 1))
+
+        # The thread might still send it: not retried before the end of the lease
+        notification = Notification.objects.get()
+        self.assertEqual(notification.status, SENDING)
+        self.assertEqual(notification.attempts, 1)
+        self.assertEqual(drain(Dispatcher(), now + timedelta(seconds=60)), (0, 0))
+        self.assertEqual(drain(Dispatcher(), now + timedelta(seconds=301)), (1, 0))
+
+    def test_outbox_cancelled(self):
+        class HungDispatcher(Dispatcher):
+            def send_mail(self, subject, body, from_email, recipient_list):
+                if not hung:
+                    hung.append(recipient_list)
+                    time.sleep(0.5)
+
+        hung = []
+        for hours in [1, 2]:
+            self.create_outing(self.users[1], self.now - timedelta(minutes=1), self.now + timedelta(hours=hours))
+        call_command('alert', base_url='http://example.com', send=False)
+        now = max(Notification.objects.values_list('next_attempt', flat=True))
+        # The second notification waits for the stuck thread: sent again at
+        # once rather than after the lease
+        self.assertEqual(drain(HungDispatcher(limits={'email': 1}, timeout=0.1), now), (1, 1))
+        self.assertEqual(sorted(Notification.objects.values_list('status', 'attempts')),
+                         sorted([(SENDING, 1), (SENT, 0)]))
+
+
+class ProviderCacheTest(TestCase):
+    def setUp(self):
+        provider_cache.clear()
+        self.user = User.objects.create_user('zoro', 'zoro@example.com', 'zorro')
+        self.user.profile = Profile.objects.create(user=self.user, provider='mobile.free.fr',
+                                                   provider_data='{"user": "zoro", "token": "zorro"}')
+
+    def test_cache(self):
+        provider = get_provider(self.user.profile)
+        self.assertTrue(get_provider(self.user.profile) is provider)
+
+        # Saving the profile drops the provider
+        self.user.profile.save()
+        self.assertFalse(get_provider(self.user.profile) is provider)
+
+    def test_size(self):
+        cache = ProviderCache(2)
+        providers = [cache.get('mobile.free.fr', '{"user": "%d", "token": ""}' % i)
+                     for i in range(3)]
+        self.assertEqual(len(cache.providers), 2)
+        self.assertTrue(cache.get('mobile.free.fr', '{"user": "2", "token": ""}') is providers[2])
+        self.assertFalse(cache.get('mobile.free.fr', '{"user": "0", "token": ""}') is providers[0])
+
+
+def metrics_hook(metrics):
+    metrics_hook.metrics = metrics
+
+
+class CountingEmailBackend(EmailBackend):
+    opened = 0
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return True
+
+
+class DispatcherTest(TestCase):
+    def test_limits(self):
+        lock = threading.Lock()
+        running = {'current': 0, 'max': 0}
+
+        def send():
+            with lock:
+                running['current'] += 1
+                running['max'] = max(running['max'], running['current'])
+            time.sleep(0.05)
+            with lock:
+                running['current'] -= 1
+
+        dispatcher = Dispatcher(limits={'email': 2})
+        for i in range(6):
+            dispatcher.submit('email', 'user', send)
+        self.assertEqual(dispatcher.join(), [])
+        self.assertEqual(running['max'], 2)
+
+    def test_failures(self):
+        def fail():
+            raise IOError('Connection refused')
+
+        dispatcher = Dispatcher(limits={}, timeout=0.1)
+        dispatcher.submit('email', 'user1', fail)
+        dispatcher.submit('mobile.free.fr', 'user2', time.sleep, 1)
+        dispatcher.submit('email', 'user3', lambda: None)
+        failures = dispatcher.join()
+        self.assertEqual(len(failures), 2)
+        self.assertEqual(failures[0][0].recipient, 'user1')
+        self.assertTrue(isinstance(failures[0][1], IOError))
+        self.assertEqual(failures[1][0].recipient, 'user2')
+        self.assertEqual(failures[1][1], 'timeout')
+
+    def test_timeout(self):
+        # The time spent waiting for a thread does not count
+        dispatcher = Dispatcher(limits={'email': 1}, timeout=0.2)
+        for i in range(4):
+            dispatcher.submit('email', 'user', time.sleep, 0.1)
+        self.assertEqual(dispatcher.join(), [])
+
+        # The jobs waiting for a stuck thread are cancelled
+        for i in range(6):
+            dispatcher.submit('email', 'user', time.sleep, 1)
+        start = time.time()
+        failures = dispatcher.join()
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual([error for (_, error) in failures], ['timeout'] + ['cancelled'] * 5)
+
+    @override_settings(EMAIL_BACKEND='RandoAmisSecours.tests.CountingEmailBackend')
+    def test_connections(self):
+        CountingEmailBackend.opened = 0
+        dispatcher = Dispatcher(limits={'email': 2})
+        for i in range(10):
+            dispatcher.submit('email', 'user', dispatcher.send_mail,
+                              'subject', 'body', 'ras@example.com', ['user%d@example.com' % i])
+        self.assertEqual(dispatcher.join(), [])
+        self.assertEqual(len(mail.outbox), 10)
+        # At most one connection per thread
+        self.assertTrue(CountingEmailBackend.opened <= 2)
+
+    def test_shared_connection(self):
+        user = User.objects.create_user('alpha', 'alpha@example.com', 'azerty')
+        user.profile = Profile.objects.create(user=user)
+        connection = EmailBackend()
+        for i in range(2):
+            send_localized_mail(user, 'subject', 'RandoAmisSecours/friends/request_email.html',
+                                {'from': 'beta', 'to': 'alpha', 'accept': '', 'refuse': ''},
+                                connection=connection)
+        self.assertEqual([m.connection for m in mail.outbox], [connection, connection])
+
+
+class TraceTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alpha', 'alpha@example.com', 'azerty')
+        self.user.profile = Profile.objects.create(user=self.user, timezone='Europe/Paris', language='fr')
+        self.date = datetime(2016, 4, 2, 8, 0).replace(tzinfo=utc)
+        self.outing = Outing.objects.create(user=self.user, beginning=self.date,
+                                            ending=self.date + timedelta(hours=4),
+                                            alert=self.date + timedelta(hours=6),
+                                            latitude=1, longitude=1, status=FINISHED)
+        for i in range(100):
+            GPSPoint.objects.create(outing=self.outing, date=self.date + timedelta(seconds=10 * i),
+                                    latitude=45.1234567 + i * 0.0001, longitude=-5.5 - i * 0.00005,
+                                    precision=10 + i % 3)
+
+    def test_encoding(self):
+        points = [(p.date, p.latitude, p.longitude, p.precision) for p in GPSPoint.objects.all()]
+        data = trace.encode(points)
+        # Small deltas take a few bytes per point
+        self.assertTrue(len(data) < 8 * len(points))
+
+        decoded = trace.decode(data)
+        self.assertEqual(len(decoded), len(points))
+        for (point, (date, latitude, longitude, precision)) in zip(points, decoded):
+            self.assertEqual(date, point[0])
+            self.assertAlmostEqual(latitude, point[1], places=6)
+            self.assertAlmostEqual(longitude, point[2], places=6)
+            self.assertEqual(precision, point[3])
+
+        self.assertRaises(ValueError, trace.decode, b'')
+
+    def test_compact(self):
+        expected = [(p.date, round(p.latitude, 6), round(p.longitude, 6)) for p in self.outing.get_trace()]
+        call_command('compact_traces')
+        self.assertEqual(GPSPoint.objects.count(), 0)
+        self.assertEqual(TraceSegment.objects.get().count, 100)
+
+        # New points are merged with the packed ones
+        GPSPoint.objects.create(outing=self.outing, date=self.date - timedelta(minutes=1),
+                                latitude=45, longitude=-5, precision=10)
+        with self.assertNumQueries(2):
+            points = self.outing.get_trace()
+        self.assertEqual(len(points), 101)
+        self.assertEqual(points[0].date, self.date - timedelta(minutes=1))
+        self.assertEqual([(p.date, round(p.latitude, 6), round(p.longitude, 6)) for p in points[1:]],
+                         expected)
+
+    def test_simplify(self):
+        # A straight line with a 50m detour in the middle
+        points = [(self.date + timedelta(seconds=i), 45, 5 + i * 0.0001, 10) for i in range(101)]
+        points[50] = (points[50][0], 45.00045, points[50][2], 10)
+        self.assertEqual(trace.simplify(points, 0), points)
+        self.assertEqual(trace.simplify(points, 20), [points[0], points[49], points[50], points[51], points[100]])
+        self.assertEqual(trace.simplify(points, 100), [points[0], points[100]])
+        self.assertEqual(trace.simplify(points[:2], 100), points[:2])
+
+        self.assertEqual(trace.tolerance_for_zoom(8, 45), 100)
+        self.assertEqual(trace.tolerance_for_zoom(12, 45), 20)
+        self.assertEqual(trace.tolerance_for_zoom(14, 45), 5)
+        self.assertEqual(trace.tolerance_for_zoom(18, 45), 0)
+        self.assertEqual(trace.tolerance_for_zoom(2000, 45), 0)
+        self.assertEqual(trace.tolerance_for_zoom(-2000, 45), 100)
+
+    def test_simplified_trace(self):
+        cache.clear()
+        client = Client()
+        self.assertTrue(client.login(username='alpha', password='azerty'))
+        url = reverse('outings.details.trace', args=[self.outing.pk])
+
+        # The points are aligned
+        response = client.get(url)
+        self.assertEqual(response.context['zoom'], 12)
+        self.assertEqual(response.context['tolerance'], 20)
+        self.assertEqual(len(response.context['points']), 2)
+        response = client.get(url, {'zoom': 42})
+        self.assertEqual(response.context['zoom'], 18)
+        self.assertEqual(len(response.context['points']), 100)
+
+        # The tiers are cached until the points change
+        with self.assertNumQueries(0):
+            trace.get_simplified_trace(self.outing, 20)
+        GPSPoint.objects.create(outing=self.outing, date=self.date - timedelta(minutes=1),
+                                latitude=46, longitude=-5, precision=10)
+        self.assertEqual(len(trace.get_simplified_trace(self.outing, 20)), 3)
+
+
+class GPSPointBulkTest(ResourceTestCase):
+    def setUp(self):
+        super(GPSPointBulkTest, self).setUp()
+        self.user = User.objects.create_user('alpha', 'alpha@example.com', 'azerty')
+        self.user.profile = Profile.objects.create(user=self.user)
+        self.other = User.objects.create_user('beta', 'beta@example.com', 'azerty')
+        self.other.profile = Profile.objects.create(user=self.other)
+        self.date = datetime(2016, 4, 2, 8, 0).replace(tzinfo=utc)
+        self.outing = Outing.objects.create(user=self.user, beginning=self.date,
+                                            ending=self.date + timedelta(hours=4),
+                                            alert=self.date + timedelta(hours=6),
+                                            latitude=1, longitude=1, status=CONFIRMED)
+        self.url = "/api/1.0/GPSPoint/bulk/%d/" % self.outing.pk
+
+    def auth(self, user):
+        return self.create_apikey(user.username, user.api_key.key)
+
+    def post(self, user, points, url=None):
+        return self.api_client.post(url or self.url, format='json',
+                                    data={'points': points},
+                                    authentication=self.auth(user))
+
+    def test_compacted(self):
+        # Half of the trace is packed
+        for i in range(10):
+            GPSPoint.objects.create(outing=self.outing, date=self.date + timedelta(seconds=i),
+                                    latitude=45 + i * 0.001, longitude=5, precision=i)
+        trace.compact(self.outing.pk)
+        for i in range(10, 15):
+            GPSPoint.objects.create(outing=self.outing, date=self.date + timedelta(seconds=i),
+                                    latitude=45 + i * 0.001, longitude=5, precision=i)
+        self.assertEqual(self.outing.get_point_count(), 15)
+
+        # Still listed by the API, in the same order and pages
+        data = self.deserialize(self.api_client.get('/api/1.0/GPSPoint/', data={'outing': self.outing.pk, 'limit': 4},
+                                                    authentication=self.auth(self.user)))
+        self.assertEqual(data['meta']['total_count'], 15)
+        points = data['objects']
+        while data['meta']['next']:
+            data = self.deserialize(self.api_client.get(data['meta']['next'], authentication=self.auth(self.user)))
+            points.extend(data['objects'])
+        self.assertEqual([p['precision'] for p in points], list(range(15)))
+        self.assertEqual(points[0]['resource_uri'], None)
+        self.assertEqual(points[0]['outing'], '/api/1.0/outing/%d/' % self.outing.pk)
+        self.assertEqual(points[0]['date'], '2016-04-02T10:00:00')
+        self.assertEqual(points[0]['latitude'], 45)
+
+        # Filtered
+        data = self.deserialize(self.api_client.get('/api/1.0/GPSPoint/',
+                                                    data={'date__gte': '2016-04-02T08:00:08+00:00',
+                                                          'date__lt': '2016-04-02T08:00:12+00:00'},
+                                                    authentication=self.auth(self.user)))
+        self.assertEqual([p['precision'] for p in data['objects']], [8, 9, 10, 11])
+        data = self.deserialize(self.api_client.get('/api/1.0/GPSPoint/', data={'outing': self.outing.pk + 1},
+                                                    authentication=self.auth(self.user)))
+        self.assertEqual(data['objects'], [])
+        data = self.deserialize(self.api_client.get('/api/1.0/GPSPoint/', data={'layout': 'columns'},
+                                                    authentication=self.auth(self.user)))
+        self.assertEqual(data['columns']['precision'], list(range(15)))
+        self.assertHttpBadRequest(self.api_client.get('/api/1.0/GPSPoint/', data={'date__gt': 'nope'},
+                                                      authentication=self.auth(self.user)))
+
+        # Not visible to the others
+        data = self.deserialize(self.api_client.get('/api/1.0/GPSPoint/', authentication=self.auth(self.other)))
+        self.assertEqual(data['objects'], [])
+
+    def test_compacted_pages(self):
+        # A packed outing after a long running one
+        for i in range(20):
+            GPSPoint.objects.create(outing=self.outing, date=self.date + timedelta(hours=1, seconds=i),
+                                    latitude=45, longitude=5, precision=100 + i)
+        (size, trace.SEGMENT_SIZE) = (trace.SEGMENT_SIZE, 2)
+        try:
+            trace.compact(self.outing.pk)
+        finally:
+            trace.SEGMENT_SIZE = size
+        running = Outing.objects.create(user=self.user, name='running', beginning=self.date,
+                                        ending=self.date + timedelta(hours=4),
+                                        alert=self.date + timedelta(hours=6),
+                                        latitude=1, longitude=1, status=CONFIRMED)
+        GPSPoint.objects.bulk_create([GPSPoint(outing=running, date=self.date + timedelta(seconds=i),
+                                               latitude=45, longitude=5, precision=i)
+                                      for i in range(30)])
+
+        def get(url, limit):
+            return self.deserialize(self.api_client.get(re.sub(r'limit=\d+', 'limit=%d' % limit, url),
+                                                        authentication=self.auth(self.user)))
+
+        # Only the segments that might contain points of the page are decoded
+        decoded = []
+        get_points = TraceSegment.get_points
+        TraceSegment.get_points = lambda segment: decoded.append(segment.start) or get_points(segment)
+        try:
+            data = get('/api/1.0/GPSPoint/?limit=20', 20)
+            self.assertEqual(data['meta']['total_count'], 50)
+            self.assertEqual([p['precision'] for p in data['objects']], list(range(20)))
+            self.assertEqual(decoded, [])
+
+            data = get(data['meta']['next'], 12)
+            self.assertEqual([p['precision'] for p in data['objects']], list(range(20, 30)) + [100, 101])
+            self.assertEqual(len(decoded), 7)
+
+            del decoded[:]
+            data = get(data['meta']['next'], 4)
+            self.assertEqual([p['precision'] for p in data['objects']], [102, 103, 104, 105])
+            self.assertEqual(len(decoded), 4)
+        finally:
+            TraceSegment.get_points = get_points
+
+    def test_json(self):
+        epoch = (self.date - trace.EPOCH).total_seconds()
+        points = [[epoch + 10 * i, 45 + i * 0.001, 5, 10] for i in range(200)]
+        response = self.post(self.user, points)
+        self.assertHttpCreated(response)
+        self.assertEqual(self.deserialize(response), {'created': 200, 'duplicates': 0})
+        self.assertEqual(GPSPoint.objects.filter(outing=self.outing).count(), 200)
+        self.assertEqual(GPSPoint.objects.first().date, self.date)
+
+        # Sending the points again is harmless
+        points.append(["2016-04-02T09:00:00Z", 46, 5, 10])
+        response = self.post(self.user, points)
+        self.assertHttpCreated(response)
+        self.assertEqual(self.deserialize(response), {'created': 1, 'duplicates': 200})
+        self.assertEqual(GPSPoint.objects.filter(outing=self.outing).count(), 201)
+
+        # Packed points are not added again
+        trace.compact(self.outing.pk)
+        response = self.post(self.user, points[:10])
+        self.assertEqual(self.deserialize(response), {'created': 0, 'duplicates': 10})
+        self.assertEqual(GPSPoint.objects.count(), 0)
+
+    def test_packed(self):
+        points = [(self.date + timedelta(seconds=i), 45, 5, 10) for i in range(10)]
+        response = self.api_client.client.post(self.url, data=trace.encode(points),
+                                               content_type='application/x-ras-trace',
+                                               HTTP_AUTHORIZATION=self.auth(self.user))
+        self.assertHttpCreated(response)
+        self.assertEqual([p.date for p in self.outing.get_trace()], [p[0] for p in points])
+
+        # A date out of range
+        data = bytearray([trace.VERSION])
+        trace._write_varint(data, 2 ** 60)
+        data.extend([0, 0, 0])
+        self.assertRaises(ValueError, trace.decode, bytes(data))
+        response = self.api_client.client.post(self.url, data=bytes(data),
+                                               content_type='application/x-ras-trace',
+                                               HTTP_AUTHORIZATION=self.auth(self.user))
+        self.assertHttpBadRequest(response)
+
+    def test_errors(self):
+        points = [["2016-04-02T09:00:00Z", 46, 5, 10]]
+        self.assertHttpUnauthorized(self.api_client.post(self.url, format='json', data={'points': points}))
+        self.assertHttpNotFound(self.post(self.other, points))
+        self.assertHttpNotFound(self.post(self.user, points, url="/api/1.0/GPSPoint/bulk/%d/" % (self.outing.pk + 1)))
+        self.assertHttpMethodNotAllowed(self.api_client.get(self.url, authentication=self.auth(self.user)))
+
+        self.assertHttpBadRequest(self.post(self.user, [["2016-04-02T09:00:00Z", 91, 5, 10]]))
+        self.assertHttpBadRequest(self.post(self.user, [["yesterday", 45, 5, 10]]))
+        self.assertHttpBadRequest(self.post(self.user, [[0, 45, 5]]))
+        with override_settings(RAS_GPS_BULK_MAX=1):
+            self.assertHttpBadRequest(self.post(self.user, points * 2))
+        self.assertEqual(GPSPoint.objects.count(), 0)
+
+    def test_trace(self):
+        self.outing.status = FINISHED
+        self.outing.save()
+        points = [["2016-04-02T08:00:%02dZ" % i, 45, 5 + i * 0.0001, 10] for i in range(10)]
+        self.assertHttpCreated(self.post(self.user, points))
+
+        url = "/api/1.0/GPSPoint/trace/%d/" % self.outing.pk
+        response = self.api_client.get(url, authentication=self.auth(self.user))
+        self.assertValidJSONResponse(response)
+        data = self.deserialize(response)
+        self.assertEqual(data['tolerance'], 0)
+        self.assertEqual(len(data['points']), 10)
+
+        # Dates in the local time, like the other resources
+        response = self.api_client.get(url, data={'zoom': 12}, authentication=self.auth(self.user))
+        data = self.deserialize(response)
+        self.assertEqual(data['tolerance'], 20)
+        self.assertEqual(data['points'], [["2016-04-02T10:00:00", 45.0, 5.0, 10],
+                                          ["2016-04-02T10:00:09", 45.0, 5.0009, 10]])
+
+        # Only the owner and the friends can read the trace
+        self.assertHttpNotFound(self.api_client.get(url, authentication=self.auth(self.other)))
+        self.user.profile.friends.add(self.other.profile)
+        self.other.profile.friends.add(self.user.profile)
+        self.assertValidJSONResponse(self.api_client.get(url, authentication=self.auth(self.other)))
+        self.assertHttpBadRequest(self.api_client.get(url, data={'zoom': 'far'}, authentication=self.auth(self.user)))
+
+        # Out of range zoom levels are clamped
+        data = self.deserialize(self.api_client.get(url, data={'zoom': 2000}, authentication=self.auth(self.user)))
+        self.assertEqual(data['tolerance'], 0)
+        data = self.deserialize(self.api_client.get(url, data={'zoom': -5}, authentication=self.auth(self.user)))
+        self.assertEqual(data['tolerance'], 100)
+
+
+class GeoTest(ResourceTestCase):
+    def setUp(self):
+        super(GeoTest, self).setUp()
+        self.user = User.objects.create_user('alpha', 'alpha@example.com', 'azerty')
+        self.user.profile = Profile.objects.create(user=self.user)
+        self.date = datetime.utcnow().replace(tzinfo=utc) - timedelta(hours=8)
+        self.outings = {}
+        for (name, latitude, longitude) in [('grenoble', 45.188, 5.724),
+                                            ('chamrousse', 45.110, 5.875),
+                                            ('lyon', 45.764, 4.835),
+                                            ('taveuni', -16.8, 179.99),
+                                            ('rabi', -16.5, -179.98)]:
+            self.outings[name] = Outing.objects.create(user=self.user, name=name,
+                                                       beginning=self.date,
+                                                       ending=self.date + timedelta(hours=4),
+                                                       alert=self.date + timedelta(hours=6),
+                                                       latitude=latitude, longitude=longitude,
+                                                       status=CONFIRMED)
+
+    def near(self, latitude, longitude, distance):
+        return sorted(o.name for o in geo.near(Outing.objects.all(), latitude, longitude, distance))
+
+    def test_geohash(self):
+        self.assertEqual(geo.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(self.outings['grenoble'].geohash, geo.encode(45.188, 5.724))
+        self.assertAlmostEqual(geo.haversine(45.188, 5.724, 45.764, 4.835), 94.4, places=1)
+
+    def test_near(self):
+        self.assertEqual(self.near(45.19, 5.72, 1), ['grenoble'])
+        self.assertEqual(self.near(45.19, 5.72, 20), ['chamrousse', 'grenoble'])
+        self.assertEqual(self.near(45.19, 5.72, 100), ['chamrousse', 'grenoble', 'lyon'])
+        # Lyon is 94.4 km away
+        self.assertEqual(self.near(45.188, 5.724, 94.3), ['chamrousse', 'grenoble'])
+        self.assertEqual(self.near(45.188, 5.724, 94.5), ['chamrousse', 'grenoble', 'lyon'])
+        # Filtered by the database in one query
+        with self.assertNumQueries(1):
+            self.near(45.19, 5.72, 20)
+        self.assertEqual(self.near(0, 0, 100), [])
+        # Across the antimeridian
+        self.assertEqual(self.near(-16.6, 179.9, 50), ['rabi', 'taveuni'])
+
+    def test_api(self):
+        auth = self.create_apikey(self.user.username, self.user.api_key.key)
+        response = self.api_client.get('/api/1.0/outing/', data={'near': '45.19,5.72,20'},
+                                       authentication=auth)
+        self.assertValidJSONResponse(response)
+        self.assertEqual(sorted(o['name'] for o in self.deserialize(response)['objects']),
+                         ['chamrousse', 'grenoble'])
+        self.assertHttpBadRequest(self.api_client.get('/api/1.0/outing/', data={'near': '45.19'},
+                                                      authentication=auth))
+        self.assertHttpBadRequest(self.api_client.get('/api/1.0/outing/', data={'near': '45.19,5.72,1000'},
+                                                      authentication=auth))
+
+    def test_reporting(self):
+        self.user.is_staff = True
+        self.user.save()
+        client = Client()
+        self.assertTrue(client.login(username='alpha', password='azerty'))
+
+        response = client.get(reverse('reporting.outings.late'))
+        self.assertEqual(len(response.context['late_outings']), 5)
+        response = client.get(reverse('reporting.outings.late'),
+                              {'latitude': 45.2, 'longitude': 5.9, 'distance': 30})
+        self.assertEqual([o.name for o in response.context['late_outings']], ['chamrousse', 'grenoble'])
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alpha', 'alpha@example.com', 'azerty')
+        self.user.profile = Profile.objects.create(user=self.user)
+        now = datetime.utcnow().replace(tzinfo=utc)
+        self.outings = {}
+        for (name, days, status) in [('old', 400, FINISHED), ('canceled', 400, CANCELED),
+                                     ('recent', 10, FINISHED), ('confirmed', 400, CONFIRMED)]:
+            self.outings[name] = Outing.objects.create(user=self.user, name=name, status=status,
+                                                       beginning=now - timedelta(days=days, hours=4),
+                                                       ending=now - timedelta(days=days),
+                                                       alert=now - timedelta(days=days) + timedelta(hours=2),
+                                                       latitude=45, longitude=5)
+        self.date = (now - timedelta(days=400, hours=3)).replace(microsecond=0)
+        for i in range(20):
+            GPSPoint.objects.create(outing=self.outings['old'], date=self.date + timedelta(seconds=i),
+                                    latitude=45 + i * 0.001, longitude=5, precision=10)
+        # Half of the points are packed
+        trace.compact(self.outings['old'].pk)
+        for i in range(20, 30):
+            GPSPoint.objects.create(outing=self.outings['old'], date=self.date + timedelta(seconds=i),
+                                    latitude=45 + i * 0.001, longitude=5, precision=10)
+
+    def test_archive(self):
+        call_command('archive_outings', batch=1)
+        self.assertEqual(sorted(Outing.objects.values_list('name', flat=True)), ['confirmed', 'recent'])
+        self.assertEqual(sorted(ArchivedOuting.objects.values_list('name', flat=True)), ['canceled', 'old'])
+        self.assertEqual(GPSPoint.objects.count(), 0)
+        self.assertEqual(TraceSegment.objects.count(), 0)
+
+        # Archived outings are still readable
+        outing = get_outing(self.outings['old'].pk)
+        self.assertEqual(outing.name, 'old')
+        self.assertEqual(outing.user, self.user)
+        self.assertEqual(outing.beginning, self.outings['old'].beginning)
+        points = outing.get_trace()
+        self.assertEqual([p.date for p in points], [self.date + timedelta(seconds=i) for i in range(30)])
+        self.assertRaises(Outing.DoesNotExist, get_outing, self.outings['old'].pk + 42)
+
+        client = Client()
+        self.assertTrue(client.login(username='alpha', password='azerty'))
+        response = client.get(reverse('outings.details', args=[outing.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['outing'].archived, ArchivedOuting.objects.get(pk=outing.pk).archived)
+        response = client.get(reverse('outings.details.trace', args=[outing.pk]), {'zoom': 18})
+        self.assertEqual(len(response.context['points']), 30)
+
+        call_command('archive_outings', days=1)
+        self.assertEqual(sorted(Outing.objects.values_list('name', flat=True)), ['confirmed'])
+
+
+class ConditionalTest(ResourceTestCase):
+    def setUp(self):
+        super(ConditionalTest, self).setUp()
+        cache.clear()
+        self.user = User.objects.create_user('alpha', 'alpha@example.com', 'azerty')
+        self.user.profile = Profile.objects.create(user=self.user)
+        self.friend = User.objects.create_user('beta', 'beta@example.com', 'azerty')
+        self.friend.profile = Profile.objects.create(user=self.friend)
+        self.date = datetime.utcnow().replace(tzinfo=utc)
+        self.outing = Outing.objects.create(user=self.friend, name='outing', beginning=self.date,
+                                            ending=self.date + timedelta(hours=4),
+                                            alert=self.date + timedelta(hours=6),
+                                            latitude=1, longitude=1, status=CONFIRMED)
+        self.user.profile.friends.add(self.friend.profile)
+        self.friend.profile.friends.add(self.user.profile)
+        self.auth = self.create_apikey(self.user.username, self.user.api_key.key)
+
+    def get(self, url, **headers):
+        return self.api_client.get(url, authentication=self.auth, **headers)
+
+    def test_list(self):
+        response = self.get('/api/1.0/outing/')
+        self.assertValidJSONResponse(response)
+        etag = response['ETag']
+
+        # Neither the outings nor the friends are loaded, the user is cached
+        with self.assertNumQueries(1):
+            response = self.get('/api/1.0/outing/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        # Another query is another version
+        response = self.get('/api/1.0/outing/?status=1', HTTP_IF_NONE_MATCH=etag)
+        self.assertValidJSONResponse(response)
+
+        self.outing.name = 'renamed'
+        self.outing.save()
+        response = self.get('/api/1.0/outing/', HTTP_IF_NONE_MATCH=etag)
+        self.assertValidJSONResponse(response)
+        self.assertNotEqual(response['ETag'], etag)
+        etag = response['ETag']
+        self.assertEqual(self.get('/api/1.0/outing/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # Removing a friend changes the list
+        self.user.profile.friends.remove(self.friend.profile)
+        self.assertValidJSONResponse(self.get('/api/1.0/outing/', HTTP_IF_NONE_MATCH=etag))
+
+    def test_detail(self):
+        url = '/api/1.0/outing/%d/' % self.outing.pk
+        response = self.get(url)
+        self.assertValidJSONResponse(response)
+        self.assertEqual(self.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+        Outing.objects.filter(pk=self.outing.pk).update(updated=self.date + timedelta(minutes=1))
+        self.assertValidJSONResponse(self.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']))
+
+        # The profiles and users change with the friends
+        url = '/api/1.0/profile/%d/' % self.user.profile.pk
+        response = self.get(url)
+        self.assertEqual(self.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        Profile.objects.filter(pk=self.user.profile.pk).update(updated=self.date - timedelta(days=1))
+        self.user.profile.friends.remove(self.friend.profile)
+        self.assertValidJSONResponse(self.get(url, HTTP_IF_NONE_MATCH=response['ETag']))
+
+    def test_points(self):
+        response = self.get('/api/1.0/GPSPoint/')
+        self.assertValidJSONResponse(response)
+        etag = response['ETag']
+        url = '/api/1.0/GPSPoint/trace/%d/' % self.outing.pk
+        trace_etag = self.get(url)['ETag']
+        self.assertEqual(self.get(url, HTTP_IF_NONE_MATCH=trace_etag).status_code, 304)
+
+        self.api_client.post('/api/1.0/GPSPoint/bulk/%d/' % self.outing.pk, format='json',
+                             data={'points': [[0, 45, 5, 10]]},
+                             authentication=self.create_apikey('beta', self.friend.api_key.key))
+        response = self.get('/api/1.0/GPSPoint/', HTTP_IF_NONE_MATCH=etag)
+        self.assertValidJSONResponse(response)
+        self.assertEqual(len(self.deserialize(response)['objects']), 1)
+        self.assertEqual(self.get('/api/1.0/GPSPoint/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertValidJSONResponse(self.get(url, HTTP_IF_NONE_MATCH=trace_etag))
+
+    def test_friends(self):
+        # Swapping a friend for another one with an older outing changes
+        # neither the last change nor the number of the objects
+        other = User.objects.create_user('gamma', 'gamma@example.com', 'azerty')
+        other.profile = Profile.objects.create(user=other)
+        Outing.objects.create(user=other, name='other', beginning=self.date,
+                              ending=self.date + timedelta(hours=4),
+                              alert=self.date + timedelta(hours=6),
+                              latitude=1, longitude=1, status=CONFIRMED)
+        Outing.objects.create(user=self.user, name='mine', beginning=self.date,
+                              ending=self.date + timedelta(hours=4),
+                              alert=self.date + timedelta(hours=6),
+                              latitude=1, longitude=1, status=CONFIRMED)
+        etags = dict((url, self.get(url)['ETag']) for url in ['/api/1.0/outing/', '/api/1.0/GPSPoint/',
+                                                             '/api/1.0/user/', '/api/1.0/profile/'])
+
+        self.user.profile.friends.remove(self.friend.profile)
+        self.friend.profile.friends.remove(self.user.profile)
+        self.user.profile.friends.add(other.profile)
+        other.profile.friends.add(self.user.profile)
+        for (url, etag) in etags.items():
+            response = self.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertValidJSONResponse(response)
+        self.assertEqual(sorted(o['name'] for o in self.deserialize(self.get('/api/1.0/outing/'))['objects']),
+                         ['mine', 'other'])
+
+
+class PaginationTest(ResourceTestCase):
+    def setUp(self):
+        super(PaginationTest, self).setUp()
+        cache.clear()
+        self.user = User.objects.create_user('alpha', 'alpha@example.com', 'azerty')
+        self.user.profile = Profile.objects.create(user=self.user)
+        self.date = datetime(2016, 4, 2, 8, 0).replace(tzinfo=utc)
+        self.outing = Outing.objects.create(user=self.user, name='outing', beginning=self.date,
+                                            ending=self.date + timedelta(hours=4),
+                                            alert=self.date + timedelta(hours=6),
+                                            latitude=1, longitude=1, status=CONFIRMED)
+        # Created in the reverse order of the dates
+        GPSPoint.objects.bulk_create([GPSPoint(outing=self.outing, date=self.date + timedelta(seconds=i),
+                                               latitude=45, longitude=5, precision=i)
+                                      for i in reversed(range(50))])
+        self.auth = self.create_apikey(self.user.username, self.user.api_key.key)
+
+    def get(self, url, **data):
+        response = self.api_client.get(url, data=data, authentication=self.auth)
+        self.assertValidJSONResponse(response)
+        return self.deserialize(response)
+
+    def test_keyset(self):
+        data = self.get('/api/1.0/GPSPoint/', outing=self.outing.pk, limit=20)
+        self.assertEqual(data['meta']['total_count'], 50)
+        precisions = [p['precision'] for p in data['objects']]
+
+        while data['meta']['next']:
+            self.assertNotIn('offset', data['meta']['next'])
+            # Version, packed segments and page, the user being cached
+            with self.assertNumQueries(3):
+                data = self.get(data['meta']['next'])
+            self.assertNotIn('total_count', data['meta'])
+            precisions.extend(p['precision'] for p in data['objects'])
+        self.assertEqual(precisions, list(range(50)))
+
+        data = self.get('/api/1.0/GPSPoint/', limit=20, count=0)
+        self.assertNotIn('total_count', data['meta'])
+        self.assertEqual(len(data['objects']), 20)
+
+        response = self.api_client.get('/api/1.0/GPSPoint/', data={'cursor': 'nope'}, authentication=self.auth)
+        self.assertHttpBadRequest(response)
+
+    def test_offset(self):
+        data = self.get('/api/1.0/GPSPoint/', limit=20, offset=40)
+        self.assertEqual(data['meta']['total_count'], 50)
+        self.assertEqual(len(data['objects']), 10)
+        self.assertEqual(data['meta']['next'], None)
+
+        data = self.get('/api/1.0/GPSPoint/', limit=20, offset=20, count=0)
+        self.assertNotIn('total_count', data['meta'])
+        self.assertIn('offset=40', data['meta']['next'])
+
+    def test_outings(self):
+        for i in range(3):
+            Outing.objects.create(user=self.user, name='outing %d' % i,
+                                  beginning=self.date - timedelta(days=i),
+                                  ending=self.date, alert=self.date,
+                                  latitude=1, longitude=1, status=FINISHED)
+        data = self.get('/api/1.0/outing/', limit=2)
+        names = [o['name'] for o in data['objects']]
+        data = self.get(data['meta']['next'])
+        names.extend(o['name'] for o in data['objects'])
+        self.assertEqual(data['meta']['next'], None)
+        # 'outing' and 'outing 0' begin at the same time
+        self.assertEqual(names, ['outing 2', 'outing 1', 'outing', 'outing 0'])
+
+
+@override_settings(RAS_SYNC_OVERLAP=0, RAS_SYNC_POINTS=3)
+class SyncTest(ResourceTestCase):
+    def setUp(self):
+        super(SyncTest, self).setUp()
+        cache.clear()
+        self.user = User.objects.create_user('alpha', 'alpha@example.com', 'azerty')
+        self.user.profile = Profile.objects.create(user=self.user)
+        self.friend = User.objects.create_user('beta', 'beta@example.com', 'azerty')
+        self.friend.profile = Profile.objects.create(user=self.friend)
+        self.stranger = User.objects.create_user('gamma', 'gamma@example.com', 'azerty')
+        self.stranger.profile = Profile.objects.create(user=self.stranger)
+        self.user.profile.friends.add(self.friend.profile)
+        self.friend.profile.friends.add(self.user.profile)
+
+        self.date = datetime.utcnow().replace(tzinfo=utc)
+        self.outings = {}
+        for user in [self.user, self.friend, self.stranger]:
+            self.outings[user.username] = self.create_outing(user, user.username)
+        self.auth = self.create_apikey(self.user.username, self.user.api_key.key)
+
+    def create_outing(self, user, name):
+        return Outing.objects.create(user=user, name=name, beginning=self.date,
+                                     ending=self.date + timedelta(hours=4),
+                                     alert=self.date + timedelta(hours=6),
+                                     latitude=1, longitude=1, status=CONFIRMED)
+
+    def sync(self, token=None):
+        response = self.api_client.get('/api/1.0/sync/', data={'token': token} if token else {},
+                                       authentication=self.auth)
+        self.assertValidJSONResponse(response)
+        return self.deserialize(response)
+
+    def test_sync(self):
+        GPSPoint.objects.create(outing=self.outings['beta'], date=self.date, latitude=1, longitude=1, precision=10)
+        data = self.sync()
+        self.assertFalse(data['reset'])
+        self.assertEqual(sorted(o['name'] for o in data['outings']), ['alpha', 'beta'])
+        self.assertEqual(sorted(u['first_name'] for u in data['users']), ['', ''])
+        self.assertEqual(len(data['profiles']), 2)
+        # The traces are not sent with the first sync
+        self.assertEqual(data['points'], [])
+        self.assertEqual(data['deleted_outings'], [])
+
+        # Nothing changed
+        token = data['token']
+        data = self.sync(token)
+        self.assertEqual((data['outings'], data['profiles'], data['points']), ([], [], []))
+
+        # Only the changes are sent
+        token = data['token']
+        self.outings['beta'].name = 'renamed'
+        self.outings['beta'].save()
+        self.outings['gamma'].save()
+        deleted = self.outings['alpha'].pk
+        self.outings['alpha'].delete()
+        for i in range(4):
+            GPSPoint.objects.create(outing=self.outings['beta'], date=self.date + timedelta(seconds=i + 1),
+                                    latitude=1, longitude=1, precision=i)
+        GPSPoint.objects.create(outing=self.outings['gamma'], date=self.date, latitude=1, longitude=1, precision=10)
+        data = self.sync(token)
+        self.assertEqual([o['name'] for o in data['outings']], ['renamed'])
+        self.assertEqual(data['deleted_outings'], [deleted])
+        self.assertEqual(data['profiles'], [])
+        self.assertEqual([p[4] for p in data['points']], [0, 1, 2])
+        self.assertEqual(data['points'][0][0], self.outings['beta'].pk)
+        self.assertTrue(data['more'])
+        data = self.sync(data['token'])
+        self.assertEqual([p[4] for p in data['points']], [3])
+        self.assertFalse(data['more'])
+
+        # New friends: every outing is sent again, the client fetching their
+        # traces
+        token = data['token']
+        self.user.profile.friends.add(self.stranger.profile)
+        GPSPoint.objects.create(outing=self.outings['gamma'], date=self.date + timedelta(seconds=1),
+                                latitude=1, longitude=1, precision=11)
+        data = self.sync(token)
+        self.assertEqual(sorted(o['name'] for o in data['outings']), ['gamma', 'renamed'])
+        self.assertEqual(len(data['profiles']), 2)
+        self.assertEqual([p[4] for p in data['points']], [11])
+
+    @override_settings(RAS_SYNC_OVERLAP=10)
+    def test_late_commit(self):
+        token = self.sync()['token']
+        now = datetime.utcnow().replace(tzinfo=utc)
+        # Points created before the previous sync but committed after it
+        for (i, delay) in enumerate([5, 20]):
+            point = GPSPoint.objects.create(outing=self.outings['beta'], date=self.date + timedelta(seconds=i),
+                                            latitude=1, longitude=1, precision=i)
+            GPSPoint.objects.filter(pk=point.pk).update(created=now - timedelta(seconds=delay))
+        data = self.sync(token)
+        self.assertEqual([p[4] for p in data['points']], [0])
+        # Sent again with the next sync, the client dropping the duplicates
+        self.assertEqual([p[4] for p in self.sync(data['token'])['points']], [0])
+
+    def test_token(self):
+        response = self.api_client.get('/api/1.0/sync/', data={'token': 'nope'}, authentication=self.auth)
+        self.assertHttpBadRequest(response)
+        self.assertHttpUnauthorized(self.api_client.get('/api/1.0/sync/'))
+
+        # The deletions are forgotten after RAS_SYNC_DAYS days
+        data = self.sync('%d.0.0' % (time.time() - 31 * 86400))
+        self.assertTrue(data['reset'])
+        self.assertEqual(sorted(o['name'] for o in data['outings']), ['alpha', 'beta'])
+
+
+class ColumnsTest(ResourceTestCase):
+    def setUp(self):
+        super(ColumnsTest, self).setUp()
+        cache.clear()
+        self.user = User.objects.create_user('alpha', 'alpha@example.com', 'azerty')
+        self.user.profile = Profile.objects.create(user=self.user)
+        self.date = datetime(2016, 4, 2, 8, 0).replace(tzinfo=utc)
+        self.outing = Outing.objects.create(user=self.user, name='outing', beginning=self.date,
+                                            ending=self.date + timedelta(hours=4),
+                                            alert=self.date + timedelta(hours=6),
+                                            latitude=1, longitude=1, status=CONFIRMED)
+        GPSPoint.objects.bulk_create([GPSPoint(outing=self.outing, date=self.date + timedelta(seconds=i),
+                                               latitude=45 + i * 0.0001, longitude=5 - i * 0.0001, precision=i)
+                                      for i in range(50)])
+        self.auth = self.create_apikey(self.user.username, self.user.api_key.key)
+
+    def get(self, url, **data):
+        response = self.api_client.get(url, data=data, authentication=self.auth)
+        self.assertValidJSONResponse(response)
+        return self.deserialize(response)
+
+    def test_columns(self):
+        for resource in ['outing', 'GPSPoint']:
+            objects = self.get('/api/1.0/%s/' % resource, limit=20)['objects']
+            data = self.get('/api/1.0/%s/' % resource, limit=20, layout='columns')
+            self.assertEqual(sorted(data['columns'].keys()), sorted(objects[0].keys()))
+            for (i, obj) in enumerate(objects):
+                self.assertEqual(dict((k, v[i]) for (k, v) in data['columns'].items()), obj)
+
+        # The same pages
+        data = self.get('/api/1.0/GPSPoint/', limit=20, layout='columns')
+        precisions = data['columns']['precision']
+        while data['meta']['next']:
+            data = self.get(data['meta']['next'])
+            precisions.extend(data['columns']['precision'])
+        self.assertEqual(precisions, list(range(50)))
+
+        response = self.api_client.get('/api/1.0/outing/', data={'layout': 'polyline'}, authentication=self.auth)
+        self.assertHttpBadRequest(response)
+
+    def test_polyline(self):
+        data = self.get('/api/1.0/GPSPoint/', limit=0, layout='polyline')
+        self.assertNotIn('latitude', data['columns'])
+        self.assertEqual(trace.decode_polyline(data['polyline']),
+                         [(round(45 + i * 0.0001, 5), round(5 - i * 0.0001, 5)) for i in range(50)])
+        self.assertEqual(trace.decode_polyline(trace.encode_polyline([(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)])),
+                         [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)])
+        self.assertEqual(trace.encode_polyline([(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]),
+                         '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+    def test_gzip(self):
+        response = self.api_client.get('/api/1.0/GPSPoint/', data={'layout': 'columns'},
+                                       authentication=self.auth, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        etag = response['ETag']
+        self.assertEqual(self.api_client.get('/api/1.0/GPSPoint/', data={'layout': 'columns'},
+                                             authentication=self.auth, HTTP_ACCEPT_ENCODING='gzip',
+                                             HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # Another encoding is another version
+        response = self.api_client.get('/api/1.0/GPSPoint/', data={'layout': 'columns'},
+                                       authentication=self.auth, HTTP_IF_NONE_MATCH=etag)
+        self.assertValidJSONResponse(response)
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+
+class AuthenticationTest(ResourceTestCase):
+    def setUp(self):
+        super(AuthenticationTest, self).setUp()
+        cache.clear()
+        self.user = User.objects.create_user('alpha', 'alpha@example.com', 'azerty')
+        self.user.profile = Profile.objects.create(user=self.user, language='fr')
+
+    def authenticate(self, api_key=None):
+        request = RequestFactory().get('/api/1.0/profile/', HTTP_AUTHORIZATION=self.create_apikey('alpha', api_key or self.user.api_key.key))
+        return (CachedApiKeyAuthentication().is_authenticated(request), request)
+
+    def test_cache(self):
+        self.assertTrue(self.authenticate()[0])
+        # The user and the profile are cached
+        with self.assertNumQueries(0):
+            (result, request) = self.authenticate()
+            self.assertTrue(result)
+            self.assertEqual(request.user, self.user)
+            self.assertEqual(request.user.profile.language, 'fr')
+        self.assertHttpUnauthorized(self.authenticate('wrong')[0])
+        self.assertValidJSONResponse(self.api_client.get('/api/1.0/profile/', authentication=self.create_apikey('alpha', self.user.api_key.key)))
+
+        # A new key invalidates the cache
+        old_key = self.user.api_key.key
+        self.user.api_key.key = None
+        self.user.api_key.save()
+        self.assertHttpUnauthorized(self.authenticate(old_key)[0])
+        self.assertTrue(self.authenticate()[0])
+
+        # Also the users and the profiles
+        self.user.is_active = False
+        self.user.save()
+        self.assertFalse(self.authenticate()[0])
+        self.user.is_active = True
+        self.user.save()
+        self.assertTrue(self.authenticate()[0])
+        self.user.profile.language = 'en'
+        self.user.profile.save()
+        self.assertEqual(self.authenticate()[1].user.profile.language, 'en')
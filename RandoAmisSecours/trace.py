@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+
+# Copyright 2016 Rémi Duraffort
+# This file is part of RandoAmisSecours.
+#
+# RandoAmisSecours is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RandoAmisSecours is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with RandoAmisSecours.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Packed and simplified GPS traces
+
+The points are quantized (seconds since the epoch, microdegrees, meters) and
+every column is delta encoded against the previous point, each delta being
+stored as a zigzag varint. The first point is encoded against zero.
+
+The traces are also sent as encoded polylines (the format of the Google maps
+API) of precision 5, about a meter.
+
+The maps display the traces simplified (Douglas-Peucker) with the tolerance
+of the tier matching the zoom level, the tiers being cached per outing.
+"""
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.timezone import datetime, timedelta, utc
+
+import math
+
+# Version of the encoding, stored in the first byte
+VERSION = 1
+# Maximum number of points in a segment
+SEGMENT_SIZE = 4096
+# Tolerances of the simplified traces (in meters), the coarsest first
+TIERS = (100, 20, 5)
+# Zoom levels of the maps
+MAX_ZOOM = 18
+
+EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+EARTH_RADIUS = 6371000.0
+EARTH_CIRCUMFERENCE = 40075016.686
+
+
+def _write_varint(buf, value):
+    # zigzag: small negative values are small positive integers
+    value = (value << 1) ^ (value >> 63)
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    return ((value >> 1) ^ -(value & 1), offset)
+
+
+def quantize(date, latitude, longitude, precision):
+    return (int((date - EPOCH).total_seconds()),
+            int(round(latitude * 1000000)),
+            int(round(longitude * 1000000)),
+            int(precision))
+
+
+def encode(points):
+    """ Pack the (date, latitude, longitude, precision) tuples """
+    buf = bytearray([VERSION])
+    previous = (0, 0, 0, 0)
+    for point in points:
+        values = quantize(*point)
+        for (value, prev) in zip(values, previous):
+            _write_varint(buf, value - prev)
+        previous = values
+    return bytes(buf)
+
+
+def decode(data):
+    """ Return the list of (date, latitude, longitude, precision) """
+    data = bytearray(data)
+    if not data or data[0] != VERSION:
+        raise ValueError('Unknown trace encoding')
+
+    points = []
+    offset = 1
+    values = [0, 0, 0, 0]
+    while offset < len(data):
+        for i in range(4):
+            (delta, offset) = _read_varint(data, offset)
+            values[i] += delta
+        try:
+            date = EPOCH + timedelta(seconds=values[0])
+        except OverflowError:
+            raise ValueError('Invalid date in the trace')
+        points.append((date,
+                       values[1] / 1000000.0,
+                       values[2] / 1000000.0,
+                       values[3]))
+    return points
+
+
+def _write_polyline_value(chars, value):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        chars.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chars.append(chr(value + 63))
+
+
+def encode_polyline(coordinates, precision=5):
+    """ Encode the (latitude, longitude) as a polyline """
+    factor = 10 ** precision
+    chars = []
+    previous = (0, 0)
+    for (latitude, longitude) in coordinates:
+        values = (int(round(latitude * factor)), int(round(longitude * factor)))
+        for (value, prev) in zip(values, previous):
+            _write_polyline_value(chars, value - prev)
+        previous = values
+    return ''.join(chars)
+
+
+def decode_polyline(data, precision=5):
+    """ Return the list of (latitude, longitude) """
+    factor = float(10 ** precision)
+    coordinates = []
+    offset = 0
+    values = [0, 0]
+    while offset < len(data):
+        for i in range(2):
+            value = shift = 0
+            while True:
+                byte = ord(data[offset]) - 63
+                offset += 1
+                value |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            values[i] += ~(value >> 1) if value & 1 else value >> 1
+        coordinates.append((values[0] / factor, values[1] / factor))
+    return coordinates
+
+
+def compact(outing_pk):
+    """ Move the GPS points of the outing into packed segments. Return the
+    number of points moved. """
+    from RandoAmisSecours.models import GPSPoint, Outing, TraceSegment
+
+    with transaction.atomic():
+        points = list(GPSPoint.objects.filter(outing_id=outing_pk)
+                                      .order_by('date')
+                                      .values_list('pk', 'date', 'latitude', 'longitude', 'precision'))
+        if not points:
+            return 0
+
+        segments = []
+        for start in range(0, len(points), SEGMENT_SIZE):
+            chunk = points[start:start + SEGMENT_SIZE]
+            segments.append(TraceSegment(outing_id=outing_pk,
+                                         start=chunk[0][1], end=chunk[-1][1],
+                                         count=len(chunk),
+                                         data=encode([p[1:] for p in chunk])))
+        TraceSegment.objects.bulk_create(segments)
+        # Keep the queries below the limit of parameters of some databases
+        pks = [p[0] for p in points]
+        for start in range(0, len(pks), 500):
+            GPSPoint.objects.filter(pk__in=pks[start:start + 500]).delete()
+        # The points are not listed by the GPSPoint resource anymore
+        Outing.objects.filter(pk=outing_pk).update(trace_updated=datetime.utcnow().replace(tzinfo=utc))
+    return len(points)
+
+
+def simplify(points, tolerance):
+    """ Douglas-Peucker simplification of the (date, latitude, longitude, ...)
+    tuples, the tolerance being in meters. The first and last points are
+    always kept. """
+    if tolerance <= 0 or len(points) < 3:
+        return list(points)
+
+    # Equirectangular projection, precise enough at the scale of a trace
+    scale = math.cos(math.radians(points[0][1]))
+    xy = [(math.radians(p[2]) * scale * EARTH_RADIUS, math.radians(p[1]) * EARTH_RADIUS)
+          for p in points]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        (first, last) = stack.pop()
+        ((x1, y1), (x2, y2)) = (xy[first], xy[last])
+        (dx, dy) = (x2 - x1, y2 - y1)
+        length = dx * dx + dy * dy
+
+        (index, distance) = (None, tolerance)
+        for i in range(first + 1, last):
+            (x, y) = xy[i]
+            # Distance to the segment
+            t = 0 if length == 0 else max(0, min(1, ((x - x1) * dx + (y - y1) * dy) / length))
+            d = math.hypot(x - x1 - t * dx, y - y1 - t * dy)
+            if d > distance:
+                (index, distance) = (i, d)
+
+        if index is not None:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return [point for (point, kept) in zip(points, keep) if kept]
+
+
+def tolerance_for_zoom(zoom, latitude):
+    """ Return the coarsest tier smaller than a pixel at the given zoom level
+    (0 for the full trace) """
+    zoom = max(0, min(MAX_ZOOM, zoom))
+    pixel = EARTH_CIRCUMFERENCE * math.cos(math.radians(latitude)) / 2 ** (zoom + 8)
+    for tolerance in TIERS:
+        if tolerance <= pixel:
+            return tolerance
+    return 0
+
+
+def trace_cache_key(outing_pk):
+    return "ras:trace:%d" % outing_pk
+
+
+def get_simplified_trace(outing, tolerance):
+    """ Return the points of the trace simplified with the given tier (the
+    full trace for 0). Every tier is computed at once and cached until the
+    points of the outing change. """
+    from RandoAmisSecours.models import GPSPoint
+
+    if not tolerance:
+        return outing.get_trace()
+
+    key = trace_cache_key(outing.pk)
+    tiers = cache.get(key)
+    if tiers is None:
+        points = [(p.date, p.latitude, p.longitude, p.precision) for p in outing.get_trace()]
+        tiers = dict((tier, simplify(points, tier)) for tier in TIERS)
+        cache.set(key, tiers, getattr(settings, 'RAS_TRACE_CACHE_TIMEOUT', 86400))
+
+    return [GPSPoint(outing_id=outing.pk, date=date, latitude=latitude,
+                     longitude=longitude, precision=precision)
+            for (date, latitude, longitude, precision) in tiers[tolerance]]
+
+
+def invalidate_trace(outing_pk):
+    cache.delete(trace_cache_key(outing_pk))
@@ -24,7 +24,7 @@ from django.contrib.auth import views as r_auth
 from django.core.urlresolvers import reverse_lazy
 from tastypie.api import Api
 
-from RandoAmisSecours.api import OutingResource, ProfileResource, UserResource, GPSPointResource, LoginResource
+from RandoAmisSecours.api import ArchivedOutingResource, OutingResource, ProfileResource, UserResource, GPSPointResource, LoginResource, SyncResource
 from RandoAmisSecours.views.account import RASAuthenticationForm, RASPasswordChangeForm, RASPasswordResetForm, RASSetPasswordForm
 
 from RandoAmisSecours.views import account as r_account
@@ -38,10 +38,12 @@ from RandoAmisSecours.views import reporting as r_reporting
 # API v1.0
 api_1_0 = Api(api_name='1.0')
 api_1_0.register(OutingResource())
+api_1_0.register(ArchivedOutingResource())
 api_1_0.register(ProfileResource())
 api_1_0.register(UserResource())
 api_1_0.register(GPSPointResource())
 api_1_0.register(LoginResource())
+api_1_0.register(SyncResource())
 
 urlpatterns = [
     # Main page
@@ -20,15 +20,21 @@
 from __future__ import unicode_literals
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.mail import send_mail
 from django.template import loader
 from django.utils import timezone, translation
 
+from collections import OrderedDict
+import hashlib
 import logging
 import json
 import pytz
+import threading
 from SMSForward import providers
 
+from RandoAmisSecours.models import Profile
+
 logger = logging.getLogger('ras.utils')
 
 
@@ -50,42 +56,115 @@ class Localize(object):
             translation.deactivate()
 
 
-def send_localized_mail(user, subject, template_name, ctx):
+def friends_cache_key(user_pk):
+    return "ras:friends:%d" % user_pk
+
+
+def get_friend_ids(user):
+    """ Return the set of the primary keys of the friends of the user (as
+    users), cached until the friends change """
+    key = friends_cache_key(user.pk)
+    friend_ids = cache.get(key)
+    if friend_ids is None:
+        # The friendship is symmetrical
+        friend_ids = set(Profile.objects.filter(friends__user=user)
+                                        .values_list('user_id', flat=True))
+        cache.set(key, friend_ids, getattr(settings, 'RAS_FRIENDS_CACHE_TIMEOUT', 60))
+    return friend_ids
+
+
+def invalidate_friend_ids(user_pks):
+    cache.delete_many([friends_cache_key(pk) for pk in user_pks])
+
+
+def authentication_cache_key(username, api_key):
+    # The API key is not stored in the cache key
+    credentials = "%s:%s" % (username, api_key)
+    return "ras:auth:%s" % hashlib.sha1(credentials.encode('utf-8')).hexdigest()
+
+
+def authentication_version_key(user_pk):
+    return "ras:auth-version:%d" % user_pk
+
+
+def invalidate_authentication(user_pk):
+    """ The cached authentications of the user are ignored once the version
+    is dropped """
+    cache.delete(authentication_version_key(user_pk))
+
+
+class ProviderCache(object):
+    """ LRU cache of the SMS providers, keyed by the provider name and data """
+    def __init__(self, size):
+        self.size = size
+        self.providers = OrderedDict()
+        # Key of the provider used by each profile
+        self.owners = {}
+        self.lock = threading.Lock()
+
+    def get(self, name, data, owner=None):
+        key = (name, hashlib.sha1(data.encode('utf-8')).hexdigest())
+        with self.lock:
+            provider = self.providers.pop(key, None)
+        if provider is None:
+            provider = providers.create(name, json.loads(data))
+
+        with self.lock:
+            self.providers[key] = provider
+            if owner is not None:
+                self.owners[owner] = key
+            while len(self.providers) > self.size:
+                self.providers.popitem(last=False)
+        return provider
+
+    def invalidate(self, owner):
+        with self.lock:
+            key = self.owners.pop(owner, None)
+            if key is not None:
+                self.providers.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.providers.clear()
+            self.owners.clear()
+
+
+provider_cache = ProviderCache(getattr(settings, 'RAS_PROVIDER_CACHE_SIZE', 256))
+
+
+def get_provider(profile):
+    """ Return the (cached) SMS provider of the profile """
+    return provider_cache.get(profile.provider, profile.provider_data, profile.pk)
+
+
+class RenderCache(object):
+    """ Render every (template, language, timezone, context) only once """
+    def __init__(self):
+        self.cache = {}
+
+    def render(self, template_name, ctx, language, timezone):
+        fingerprint = tuple(sorted((k, repr(v)) for (k, v) in ctx.items()))
+        key = (template_name, language, timezone, fingerprint)
+        try:
+            return self.cache[key]
+        except KeyError:
+            with Localize(language, timezone):
+                body = loader.render_to_string(template_name, ctx)
+            self.cache[key] = body
+            return body
+
+
+def send_localized_mail(user, subject, template_name, ctx, connection=None):
     with Localize(user.profile.language,
                   user.profile.timezone):
-        send_mail_help(user, subject, template_name, ctx)
+        send_mail_help(user, subject, template_name, ctx, connection=connection)
 
 
-def send_mail_help(user, subject, template_name, ctx):
+def send_mail_help(user, subject, template_name, ctx, connection=None):
+    """ Render and send the email with the given connection, shared by the
+    callers sending several emails in a row (a new one otherwise) """
     body = loader.render_to_string(template_name, ctx)
     logger.info("Sending email to '%s' ('%s')", user.get_full_name(),
                 user.email, extra={'data': ctx})
-    send_mail(subject, body, settings.DEFAULT_FROM_EMAIL, [user.email])
-
-
-def send_sms(user, template_name, ctx):
-    # Check that the provider is available
-    if not user.profile.provider or not user.profile.provider_data:
-        return
-
-    logger.info("Sending SMS to '%s' ('%s')",
-                user.get_full_name(), user.profile.provider,
-                extra={'data': ctx})
-    msg = loader.render_to_string(template_name, ctx)
-
-    # Create the provider object
-    try:
-        provider = providers.create(user.profile.provider,
-                                    json.loads(user.profile.provider_data))
-    except NotImplementedError:
-        logger.error("Unknown provider '%s'", user.profile.provider,
-                     exc_info=True,
-                     extra={'data': {'user': user.get_full_name(),
-                                     'provider': user.profile.provider}})
-
-    try:
-        provider.send_message(msg)
-    except Exception:
-        logger.error("Unable to send SMS", exc_info=True,
-                     extra={'data': {'user': user.get_full_name(),
-                                     'provider': user.profile.provider}})
+    send_mail(subject, body, settings.DEFAULT_FROM_EMAIL, [user.email],
+              connection=connection)
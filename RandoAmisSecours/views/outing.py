@@ -22,13 +22,26 @@ from __future__ import unicode_literals
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.core.urlresolvers import reverse
-from django.db.models import Q
 from django.forms import ModelForm
 from django.http import Http404, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
+from django.utils.timezone import datetime, utc
 from django.utils.translation import ugettext as _
 
-from RandoAmisSecours.models import Outing, DRAFT, CONFIRMED, FINISHED
+from RandoAmisSecours.models import Outing, DRAFT, CONFIRMED, FINISHED, classify_outings, get_outing
+from RandoAmisSecours.trace import MAX_ZOOM, get_simplified_trace, tolerance_for_zoom
+from RandoAmisSecours.utils import get_friend_ids
+
+# Zoom level of the trace maps
+DEFAULT_ZOOM = 12
+
+
+def get_outing_or_404(outing_id):
+    """ Also look for the archived outings """
+    try:
+        return get_outing(outing_id)
+    except Outing.DoesNotExist:
+        raise Http404
 
 
 class OutingForm(ModelForm):
@@ -74,13 +87,14 @@ class OutingForm(ModelForm):
 @login_required
 def index(request):
     # List all outings owned by the user and his friends
+    now = datetime.utcnow().replace(tzinfo=utc)
     user_outings = Outing.objects.filter(user=request.user)
-    user_outings_confirmed = user_outings.filter(status=CONFIRMED)
+    user_outings_confirmed = classify_outings(user_outings.filter(status=CONFIRMED), now)
     user_outings_draft = user_outings.filter(status=DRAFT)
     user_outings_finished = user_outings.filter(status=FINISHED)
 
     friends_outings = Outing.objects.filter(user__profile__in=request.user.profile.friends.all()).select_related()
-    friends_outings_confirmed = friends_outings.filter(status=CONFIRMED)
+    friends_outings_confirmed = classify_outings(friends_outings.filter(status=CONFIRMED), now)
     friends_outings_draft = friends_outings.filter(status=DRAFT)
     friends_outings_finished = friends_outings.filter(status=FINISHED)
 
@@ -96,7 +110,10 @@ def index(request):
 @login_required
 def details(request, outing_id):
     # Return 404 if the outing does not belong to the user or his friends
-    outing = get_object_or_404(Outing, Q(user=request.user) | Q(user__profile__in=request.user.profile.friends.all()), pk=outing_id)
+    outing = get_outing_or_404(outing_id)
+    if outing.user_id != request.user.pk and outing.user_id not in get_friend_ids(request.user):
+        raise Http404
+    classify_outings([outing], datetime.utcnow().replace(tzinfo=utc))
 
     return render(request, 'RandoAmisSecours/outing/details.html',
                   {'outing': outing,
@@ -108,15 +125,27 @@ def details(request, outing_id):
 @login_required
 def details_trace(request, outing_id):
     # Return 404 if the outing does not belong to the user or his friends
-    outing = get_object_or_404(Outing, Q(user=request.user) | Q(user__profile__in=request.user.profile.friends.all()), pk=outing_id)
+    outing = get_outing_or_404(outing_id)
+    if outing.user_id != request.user.pk and outing.user_id not in get_friend_ids(request.user):
+        raise Http404
 
     # Friends can only access traces when the outing is late
-    if not outing.is_late() and not outing.is_alerting() and not outing.user.pk == request.user.pk:
+    now = datetime.utcnow().replace(tzinfo=utc)
+    if outing.get_state(now) not in ('late', 'alerting') and not outing.user_id == request.user.pk:
         raise Http404
 
+    # Only send the points that are visible at this zoom level
+    try:
+        zoom = max(0, min(MAX_ZOOM, int(request.GET.get('zoom', DEFAULT_ZOOM))))
+    except ValueError:
+        zoom = DEFAULT_ZOOM
+    tolerance = tolerance_for_zoom(zoom, outing.latitude)
+
     return render(request, 'RandoAmisSecours/outing/details_trace.html',
                   {'outing': outing,
-                   'points': outing.gpspoint_set.all()})
+                   'points': get_simplified_trace(outing, tolerance),
+                   'zoom': zoom, 'max_zoom': MAX_ZOOM,
+                   'tolerance': tolerance})
 
 
 @login_required
@@ -23,10 +23,28 @@ from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import User
 from django.contrib.sessions.models import Session
+from django import forms
 from django.shortcuts import render
 from django.utils.timezone import datetime, utc
+from django.utils.translation import ugettext as _
 
-from RandoAmisSecours.models import Outing, CONFIRMED
+from RandoAmisSecours.geo import haversine, near
+from RandoAmisSecours.models import Outing, CONFIRMED, classify_outings
+
+
+class NearForm(forms.Form):
+    """ Position and distance (in km) of the search """
+    latitude = forms.FloatField(min_value=-90, max_value=90)
+    longitude = forms.FloatField(min_value=-180, max_value=180)
+    distance = forms.FloatField(min_value=0, max_value=getattr(settings, 'RAS_NEAR_MAX_DISTANCE', 100))
+
+    def __init__(self, *args, **kwargs):
+        super(NearForm, self).__init__(*args, **kwargs)
+        self.fields['latitude'].widget.attrs['placeholder'] = _('Latitude')
+        self.fields['longitude'].widget.attrs['placeholder'] = _('Longitude')
+        self.fields['distance'].widget.attrs['placeholder'] = _('Distance (km)')
+        for field in self.fields.values():
+            field.widget.attrs['class'] = 'form-control'
 
 
 @staff_member_required
@@ -87,6 +105,21 @@ def users(request):
 @staff_member_required
 def outings_late(request):
     now = datetime.utcnow().replace(tzinfo=utc)
-    late_outings = Outing.objects.filter(status=CONFIRMED, ending__lt=now)
+    outings = Outing.objects.filter(status=CONFIRMED, ending__lt=now).select_related('user')
+
+    # Only the outings around the given position
+    form = NearForm(request.GET or None)
+    if form.is_valid():
+        (latitude, longitude) = (form.cleaned_data['latitude'], form.cleaned_data['longitude'])
+        outings = near(outings, latitude, longitude, form.cleaned_data['distance'])
+
+    late_outings = classify_outings(outings, now)
+    if form.is_valid():
+        for outing in late_outings:
+            outing.distance = haversine(latitude, longitude, outing.latitude, outing.longitude)
+        late_outings.sort(key=lambda outing: outing.distance)
+
     return render(request, 'RandoAmisSecours/reporting/outings_late.html',
-                  {'late_outings': late_outings})
+                  {'late_outings': late_outings,
+                   'form': form,
+                   'now': now})
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set ts=4
+
+# Copyright 2016 Rémi Duraffort
+# This file is part of RandoAmisSecours.
+#
+# RandoAmisSecours is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RandoAmisSecours is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with RandoAmisSecours.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Query plans and timings of the hot queries, without and with the composite
+indexes of migration 0005, on synthetic outings and GPS points:
+
+    ./benchmark_indexes.py --rows 1000000
+
+The database of test_settings is used with the name given by --database.
+With sqlite the file is recreated, the other databases should be empty.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+
+
+INDEXES = '0005_composite_indexes'
+WITHOUT_INDEXES = '0004_outing_next_notification_at'
+
+
+def setup(database):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test_settings")
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+
+    from django.conf import settings
+    settings.DATABASES['default']['NAME'] = database
+    settings.DEBUG = False
+    if settings.DATABASES['default']['ENGINE'].endswith('sqlite3') and os.path.exists(database):
+        os.unlink(database)
+
+    import django
+    django.setup()
+
+
+def historical_apps(migration):
+    """ Return the models as of the given migration: the fields added later
+    are not in the database yet """
+    from django.db import connection
+    from django.db.migrations.executor import MigrationExecutor
+
+    executor = MigrationExecutor(connection)
+    return executor.loader.project_state(('RandoAmisSecours', migration)).apps
+
+
+def populate(apps, rows, batch=10000):
+    from django.utils.timezone import datetime, timedelta, utc
+    from RandoAmisSecours.models import CANCELED, CONFIRMED, DRAFT, FINISHED
+
+    User = apps.get_model('auth', 'User')
+    Outing = apps.get_model('RandoAmisSecours', 'Outing')
+    GPSPoint = apps.get_model('RandoAmisSecours', 'GPSPoint')
+
+    random.seed(42)
+    now = datetime.utcnow().replace(tzinfo=utc)
+
+    users = max(rows // 100, 1)
+    User.objects.bulk_create([User(username="user%d" % i) for i in range(users)])
+    user_pks = list(User.objects.values_list('pk', flat=True))
+
+    # Mostly finished outings, spread over the last year
+    statuses = [FINISHED] * 90 + [CONFIRMED] * 5 + [DRAFT] * 3 + [CANCELED] * 2
+    for start in range(0, rows, batch):
+        outings = []
+        for i in range(start, min(start + batch, rows)):
+            beginning = now + timedelta(minutes=random.randint(-365 * 24 * 60, 7 * 24 * 60))
+            ending = beginning + timedelta(hours=random.randint(1, 12))
+            alert = ending + timedelta(hours=random.randint(1, 6))
+            status = random.choice(statuses)
+            outings.append(Outing(user_id=random.choice(user_pks), name="outing %d" % i,
+                                  description='', status=status,
+                                  beginning=beginning, ending=ending, alert=alert,
+                                  latitude=0, longitude=0,
+                                  next_notification_at=ending if status in (DRAFT, CONFIRMED) else None))
+        Outing.objects.bulk_create(outings)
+
+    # One hundred points per outing for the first outings
+    outing_pks = list(Outing.objects.order_by('pk').values_list('pk', flat=True)[:max(rows // 100, 1)])
+    for start in range(0, rows, batch):
+        points = []
+        for i in range(start, min(start + batch, rows)):
+            points.append(GPSPoint(outing_id=outing_pks[i % len(outing_pks)],
+                                   date=now - timedelta(seconds=random.randint(0, 12 * 3600)),
+                                   latitude=0, longitude=0, precision=10))
+        GPSPoint.objects.bulk_create(points)
+
+
+def queries(apps):
+    from django.utils.timezone import datetime, utc
+    from RandoAmisSecours.models import CONFIRMED, DRAFT, FINISHED
+
+    User = apps.get_model('auth', 'User')
+    Outing = apps.get_model('RandoAmisSecours', 'Outing')
+    GPSPoint = apps.get_model('RandoAmisSecours', 'GPSPoint')
+
+    now = datetime.utcnow().replace(tzinfo=utc)
+    user = User.objects.order_by('pk')[0]
+    outing = GPSPoint.objects.order_by('pk')[0].outing
+    # Only load the primary keys to time the database rather than the ORM
+    return [(name, queryset.values_list('pk', flat=True)) for (name, queryset) in [
+        ('alert scan', Outing.objects.filter(status=CONFIRMED, next_notification_at__lte=now)),
+        ('drafts', Outing.objects.filter(status=DRAFT, beginning__lt=now)),
+        ('late outings', Outing.objects.filter(status=CONFIRMED, ending__lt=now)),
+        ('user confirmed', Outing.objects.filter(user=user, status=CONFIRMED)),
+        ('user finished', Outing.objects.filter(user=user, status=FINISHED)),
+        ('trace', GPSPoint.objects.filter(outing=outing).order_by('date')),
+    ]]
+
+
+def explain(queryset):
+    from django.db import connection
+
+    (sql, params) = queryset.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return [' '.join([str(c) for c in row]) for row in cursor.fetchall()]
+
+
+def measure(apps, repeat):
+    for (name, queryset) in queries(apps):
+        timings = []
+        for _ in range(repeat):
+            start = time.time()
+            count = len(list(queryset.all()))
+            timings.append(time.time() - start)
+        print("%-16s %8d rows %9.2f ms" % (name, count, min(timings) * 1000))
+        for line in explain(queryset):
+            print("    %s" % line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help='Number of outings and of GPS points')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of runs of each query (the best is kept)')
+    parser.add_argument('--database', default='ras_benchmark',
+                        help='Name of the database')
+    args = parser.parse_args()
+
+    setup(args.database)
+    from django.core.management import call_command
+    from django.db import transaction
+
+    call_command('migrate', verbosity=0)
+    call_command('migrate', 'RandoAmisSecours', WITHOUT_INDEXES, verbosity=0)
+
+    # Both migrations have the same fields
+    apps = historical_apps(WITHOUT_INDEXES)
+    start = time.time()
+    with transaction.atomic():
+        populate(apps, args.rows)
+    print("Populated %d outings and GPS points in %.1fs" % (args.rows, time.time() - start))
+
+    print("\n== Without the composite indexes ==")
+    measure(apps, args.repeat)
+
+    start = time.time()
+    call_command('migrate', 'RandoAmisSecours', INDEXES, verbosity=0)
+    print("\nCreated the indexes in %.1fs" % (time.time() - start))
+
+    print("\n== With the composite indexes ==")
+    measure(apps, args.repeat)
+
+
+if __name__ == '__main__':
+    main()